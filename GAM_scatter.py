@@ -15,12 +15,22 @@ import plotly.graph_objects as go
 import numpy as np
 from pygam import LinearGAM, s
 import os
+from pipeline import load_input
+from artifact_cache import ArtifactCache, code_version, package_version
+from instrumentation import stage
+import html_output
+import temporal
 
 # Define file paths
 stationary_survey_path = r'C:\Users\BoschJ\Desktop\ECSAS_analysis\data\stationary_platform_data.xlsx'
 
 # Load the stationary survey data
-stationary_survey = pd.read_excel(stationary_survey_path)
+stationary_survey = load_input('stationary_survey', stationary_survey_path)
+
+# Outputs are cached by a hash of the survey data and this script (see artifact_cache.py), and every key below is
+# chained from this one, so they're only rewritten when the data or the code changed
+cache = ArtifactCache()
+data_key = cache.key(stationary_survey, code_version(__file__))
 
 
 ################################################
@@ -52,7 +62,8 @@ print("List of seabird species observed during the cruise by highest average cou
 print(sorted_species_avg)
 
 # Save the table as a .csv file
-sorted_species_avg.to_csv('sorted_species_avg.csv', index=False)
+cache.output(cache.key(data_key, 'sorted_species_avg'), 'sorted_species_avg.csv',
+             lambda path: sorted_species_avg.to_csv(path, index=False))
 
 ###################################
 # Plotting a scatterplot with a GAM
@@ -70,20 +81,12 @@ grouped_df = subset_df.groupby(['WatchID', 'Alpha', 'StartTime', 'LatStart', 'Lo
 sorted_df = grouped_df.sort_values(by='StartTime')
 
 # Save sorted dataframe to an Excel file
-sorted_df.to_excel(os.path.join('data/sorted_stationary_survey_data.xlsx'), index=False)
-
-# Extract unique days from StartTime
-sorted_df['Date'] = sorted_df['StartTime'].dt.date
-
-# Create a mapping of unique days to sequential day numbers
-unique_days = sorted_df['Date'].unique()
-day_mapping = {day: f"Day {i+1}" for i, day in enumerate(unique_days)}
+cache.output(cache.key(data_key, 'sorted_stationary_survey_data'), os.path.join('data/sorted_stationary_survey_data.xlsx'),
+             lambda path: sorted_df.to_excel(path, index=False))
 
-# Map the day numbers back to the dataframe
-sorted_df['Day'] = sorted_df['Date'].map(day_mapping)
-
-# Drop the intermediate Date column
-sorted_df.drop(columns=['Date'], inplace=True)
+# Number the days of the survey from the start times (see temporal.py), Day 1 being the first day with a watch
+survey_day = pd.Series(temporal.survey_day(temporal.to_ns(sorted_df['StartTime'])), index=sorted_df.index)
+sorted_df['Day'] = ('Day ' + survey_day.astype(str)).where(survey_day != temporal.MISSING)
 
 # Calculate z-scores for the counts of each species
 sorted_df['ZScore'] = sorted_df.groupby('Alpha')['Count'].transform(lambda x: (x - x.mean()) / x.std())
@@ -99,7 +102,13 @@ mean_zscores = mean_zscores.rename(index=watch_id_mapping)
 # Fit the GAM model
 X = np.array(list(watch_id_mapping.values())).reshape(-1, 1)  # Independent variable (WatchID_Pos)
 y = mean_zscores.values  # Dependent variable (ZScore)
-gam = LinearGAM(s(0)).fit(X, y)
+
+# Watches that only saw species recorded once have no z-score (the std of one count is NaN), so they're left out of the fit
+has_zscore = np.isfinite(y)
+X, y = X[has_zscore], y[has_zscore]
+with stage('fit', rows_in=len(X)):
+    gam_key = cache.key(X, y, 'LinearGAM(s(0))', code_version(__file__), package_version('pygam'))
+    gam = cache.memoize(gam_key, lambda: LinearGAM(s(0)).fit(X, y))
 
 # Generate predictions
 X_pred = np.linspace(X.min(), X.max(), 100).reshape(-1, 1)
@@ -167,7 +176,12 @@ fig.update_layout(
     legend=dict(title='Species', x=1.05, y=1)
 )
 
-# Save the interactive plot as an HTML file
-fig.write_html('figures/interactive_scatter_plot.html')
+# Save the interactive plot as an HTML file that loads the shared plotly.js; at archive scale the points are binned,
+# drawn with WebGL and the WatchID ticks thinned out (see html_output.py)
+with stage('write', rows_in=len(sorted_df)):
+    html_path = 'figures/interactive_scatter_plot.html'
+    html_output.ensure_plotly_js()
+    cache.output(cache.key(data_key, code_version(html_output.__file__), 'interactive_scatter_plot'), html_path,
+                 lambda path: html_output.write_html(fig, path, destination=html_path))
 
 
@@ -0,0 +1,238 @@
+#####################################################
+############   ARTIFACT CACHE    ####################
+
+"""
+Derived outputs like `sorted_species_avg.csv`, the GAM and regression fits, and the figures in `figures/` were rebuilt and
+rewritten on every run, even when nothing they depend on had changed.
+
+Here I keep a content-addressed cache of those artifacts in `cache/artifacts`. Every entry is stored under a key that
+is a hash of everything it was made from: the input data, the parameters and the version of the code. If any of those
+change the key changes, so an entry never has to be invalidated, it just stops being used.
+
+- `key()` hashes DataFrames, arrays, files, dicts and plain values into a key. Passing an earlier key as one of the
+  parts chains them, so in a parameter sweep every step that shares the same inputs and earlier parameters also shares
+  the same cached entries.
+- `memoize()` returns a cached Python object (e.g. a fitted model) or computes and stores it.
+- `frame()` does the same for DataFrames, stored as Parquet.
+- `output()` writes an output file (a CSV, PNG or HTML figure) through the cache: on a hit the cached copy is put in
+  place, and a file that is already identical isn't rewritten.
+
+The cache stays under a disk budget (ECSAS_CACHE_BUDGET_MB, 2 GB by default) by evicting the least recently used entries.
+Each hit updates the entry's modification time, so the modification times give the LRU order without a separate index,
+and entries are written to a temporary file and renamed so parallel workers can share the cache safely. The size of the
+cache is measured once and then kept as a running total of the entries written; only when that goes over the budget is
+the cache walked again, and entries are then evicted down to EVICT_TO of the budget so the next walk is a while off.
+Entries written by other processes are only counted at that walk, so the cache can briefly go over by what they wrote.
+"""
+
+# load the required modules
+import hashlib
+import importlib.metadata
+import json
+import os
+import pickle
+import shutil
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from store import CACHE_DIR
+
+
+# Define the folder for the cache and its default size limit
+ARTIFACTS_DIR = os.path.join(CACHE_DIR, 'artifacts')
+DEFAULT_BUDGET_MB = 2048
+
+# Eviction frees space down to this fraction of the budget
+EVICT_TO = 0.9
+
+
+###########################
+# Keys
+
+def _update(digest, part):
+    """Feed one part of a key into the hash, using a stable representation for each type."""
+    if isinstance(part, pd.DataFrame):
+        digest.update(b'frame')
+        digest.update(json.dumps([str(c) for c in part.columns] + [str(t) for t in part.dtypes]).encode())
+        digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+    elif isinstance(part, pd.Series):
+        digest.update(b'series')
+        digest.update(pd.util.hash_pandas_object(part, index=True).to_numpy().tobytes())
+    elif isinstance(part, np.ndarray):
+        digest.update(b'array' + str(part.dtype).encode() + str(part.shape).encode())
+        digest.update(np.ascontiguousarray(part).tobytes())
+    elif isinstance(part, (dict, list, tuple)):
+        digest.update(b'json')
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode())
+    else:
+        digest.update(b'value')
+        digest.update(repr(part).encode())
+
+
+def file_hash(path, chunk_size=1 << 20):
+    """Hash the contents of a file."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as source:
+        for chunk in iter(lambda: source.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def code_version(*paths):
+    """Hash the source files an artifact is made by, so editing the code gives new keys."""
+    return hashlib.sha256(''.join(file_hash(path) for path in paths).encode()).hexdigest()
+
+
+def package_version(*names):
+    """Installed versions of the packages an artifact is made with, so a fit from another release isn't reused."""
+    return {name: importlib.metadata.version(name) for name in names}
+
+
+def key(*parts):
+    """Hash input data, parameters and code versions into a cache key."""
+    digest = hashlib.sha256()
+    for part in parts:
+        _update(digest, part)
+    return digest.hexdigest()
+
+
+###########################
+# The cache
+
+class ArtifactCache:
+    """
+    A content-addressed store of cached artifacts with least-recently-used eviction under a disk budget.
+    """
+
+    def __init__(self, root=ARTIFACTS_DIR, budget_mb=None):
+        self.root = root
+        if budget_mb is None:
+            budget_mb = float(os.environ.get('ECSAS_CACHE_BUDGET_MB', DEFAULT_BUDGET_MB))
+        self.budget_bytes = int(budget_mb * 1024 * 1024)
+        # running total of the cache size in bytes, measured on the first write
+        self._total = None
+        os.makedirs(root, exist_ok=True)
+
+    key = staticmethod(key)
+
+    def path(self, entry_key, suffix):
+        """Entries are spread over 256 subfolders by the first two characters of their key."""
+        return os.path.join(self.root, entry_key[:2], f'{entry_key}{suffix}')
+
+    def _hit(self, path):
+        """Return True if the entry exists, marking it as recently used."""
+        try:
+            os.utime(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def _store(self, path, write):
+        """Write an entry to a temporary file with `write(tmp_path)` and move it into place in one step."""
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # the temporary file keeps the real extension, since e.g. matplotlib picks the image format from it
+        handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp' + os.path.splitext(path)[1])
+        os.close(handle)
+        if self._total is None:
+            self._total = self.size()
+        try:
+            write(tmp_path)
+            replaced = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self._total += os.path.getsize(path) - replaced
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        if self._total > self.budget_bytes:
+            self.evict(keep=path)
+
+    def memoize(self, entry_key, compute):
+        """Return the cached object for `entry_key`, or compute it, store it (pickled) and return it."""
+        path = self.path(entry_key, '.pkl')
+        if self._hit(path):
+            with open(path, 'rb') as cached:
+                return pickle.load(cached)
+
+        value = compute()
+
+        def write(tmp_path):
+            with open(tmp_path, 'wb') as target:
+                pickle.dump(value, target, protocol=pickle.HIGHEST_PROTOCOL)
+        self._store(path, write)
+        return value
+
+    def frame(self, entry_key, compute):
+        """Return the cached DataFrame for `entry_key`, or compute it and store it as Parquet."""
+        path = self.path(entry_key, '.parquet')
+        if self._hit(path):
+            return pd.read_parquet(path)
+
+        value = compute()
+        self._store(path, lambda tmp_path: value.to_parquet(tmp_path))
+        return value
+
+    def output(self, entry_key, destination, render):
+        """
+        Put the output file for `entry_key` at `destination`, calling `render(path)` to make it only on a cache miss.
+
+        Returns True if the file was rendered, False if it came from the cache. The destination is left untouched if it
+        already has the same contents as the cached entry.
+        """
+        suffix = os.path.splitext(destination)[1]
+        path = self.path(entry_key, suffix)
+        rendered = False
+        if not self._hit(path):
+            self._store(path, render)
+            rendered = True
+
+        if not (os.path.exists(destination) and os.path.getsize(destination) == os.path.getsize(path)
+                and file_hash(destination) == file_hash(path)):
+            os.makedirs(os.path.dirname(os.path.abspath(destination)), exist_ok=True)
+            shutil.copyfile(path, destination)
+        return rendered
+
+    def entries(self):
+        """List (path, size, last used) for every entry."""
+        found = []
+        for folder, _, files in os.walk(self.root):
+            for name in files:
+                if '.tmp' in name:
+                    continue
+                path = os.path.join(folder, name)
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    continue
+                found.append((path, stat.st_size, stat.st_mtime))
+        return found
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self, keep=None, target_bytes=None):
+        """
+        Remove the least recently used entries until the cache fits in `target_bytes` (EVICT_TO of the budget by default),
+        never the entry `keep`.
+        """
+        if target_bytes is None:
+            target_bytes = int(self.budget_bytes * EVICT_TO)
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in sorted(entries, key=lambda entry: entry[2]):
+            if total <= target_bytes:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self._total = total
+
+    def clear(self):
+        shutil.rmtree(self.root, ignore_errors=True)
+        os.makedirs(self.root, exist_ok=True)
+        self._total = 0
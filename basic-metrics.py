@@ -9,14 +9,20 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 import numpy as np
 from prettytable import PrettyTable
+from species_accumulation import incidence_matrix, chao1, ace
+from lookups import load_lookups
+from store import load_store
+from survey_arrays import haversine_km
+from pipeline import load_input
+from instrumentation import stage
 
 # Define file paths using raw string literals
 stationary_survey_path = r'C:\Users\BoschJ\Desktop\ECSAS_analysis\data\stationary_platform_data.xlsx'
 moving_survey_path = r'C:\Users\BoschJ\Desktop\ECSAS_analysis\data\moving_platform_data.xlsx'
 
 # Load the stationary and moving survey data
-stationary_survey = pd.read_excel(stationary_survey_path)
-moving_survey = pd.read_excel(moving_survey_path)
+stationary_survey = load_input('stationary_survey', stationary_survey_path)
+moving_survey = load_input('moving_survey', moving_survey_path)
 
 # Convert the 'Date' column to datetime format in both moving and stationary survey DataFrames
 moving_survey['Date'] = pd.to_datetime(moving_survey['Date'])
@@ -37,6 +43,17 @@ total_surveys_stationary = stationary_survey['WatchID'].nunique()
 total_species_moving = moving_survey['Alpha'].nunique()
 total_species_stationary = stationary_survey['Alpha'].nunique()
 
+# The number of species seen depends on how many watches were done, so also estimate the true richness with Chao1 and ACE
+# (see species_accumulation.py for the full accumulation and rarefaction curves)
+def estimated_richness(survey):
+    matrix, _, _ = incidence_matrix(survey)
+    abundances = np.asarray(matrix.sum(axis=0)).ravel().round().astype(int)
+    return chao1(abundances), ace(abundances)
+
+with stage('fit', rows_in=len(moving_survey) + len(stationary_survey)):
+    chao1_moving, ace_moving = estimated_richness(moving_survey)
+    chao1_stationary, ace_stationary = estimated_richness(stationary_survey)
+
 # Count occurrences of each species for the moving platform survey
 moving_species_counts = moving_survey.groupby('Alpha')['Count'].sum()
 
@@ -58,10 +75,9 @@ most_seen_stationary_count = stationary_species_counts.max()       # Get the max
 least_seen_stationary_species = stationary_species_counts.idxmin()  # Get the species name with the minimum count
 least_seen_stationary_count = stationary_species_counts.min()       # Get the minimum count
 
-# Load metadata from Excel files for additional cruise info
-df_cruise = pd.read_excel(r'C:\Users\BoschJ\Desktop\ECSAS_analytics_app\ECSAS_tables\tblCruise.xlsx')
-df_platform = pd.read_excel(r'C:\Users\BoschJ\Desktop\ECSAS_analytics_app\ECSAS_tables\lkpPlatform.xlsx')
-df_observer = pd.read_excel(r'C:\Users\BoschJ\Desktop\ECSAS_analytics_app\ECSAS_tables\lkpObserver.xlsx')
+# Load the cruise info from the relational store, and the observer and platform names from the lookup tables
+df_cruise = load_store().cruises
+lookups = load_lookups()
 
 # Specify the CruiseID for my cruise
 cruise_id = 1715529814
@@ -71,38 +87,22 @@ cruise_info = df_cruise[df_cruise['CruiseID'] == cruise_id].iloc[0]  # assuming
 
 # Get Observer and platform names
 observer_id = cruise_info['Observer']
-observer_name = df_observer[df_observer['ObserverID'] == observer_id]['ObserverName'].iloc[0]
+observer_name = lookups.decode([observer_id], 'lkpObserver', 'ObserverName')[0]
 
 platform_id = cruise_info['PlatformName']
-platform_name = df_platform[df_platform['PlatformID'] == platform_id]['PlatformText'].iloc[0]
+platform_name = lookups.decode([platform_id], 'lkpPlatform', 'PlatformText')[0]
 
 
 ########################################
-#Haversine function to calculate distance
-
-# Define the Haversine function to calculate distance between two points on the Earth
-def haversine(lon1, lat1, lon2, lat2):
-    """
-    Calculate the great circle distance in kilometers between two points 
-    on the earth (specified in decimal degrees)
-    """
-    # Convert decimal degrees to radians 
-    lon1, lat1, lon2, lat2 = map(np.radians, [lon1, lat1, lon2, lat2])
-
-    # Haversine formula 
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = np.sin(dlat/2)**2 + np.cos(lat1) * np.cos(lat2) * np.sin(dlon/2)**2
-    c = 2 * np.arctan2(np.sqrt(a), np.sqrt(1-a)) 
-    km = 6371 * c # Radius of earth in kilometers. Use 3956 for miles. Determines return value units.
-    return km
+#Haversine distance from the port
 
 # Port coordinates
 start_coords = [47.569575, -52.698024]
 
-# Calculate the distance from the port to each watch point
-stationary_survey['DistanceFromPort'] = stationary_survey.apply(
-    lambda row: haversine(start_coords[1], start_coords[0], row['LongStart'], row['LatStart']), axis=1
+# Calculate the distance from the port to each watch point, with the haversine distance shared with the other analyses
+# (survey_arrays.py); it works on whole numpy arrays, so the columns are passed in at once instead of row by row
+stationary_survey['DistanceFromPort'] = haversine_km(
+    start_coords[0], start_coords[1], stationary_survey['LatStart'].to_numpy(), stationary_survey['LongStart'].to_numpy()
 )
 
 # Identify the furthest watch point
@@ -123,6 +123,8 @@ results_table.add_row(["", "", ""])  # Add an empty row with placeholders
 
 results_table.add_row(["Total surveys conducted", total_surveys_moving, total_surveys_stationary])
 results_table.add_row(["Species or bird types observed", total_species_moving, total_species_stationary])
+results_table.add_row(["Estimated species richness (Chao1)", f"{chao1_moving:.1f}", f"{chao1_stationary:.1f}"])
+results_table.add_row(["Estimated species richness (ACE)", f"{ace_moving:.1f}", f"{ace_stationary:.1f}"])
 
 results_table.add_row(["", "", ""])  # Add an empty row with placeholders
 
@@ -0,0 +1,266 @@
+#####################################################
+##############   SCALING BENCHMARKS    ##############
+
+"""
+With one cruise in the repository there was no way to see how the stages scale to a full extract, or to notice when a
+change made one of them slower.
+
+Here I run the pipeline stages on synthetic data (synthetic_data.py) at several sizes and record, for every stage:
+
+- the wall time in seconds
+- the peak resident memory of the process (every stage runs in its own process, so this is the stage's own peak)
+- the peak memory allocated through Python (tracemalloc), which leaves out the interpreter and the imported modules
+
+Each size gets its own working folder with a synthetic `ECSAS_tables`, so the stages run exactly as they do on the real
+export. The results can be stored as baselines (`benchmark_baselines.json`) and later runs are compared against them;
+a stage that got slower or bigger than the tolerance is reported as a regression and the run exits with an error.
+The startup time of the `ecsas` command is checked against its budget as well.
+
+    python benchmarks.py --save-baseline              # 1e3, 1e4 and 1e5 sightings
+    python benchmarks.py                              # compare against the stored baselines
+
+1e6 and 1e7 sightings take long enough (and need enough memory) that they are run on their own, e.g. as a SLURM job
+with a few GB, and only for the stages of interest. Their baselines are kept next to the default ones:
+
+    python benchmarks.py --sizes 1e6 --save-baseline
+    python benchmarks.py --sizes 1e6 1e7 --stages ingest merge metrics
+"""
+
+# load the required modules
+import argparse
+import json
+import os
+import pickle
+import platform
+import resource
+import shutil
+import statistics
+import subprocess
+import sys
+import time
+import tracemalloc
+
+
+# Define the repository folder, the working folders and the baselines file
+ROOT = os.path.dirname(os.path.abspath(__file__))
+BENCH_DIR = os.path.join(ROOT, 'cache', 'bench')
+BASELINES_PATH = os.path.join(ROOT, 'benchmark_baselines.json')
+
+# Default sizes (number of sightings); 1e6 and 1e7 can be passed with --sizes
+SIZES = [1_000, 10_000, 100_000]
+
+# Stages in the order they run; the later ones read the saved results of `merge`
+STAGES = ['generate', 'ingest', 'merge', 'metrics', 'map', 'heatmaps', 'pies', 'gam', 'visibility']
+
+# Pipeline scripts behind the analysis stages
+SCRIPTS = {
+    'metrics': 'basic-metrics.py',
+    'map': 'interactive_map.py',
+    'heatmaps': 'heatmaps.py',
+    'pies': 'pie-chart.py',
+    'gam': 'GAM_scatter.py',
+    'visibility': 'visibility.py',
+}
+
+# Allowed growth over the baseline before a number counts as a regression (0.5 = 50% slower or bigger)
+TIME_TOLERANCE = 0.5
+MEMORY_TOLERANCE = 0.25
+
+# Stages shorter than this are too noisy to compare times
+MIN_COMPARED_SECONDS = 0.5
+
+
+###########################
+# Running one stage (in its own process)
+
+def _saved(workdir, name):
+    return os.path.join(workdir, 'cache', 'bench', f'{name}.pkl')
+
+
+def _save(workdir, name, value):
+    os.makedirs(os.path.dirname(_saved(workdir, name)), exist_ok=True)
+    with open(_saved(workdir, name), 'wb') as target:
+        pickle.dump(value, target, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def _load(workdir, name):
+    with open(_saved(workdir, name), 'rb') as source:
+        return pickle.load(source)
+
+
+def run_stage(stage, workdir, size, seed):
+    """Run one stage inside `workdir` and return its measurements."""
+    sys.path.insert(0, ROOT)
+    os.chdir(workdir)
+    for folder in ('data', 'figures'):
+        os.makedirs(folder, exist_ok=True)
+
+    import pipeline
+    from store import TABLES_DIR
+
+    tracemalloc.start()
+    start = time.perf_counter()
+
+    if stage == 'generate':
+        from synthetic_data import generate
+        generate(size, TABLES_DIR, seed=seed, tables_dir=os.path.join(ROOT, TABLES_DIR))
+    elif stage == 'ingest':
+        _save(workdir, 'ingest', pipeline.ingest())
+    elif stage == 'merge':
+        _save(workdir, 'merge', pipeline.merge(_load(workdir, 'ingest')))
+    else:
+        pipeline.run_script(SCRIPTS[stage], **_load(workdir, 'merge'))
+
+    seconds = time.perf_counter() - start
+    _, traced_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    rss_unit = 1 if sys.platform == 'darwin' else 1024
+    return {
+        'seconds': round(seconds, 4),
+        'peak_rss_mb': round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * rss_unit / 2 ** 20, 1),
+        'peak_traced_mb': round(traced_peak / 2 ** 20, 1),
+    }
+
+
+def _measure(stage, workdir, size, seed):
+    """Run a stage in a fresh process so its timings and peak memory are its own."""
+    env = dict(os.environ, MPLBACKEND='Agg')
+    process = subprocess.run(
+        [sys.executable, os.path.abspath(__file__), '--run-stage', stage, '--workdir', workdir,
+         '--sizes', str(size), '--seed', str(seed)],
+        capture_output=True, text=True, env=env)
+    if process.returncode != 0:
+        return {'error': process.stderr.strip().splitlines()[-1] if process.stderr.strip() else 'failed'}
+    return json.loads(process.stdout.strip().splitlines()[-1])
+
+
+###########################
+# Running the suite
+
+def run_suite(sizes=SIZES, stages=STAGES, seed=0, keep=False):
+    """Run every stage at every size and return {'<size>/<stage>': measurements}."""
+    results = {}
+    for size in sizes:
+        workdir = os.path.join(BENCH_DIR, f'{size}')
+        shutil.rmtree(workdir, ignore_errors=True)
+        os.makedirs(workdir)
+
+        failed = False
+        for stage in STAGES:
+            # the setup stages always run, since the later stages need their results
+            if stage not in stages and stage not in ('generate', 'ingest', 'merge'):
+                continue
+            if failed:
+                results[f'{size}/{stage}'] = {'error': 'skipped, an earlier stage failed'}
+                continue
+            measured = _measure(stage, workdir, size, seed)
+            failed = 'error' in measured and stage in ('generate', 'ingest', 'merge')
+            if stage in stages:
+                results[f'{size}/{stage}'] = measured
+            print(f"{size:>10} {stage:<12} " + (f"error: {measured['error']}" if 'error' in measured else
+                  f"{measured['seconds']:9.2f} s {measured['peak_rss_mb']:9.1f} MB rss "
+                  f"{measured['peak_traced_mb']:9.1f} MB traced"))
+
+        if not keep:
+            shutil.rmtree(workdir, ignore_errors=True)
+    return results
+
+
+def measure_startup(repeats=5):
+    """Median time of `ecsas --help`, in milliseconds."""
+    from ecsas import measure_startup as measure
+    return round(statistics.median(measure(repeats)), 1)
+
+
+def machine():
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'cpus': os.cpu_count(),
+    }
+
+
+###########################
+# Baselines
+
+def load_baselines(path=BASELINES_PATH):
+    if not os.path.exists(path):
+        return None
+    with open(path) as baselines_file:
+        return json.load(baselines_file)
+
+
+def save_baselines(results, startup_ms, path=BASELINES_PATH):
+    """Store the results as baselines, keeping earlier baselines for sizes or stages that weren't run this time."""
+    baselines = load_baselines(path) or {'results': {}}
+    baselines['machine'] = machine()
+    baselines['saved'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    baselines['startup_ms'] = startup_ms
+    baselines['results'].update({name: values for name, values in results.items() if 'error' not in values})
+    with open(path, 'w') as baselines_file:
+        json.dump(baselines, baselines_file, indent=2, sort_keys=True)
+
+
+def compare(results, startup_ms, baselines, time_tolerance=TIME_TOLERANCE, memory_tolerance=MEMORY_TOLERANCE):
+    """Return a list of regressions: stages that failed, or got slower or bigger than the tolerance allows."""
+    from ecsas import STARTUP_BUDGET_MS
+
+    regressions = []
+    if startup_ms > STARTUP_BUDGET_MS:
+        regressions.append(f"startup: {startup_ms:.0f} ms is over the {STARTUP_BUDGET_MS} ms budget")
+
+    for name, values in results.items():
+        if 'error' in values:
+            regressions.append(f"{name}: {values['error']}")
+            continue
+        baseline = baselines['results'].get(name)
+        if baseline is None:
+            continue
+        if baseline['seconds'] >= MIN_COMPARED_SECONDS and values['seconds'] > baseline['seconds'] * (1 + time_tolerance):
+            regressions.append(f"{name}: {values['seconds']:.2f} s, baseline {baseline['seconds']:.2f} s")
+        for measure in ('peak_rss_mb', 'peak_traced_mb'):
+            if values[measure] > baseline[measure] * (1 + memory_tolerance) and values[measure] - baseline[measure] > 10:
+                regressions.append(f"{name}: {measure} {values[measure]:.1f}, baseline {baseline[measure]:.1f}")
+    return regressions
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time and memory-profile the pipeline stages on synthetic data.')
+    parser.add_argument('--sizes', nargs='+', type=lambda value: int(float(value)), default=SIZES,
+                        help='numbers of sightings to generate (e.g. 1e4 1e5 1e6)')
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=STAGES, help='stages to measure')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--save-baseline', action='store_true', help=f'store the results in {os.path.basename(BASELINES_PATH)}')
+    parser.add_argument('--time-tolerance', type=float, default=TIME_TOLERANCE)
+    parser.add_argument('--memory-tolerance', type=float, default=MEMORY_TOLERANCE)
+    parser.add_argument('--keep', action='store_true', help='keep the working folders in cache/bench')
+    parser.add_argument('--run-stage', help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        # inside a stage process: print the measurements as the last line of output
+        print(json.dumps(run_stage(args.run_stage, args.workdir, args.sizes[0], args.seed)))
+        sys.exit(0)
+
+    results = run_suite(args.sizes, args.stages, args.seed, args.keep)
+    startup_ms = measure_startup()
+    print(f"{'':>10} {'startup':<12} {startup_ms:9.1f} ms")
+
+    if args.save_baseline:
+        save_baselines(results, startup_ms)
+        print(f"Baselines saved to {BASELINES_PATH}")
+        sys.exit(0)
+
+    baselines = load_baselines()
+    if baselines is None:
+        print("No baselines yet, run with --save-baseline to store these results")
+        sys.exit(0)
+
+    regressions = compare(results, startup_ms, baselines, args.time_tolerance, args.memory_tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,411 @@
+#####################################################
+##############   CLUSTER EXECUTION    ###############
+
+"""
+`run-map.py` ran the whole map as one small SLURM job, and made a new virtual environment and pip-installed folium every
+time it was submitted.
+
+Here I split the work over a SLURM job array instead. The watches are divided into shards, either by CruiseID or by
+spatial tile (a grid of `--tile-deg` degree cells), and the shards are spread over the array tasks so every task gets
+about the same number of sightings. Every task computes partial results for its shards:
+
+- `metrics`: counts, sightings and watches per species plus the effort and distance surveyed
+- `density`: counts summed into a lat/lon grid (the same grid for every task, so they can just be added up)
+- `gam`: a GAM of the count per watch over time, fitted for every cruise or tile in the shard
+- `map`: one row per watch with its position and total count
+
+and writes them to the shared cache (`cache/cluster/<shard by>-<tasks>/`). A reduce job, which only starts once every
+array task finished, merges the partial results into the final tables, grid and map.
+
+The jobs use an environment built once with `setup-env.sh`, not a new one per job. Everything reads the memory-mapped
+arrays from survey_arrays.py, so the store has to be built before the array is submitted (`submit` does that).
+
+    python cluster.py submit --tasks 8 --by tile      # on the cluster login node
+    python cluster.py simulate --tasks 4 --by cruise  # locally, runs every array index and then the reduce step
+"""
+
+# load the required modules
+import argparse
+import heapq
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+
+import numpy as np
+import pandas as pd
+
+from store import CACHE_DIR
+from survey_arrays import ARRAYS_DIR, NAT, grid_totals, haversine_km, open_arrays
+
+
+# Define the folder for partial and merged results
+CLUSTER_DIR = os.path.join(CACHE_DIR, 'cluster')
+
+# Ways to shard the watches and the jobs every array task runs
+SHARD_BY = ('cruise', 'tile')
+JOBS = ('metrics', 'density', 'gam', 'map')
+
+# Defaults for the tile size and the density grid cells (degrees)
+TILE_DEG = 0.5
+CELL_DEG = 0.1
+
+# Watches without coordinates all go to this tile
+NO_TILE = -1
+
+# The batch scripts for the array tasks and the reduce job
+SHARD_SCRIPT = 'run-shards.sh'
+REDUCE_SCRIPT = 'run-reduce.sh'
+
+
+###########################
+# Sharding
+
+def watch_keys(arrays, by='cruise', tile_deg=TILE_DEG):
+    """Return the shard key of every watch: its CruiseID, or a number identifying its tile."""
+    if by == 'cruise':
+        return np.asarray(arrays.cruise_id, dtype=np.int64)
+    if by == 'tile':
+        lat, lon = np.asarray(arrays.lat_start), np.asarray(arrays.lon_start)
+        located = np.isfinite(lat) & np.isfinite(lon)
+        keys = np.full(len(lat), NO_TILE, dtype=np.int64)
+        # tile rows and columns counted from the south pole and the antimeridian, so the keys are never negative
+        rows = np.floor((lat[located] + 90) / tile_deg).astype(np.int64)
+        cols = np.floor((lon[located] + 180) / tile_deg).astype(np.int64)
+        keys[located] = rows * int(np.ceil(360 / tile_deg)) + cols
+        return keys
+    raise ValueError(f"Unknown shard key {by!r}, choose from {', '.join(SHARD_BY)}")
+
+
+def assign(keys, weights, n_tasks):
+    """
+    Spread shard keys over `n_tasks` array tasks, biggest shard first to the least loaded task.
+
+    The result only depends on the keys and weights, so every array task works out the same assignment on its own.
+    Returns {key: task index}.
+    """
+    order = sorted(zip(keys, weights), key=lambda item: (-item[1], item[0]))
+    loads = [(0, task) for task in range(n_tasks)]
+    assignment = {}
+    for key, weight in order:
+        load, task = heapq.heappop(loads)
+        assignment[key] = task
+        heapq.heappush(loads, (load + weight, task))
+    return assignment
+
+
+def shard_mask(arrays, task, n_tasks, by='cruise', tile_deg=TILE_DEG):
+    """Return a boolean mask of the watches handled by array task `task` and the shard key of every watch."""
+    keys = watch_keys(arrays, by, tile_deg)
+    unique_keys, watch_key_index = np.unique(keys, return_inverse=True)
+
+    # shards are weighted by their sightings (plus one per watch, so watches without sightings still count)
+    sightings = np.bincount(arrays.watch_row[arrays.watch_row >= 0], minlength=arrays.n_watches)
+    weights = np.bincount(watch_key_index, weights=sightings + 1, minlength=len(unique_keys))
+
+    assignment = assign(unique_keys.tolist(), weights.tolist(), n_tasks)
+    tasks = np.array([assignment[key] for key in unique_keys.tolist()], dtype=np.int64)
+    return tasks[watch_key_index] == task, keys
+
+
+###########################
+# Partial results
+
+def _sighting_mask(arrays, watch_mask):
+    """Mask of the sightings that belong to the watches in `watch_mask`."""
+    rows = np.asarray(arrays.watch_row)
+    return (rows >= 0) & watch_mask[np.maximum(rows, 0)]
+
+
+def partial_metrics(arrays, watch_mask, keys):
+    """Per-species counts, sightings and watches, plus the effort, distance and number of watches surveyed."""
+    sighting_mask = _sighting_mask(arrays, watch_mask)
+    codes = np.asarray(arrays.species_code)[sighting_mask]
+    counts = np.asarray(arrays.count, dtype=np.float64)[sighting_mask]
+    rows = np.asarray(arrays.watch_row)[sighting_mask]
+
+    n_species = len(arrays.species) + 1
+    # unknown species (code -1) are counted in the last slot
+    codes = np.where(codes >= 0, codes, n_species - 1)
+    species = pd.DataFrame({
+        'Count': np.bincount(codes, weights=counts, minlength=n_species),
+        'Sightings': np.bincount(codes, minlength=n_species),
+        # shards never share a watch, so the watches per species can be added up over the shards
+        'Watches': np.bincount(np.unique(codes.astype(np.int64) * arrays.n_watches + rows) // arrays.n_watches,
+                               minlength=n_species),
+    }, index=pd.Index(list(arrays.species) + ['UNKNOWN'], name='Alpha'))
+
+    distance = haversine_km(arrays.lat_start[watch_mask], arrays.lon_start[watch_mask],
+                            arrays.lat_end[watch_mask], arrays.lon_end[watch_mask])
+    effort = {
+        'Watches': int(watch_mask.sum()),
+        'EffortMinutes': float(np.nansum(arrays.effort_min[watch_mask])),
+        'DistanceKm': float(np.nansum(distance)),
+    }
+    return {'species': species[species['Sightings'] > 0], 'effort': effort}
+
+
+def partial_density(arrays, watch_mask, keys, cell_deg=CELL_DEG):
+    """Counts summed into a lat/lon grid with bounds covering every watch, so all tasks use the same grid."""
+    lat, lon = np.asarray(arrays.lat_start), np.asarray(arrays.lon_start)
+    located = np.isfinite(lat) & np.isfinite(lon)
+    if not located.any():
+        return {'grid': np.zeros((0, 0)), 'corner': (np.nan, np.nan), 'cell_deg': cell_deg}
+    bounds = (lat[located].min(), lon[located].min(), lat[located].max(), lon[located].max())
+
+    sighting_mask = _sighting_mask(arrays, watch_mask)
+    rows = np.asarray(arrays.watch_row)[sighting_mask]
+    grid, corner = grid_totals(lat[rows], lon[rows], np.asarray(arrays.count)[sighting_mask], cell_deg, bounds)
+    return {'grid': grid, 'corner': corner, 'cell_deg': cell_deg}
+
+
+def _watch_totals(arrays, watch_mask):
+    """Total count of every watch in `watch_mask`."""
+    return arrays.watch_totals()[watch_mask]
+
+
+def partial_gam(arrays, watch_mask, keys, n_points=50):
+    """
+    Fit a GAM of the count per watch over the hours since the first watch, separately for every shard key.
+
+    Returns the predictions with 95% prediction intervals; keys with fewer than five timed watches are skipped.
+    """
+    from pygam import LinearGAM, s
+
+    start_ns = np.asarray(arrays.start_ns)[watch_mask]
+    totals = _watch_totals(arrays, watch_mask)
+    shard_keys = keys[watch_mask]
+
+    curves = []
+    for key in np.unique(shard_keys):
+        timed = (shard_keys == key) & (start_ns != NAT)
+        if np.count_nonzero(timed) < 5:
+            continue
+        hours = (start_ns[timed] - start_ns[timed].min()) / 3.6e12
+        if np.unique(hours).size < 5:
+            continue
+        gam = LinearGAM(s(0, n_splines=min(10, np.unique(hours).size - 1))).fit(hours.reshape(-1, 1), totals[timed])
+        grid = np.linspace(hours.min(), hours.max(), n_points).reshape(-1, 1)
+        intervals = gam.prediction_intervals(grid, width=0.95)
+        curves.append(pd.DataFrame({
+            'Shard': key,
+            'Hours': grid.ravel(),
+            'Prediction': gam.predict(grid),
+            'Lower': intervals[:, 0],
+            'Upper': intervals[:, 1],
+            'Watches': np.count_nonzero(timed),
+        }))
+    if not curves:
+        return pd.DataFrame(columns=['Shard', 'Hours', 'Prediction', 'Lower', 'Upper', 'Watches'])
+    return pd.concat(curves, ignore_index=True)
+
+
+def partial_map(arrays, watch_mask, keys):
+    """One row per watch in the shard with its position and total count, for the map layer."""
+    return pd.DataFrame({
+        'WatchID': np.asarray(arrays.watch_id)[watch_mask],
+        'CruiseID': np.asarray(arrays.cruise_id)[watch_mask],
+        'Shard': keys[watch_mask],
+        'LatStart': np.asarray(arrays.lat_start)[watch_mask],
+        'LongStart': np.asarray(arrays.lon_start)[watch_mask],
+        'PlatformClass': np.asarray(arrays.platform_class)[watch_mask],
+        'TotalCount': _watch_totals(arrays, watch_mask),
+    })
+
+
+PARTIALS = {
+    'metrics': partial_metrics,
+    'density': partial_density,
+    'gam': partial_gam,
+    'map': partial_map,
+}
+
+
+###########################
+# Running array tasks
+
+def run_dir(by, n_tasks, root=CLUSTER_DIR):
+    """Folder for the partial and merged results of one sharding."""
+    return os.path.join(root, f'{by}-{n_tasks}')
+
+
+def _part_path(directory, job, task):
+    return os.path.join(directory, job, f'part-{task:04d}.pkl')
+
+
+def _write_pickle(path, value):
+    """Write to a temporary file and rename it, so the reduce job never reads a half-written part."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    handle, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+    with os.fdopen(handle, 'wb') as target:
+        pickle.dump(value, target, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def run_task(task, n_tasks, by='cruise', jobs=JOBS, tile_deg=TILE_DEG, arrays_dir=ARRAYS_DIR, root=CLUSTER_DIR):
+    """Compute and write the partial results of one array task."""
+    if not 0 <= task < n_tasks:
+        raise ValueError(f"Task {task} is outside the array 0-{n_tasks - 1}")
+    arrays = open_arrays(arrays_dir)
+    watch_mask, keys = shard_mask(arrays, task, n_tasks, by, tile_deg)
+    directory = run_dir(by, n_tasks, root)
+
+    for job in jobs:
+        _write_pickle(_part_path(directory, job, task), PARTIALS[job](arrays, watch_mask, keys))
+    print(f"task {task}/{n_tasks}: {int(watch_mask.sum())} watches, wrote {', '.join(jobs)}")
+
+
+###########################
+# Reducing
+
+def _load_parts(directory, job, n_tasks):
+    missing = [task for task in range(n_tasks) if not os.path.exists(_part_path(directory, job, task))]
+    if missing:
+        raise FileNotFoundError(f"{job}: no partial results from array tasks {missing} in {directory}")
+    parts = []
+    for task in range(n_tasks):
+        with open(_part_path(directory, job, task), 'rb') as part:
+            parts.append(pickle.load(part))
+    return parts
+
+
+def reduce_metrics(parts):
+    species = pd.concat([part['species'] for part in parts]).groupby(level='Alpha').sum()
+    species = species.sort_values('Count', ascending=False)
+    effort = {name: sum(part['effort'][name] for part in parts) for name in parts[0]['effort']}
+    return {'species': species, 'effort': effort}
+
+
+def reduce_density(parts):
+    return {'grid': sum(part['grid'] for part in parts), 'corner': parts[0]['corner'], 'cell_deg': parts[0]['cell_deg']}
+
+
+def reduce_gam(parts):
+    return pd.concat(parts, ignore_index=True).sort_values(['Shard', 'Hours'], ignore_index=True)
+
+
+def reduce_map(parts):
+    return pd.concat(parts, ignore_index=True).sort_values('WatchID', ignore_index=True)
+
+
+REDUCERS = {
+    'metrics': reduce_metrics,
+    'density': reduce_density,
+    'gam': reduce_gam,
+    'map': reduce_map,
+}
+
+
+def render_map(watches, path):
+    """Draw the merged watches on a folium map, with a layer per cruise."""
+    import folium
+
+    located = watches.dropna(subset=['LatStart', 'LongStart'])
+    if located.empty:
+        return
+    survey_map = folium.Map(location=[located['LatStart'].mean(), located['LongStart'].mean()], zoom_start=7)
+    scale = max(located['TotalCount'].max(), 1)
+    for cruise_id, cruise in located.groupby('CruiseID'):
+        layer = folium.FeatureGroup(name=f'Cruise {cruise_id}')
+        for watch in cruise.itertuples():
+            folium.CircleMarker(
+                location=[watch.LatStart, watch.LongStart],
+                radius=3 + 12 * watch.TotalCount / scale,
+                popup=f'WatchID: {watch.WatchID}<br>Total count: {watch.TotalCount:g}',
+                fill=True,
+            ).add_to(layer)
+        layer.add_to(survey_map)
+    folium.LayerControl().add_to(survey_map)
+    survey_map.save(path)
+
+
+def run_reduce(n_tasks, by='cruise', jobs=JOBS, root=CLUSTER_DIR):
+    """Merge the partial results of every array task and write the final outputs next to them."""
+    directory = run_dir(by, n_tasks, root)
+    merged = {job: REDUCERS[job](_load_parts(directory, job, n_tasks)) for job in jobs}
+
+    if 'metrics' in merged:
+        merged['metrics']['species'].to_csv(os.path.join(directory, 'species_metrics.csv'))
+        pd.Series(merged['metrics']['effort']).to_csv(os.path.join(directory, 'effort.csv'), header=['Value'])
+    if 'density' in merged:
+        density = merged['density']
+        np.savez(os.path.join(directory, 'density.npz'), grid=density['grid'], corner=density['corner'],
+                 cell_deg=density['cell_deg'])
+    if 'gam' in merged:
+        merged['gam'].to_csv(os.path.join(directory, 'gam_curves.csv'), index=False)
+    if 'map' in merged:
+        merged['map'].to_parquet(os.path.join(directory, 'watches.parquet'), index=False)
+        render_map(merged['map'], os.path.join(directory, 'survey_map.html'))
+
+    print(f"merged {n_tasks} tasks into {directory}")
+    return merged
+
+
+###########################
+# Submitting and simulating
+
+def _prepare():
+    """Build the store and arrays once, before any array task runs, so the tasks never build them at the same time."""
+    from store import load_store
+    load_store()
+
+
+def _common_args(args):
+    return ['--tasks', str(args.tasks), '--by', args.by, '--tile-deg', str(args.tile_deg), '--jobs', ','.join(args.jobs)]
+
+
+def submit(args):
+    """Submit the array and a reduce job that only starts once every array task succeeded."""
+    _prepare()
+    array = subprocess.run(['sbatch', '--parsable', f'--array=0-{args.tasks - 1}', SHARD_SCRIPT] + _common_args(args),
+                           check=True, capture_output=True, text=True).stdout.strip().split(';')[0]
+    reduce = subprocess.run(['sbatch', '--parsable', f'--dependency=afterok:{array}', REDUCE_SCRIPT]
+                            + _common_args(args), check=True, capture_output=True, text=True).stdout.strip()
+    print(f"submitted array job {array} ({args.tasks} tasks) and reduce job {reduce}")
+
+
+def simulate(args):
+    """Run every array index one after the other, the way SLURM would set them, then the reduce step."""
+    _prepare()
+    for task in range(args.tasks):
+        env = dict(os.environ, SLURM_ARRAY_TASK_ID=str(task), SLURM_ARRAY_TASK_COUNT=str(args.tasks))
+        subprocess.run([sys.executable, os.path.abspath(__file__), 'shard'] + _common_args(args), check=True, env=env)
+    run_reduce(args.tasks, args.by, args.jobs)
+
+
+def _task_index(args):
+    """The array index from --task, or from SLURM inside an array job."""
+    if args.task is not None:
+        return args.task
+    if 'SLURM_ARRAY_TASK_ID' not in os.environ:
+        raise SystemExit("No array index: pass --task or run inside a SLURM array job")
+    return int(os.environ['SLURM_ARRAY_TASK_ID'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the ECSAS analyses as a sharded SLURM job array.')
+    parser.add_argument('command', choices=['shard', 'reduce', 'simulate', 'submit'])
+    parser.add_argument('--task', type=int, default=None, help='array index (default: $SLURM_ARRAY_TASK_ID)')
+    parser.add_argument('--tasks', type=int, default=None,
+                        help='number of array tasks (default: $SLURM_ARRAY_TASK_COUNT, or 4)')
+    parser.add_argument('--by', choices=SHARD_BY, default='cruise', help='shard watches by cruise or by spatial tile')
+    parser.add_argument('--tile-deg', type=float, default=TILE_DEG, help='tile size in degrees when sharding by tile')
+    parser.add_argument('--jobs', type=lambda value: value.split(','), default=list(JOBS),
+                        help=f"comma separated jobs to run (default: {','.join(JOBS)})")
+    args = parser.parse_args()
+
+    if args.tasks is None:
+        args.tasks = int(os.environ.get('SLURM_ARRAY_TASK_COUNT', 4))
+    unknown = set(args.jobs) - set(JOBS)
+    if unknown:
+        parser.error(f"unknown jobs {', '.join(sorted(unknown))}, choose from {', '.join(JOBS)}")
+
+    if args.command == 'shard':
+        run_task(_task_index(args), args.tasks, args.by, args.jobs, args.tile_deg)
+    elif args.command == 'reduce':
+        run_reduce(args.tasks, args.by, args.jobs)
+    elif args.command == 'simulate':
+        simulate(args)
+    else:
+        submit(args)
@@ -0,0 +1,187 @@
+#####################################################
+##############   ECSAS COMMAND LINE    ##############
+
+"""
+Every script imports plotly, folium, pygam, sklearn, seaborn and matplotlib at the top whether the task needs them or
+not. On cluster jobs that start cold from a network filesystem, those imports take up a large part of a short run.
+
+Here I put every task behind one command, `ecsas`, with a subcommand per task:
+
+    ecsas ingest        build the relational store and the merged survey data
+    ecsas metrics       basic metrics and species richness      (pandas, matplotlib, seaborn, scipy)
+    ecsas map           interactive map                         (folium, geopy)
+    ecsas heatmaps      heatmaps of the survey conditions       (matplotlib, seaborn)
+    ecsas pies          pie charts of the species counts        (plotly)
+    ecsas gam           GAM scatter plot                        (plotly, pygam)
+    ecsas visibility    visibility regression                   (matplotlib, seaborn, sklearn)
+    ecsas figures       per-cruise and per-species figures      (matplotlib, seaborn, plotly)
+    ecsas all           everything
+    ecsas update        add new watches to the metrics and map  (pandas, folium)
+    ecsas notes QUERY   search the watch, sighting and cruise notes   (pandas)
+    ecsas serve         local HTTP service for summaries and map tiles (pandas, matplotlib)
+
+This module only imports the standard library, and a subcommand imports the pipeline (and through it pandas and the
+plotting libraries) only once it runs, so `ecsas --help` or a typo never waits for them. `ecsas startup` measures
+how long `ecsas --help` takes and fails if it's over the startup budget (STARTUP_BUDGET_MS).
+"""
+
+# load the required modules (standard library only, anything heavier is imported inside the subcommands)
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+
+# Time allowed for `ecsas --help`, in milliseconds
+STARTUP_BUDGET_MS = 200
+
+# Modules that must not be imported just to parse the command line
+HEAVY_MODULES = ('numpy', 'pandas', 'pyarrow', 'scipy', 'matplotlib', 'seaborn', 'plotly', 'folium', 'pygam', 'sklearn')
+
+# Subcommands and the pipeline stages they run (their dependencies are run too when they're out of date)
+COMMANDS = {
+    'ingest': (['ingest', 'merge'], 'build the relational store and the merged survey data'),
+    'metrics': (['metrics'], 'basic metrics and species richness estimates'),
+    'map': (['map'], 'interactive map of the survey'),
+    'heatmaps': (['heatmaps'], 'heatmaps of the survey conditions'),
+    'pies': (['pies'], 'pie charts of the species counts'),
+    'gam': (['gam'], 'GAM scatter plot of the species counts over the survey'),
+    'visibility': (['visibility'], 'regression of the counts on visibility'),
+    'figures': (['figures'], 'per-cruise and per-species figures, rendered in parallel'),
+    'all': (None, 'run every stage'),
+}
+
+
+###########################
+# Subcommands
+
+def run_stages(args):
+    """Run the pipeline stages of a subcommand; this is where pandas and the plotting libraries get imported."""
+    from pipeline import run
+
+    stages, _ = COMMANDS[args.command]
+    status = run(stages, force=args.force, max_workers=args.workers, trace_memory=args.trace_memory,
+                 profile=args.profile)
+    failed = [name for name, result in status.items() if result in ('failed', 'skipped')]
+    if failed:
+        print(f"failed: {', '.join(failed)}", file=sys.stderr)
+        return 1
+    return 0
+
+
+def run_update(args):
+    """Add the watches that are new since the last update (see incremental.py)."""
+    from incremental import load_state, report, update
+
+    update(rebuild=args.rebuild)
+    print(report(load_state()[1]))
+    return 0
+
+
+def search_notes(args):
+    """Search the notes index (see notes_index.py) and print the matching notes or ids."""
+    import pandas as pd
+    from notes_index import load_index
+    from store import load_store
+
+    index = load_index()
+    if args.key:
+        print('\n'.join(str(value) for value in index.ids(args.query, args.key)))
+    else:
+        with pd.option_context('display.max_colwidth', 120, 'display.width', 200):
+            print(index.results(index.search(args.query), load_store()).to_string(index=False))
+    return 0
+
+
+def run_service(args):
+    """Serve summaries, crosstabs, densities and map tiles over HTTP (see query_service.py)."""
+    import asyncio
+    from query_service import QueryService
+
+    try:
+        asyncio.run(QueryService(workers=args.workers).serve(args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+def measure_startup(repeats=5):
+    """Run `ecsas --help` in fresh interpreters and return the time each run took, in milliseconds."""
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, os.path.abspath(__file__), '--help'], check=True, stdout=subprocess.DEVNULL)
+        times.append((time.perf_counter() - start) * 1000)
+    return times
+
+
+def heavy_imports():
+    """Return the heavy modules that get imported just by loading this module (there should be none)."""
+    code = (f"import sys; sys.path.insert(0, {os.path.dirname(os.path.abspath(__file__))!r}); import ecsas; "
+            f"print(','.join(name for name in {HEAVY_MODULES!r} if name in sys.modules))")
+    output = subprocess.run([sys.executable, '-c', code], check=True, capture_output=True, text=True).stdout.strip()
+    return [name for name in output.split(',') if name]
+
+
+def check_startup(args):
+    """Measure `ecsas --help` against the startup budget."""
+    times = measure_startup(args.repeats)
+    median = statistics.median(times)
+    heavy = heavy_imports()
+    print(f"ecsas --help: median {median:.0f} ms over {args.repeats} runs (min {min(times):.0f} ms), "
+          f"budget {args.budget_ms} ms")
+    if heavy:
+        print(f"heavy modules imported at startup: {', '.join(heavy)}")
+    return 0 if median <= args.budget_ms and not heavy else 1
+
+
+###########################
+# Command line
+
+def build_parser():
+    parser = argparse.ArgumentParser(prog='ecsas', description='ECSAS seabird survey analysis.')
+    subcommands = parser.add_subparsers(dest='command', metavar='command', required=True)
+
+    for name, (_, description) in COMMANDS.items():
+        subcommand = subcommands.add_parser(name, help=description, description=description)
+        subcommand.add_argument('--force', action='store_true', help='re-run even if nothing changed')
+        subcommand.add_argument('--workers', type=int, default=None, help='number of worker processes')
+        subcommand.add_argument('--trace-memory', action='store_true', help='record tracemalloc peaks (slower)')
+        subcommand.add_argument('--profile', action='store_true', help='keep a cProfile dump of the hottest stage')
+        subcommand.set_defaults(handler=run_stages)
+
+    update = subcommands.add_parser('update', help='add new watches to the running metrics and the map',
+                                    description='add new watches to the running metrics and the map')
+    update.add_argument('--rebuild', action='store_true', help='recompute everything from the whole survey')
+    update.set_defaults(handler=run_update)
+
+    notes = subcommands.add_parser('notes', help='search the watch, sighting and cruise notes',
+                                   description='search the watch, sighting and cruise notes')
+    notes.add_argument('query', help='words, "phrases", prefix* and -excluded words, alternatives joined with OR')
+    notes.add_argument('--key', choices=['WatchID', 'SightingID', 'CruiseID'], default=None,
+                       help='only print the unique ids of this kind')
+    notes.set_defaults(handler=search_notes)
+
+    serve = subcommands.add_parser('serve', help='serve summaries, crosstabs, densities and map tiles over HTTP',
+                                   description='serve summaries, crosstabs, densities and map tiles over HTTP')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=8765)
+    serve.add_argument('--workers', type=int, default=4, help='threads computing responses')
+    serve.set_defaults(handler=run_service)
+
+    startup = subcommands.add_parser('startup', help='check the startup time against its budget')
+    startup.add_argument('--budget-ms', type=float, default=STARTUP_BUDGET_MS, help='allowed time for `ecsas --help`')
+    startup.add_argument('--repeats', type=int, default=5, help='number of runs to take the median of')
+    startup.set_defaults(handler=check_startup)
+    return parser
+
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    return args.handler(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -10,44 +10,45 @@ import pandas as pd
 import numpy as np
 import matplotlib.pyplot as plt
 import seaborn as sns
+from lookups import load_lookups
+from lazy_query import scan
+from store import load_store
+from pipeline import load_input
+from instrumentation import stage
 
 # Define file paths using raw string literals
 stationary_survey_path = r'data/stationary_platform_data.xlsx'
 
 # Load the stationary survey data
-stationary_survey = pd.read_excel(stationary_survey_path)
+stationary_survey = load_input('stationary_survey', stationary_survey_path)
 
-# load the metadata files for weather, sea state, and glare
-sea_state = pd.read_excel('ECSAS_tables\\lkpSeaState.xlsx')
-weather = pd.read_excel('ECSAS_tables\\lkpWeather.xlsx')
+# load the compiled lookup tables for weather and sea state
+lookups = load_lookups()
+weather = lookups['lkpWeather']
+sea_state = lookups['lkpSeaState']
 
 # find the most common Weather and SeaState codes for each species
 most_common_weather = stationary_survey.groupby('Alpha')['Weather'].agg(lambda x: x.mode()[0] if not x.mode().empty else np.nan).reset_index()
 most_common_sea_state = stationary_survey.groupby('Alpha')['SeaState'].agg(lambda x: x.mode()[0] if not x.mode().empty else np.nan).reset_index()
 
-# merge with metadata to get descriptive labels
-most_common_weather = most_common_weather.merge(weather, left_on='Weather', right_on='Weather', how='left')
-most_common_sea_state = most_common_sea_state.merge(sea_state, left_on='SeaState', right_on='SeaState', how='left')
+# decode the codes into their descriptive labels with the lookup tables
+most_common_weather['WeatherText'] = weather.decode(most_common_weather['Weather'], 'WeatherText')
+most_common_sea_state['SeaStateText'] = sea_state.decode(most_common_sea_state['SeaState'], 'SeaStateText')
 
-# create full pivot tables with all possible codes as indices and columns
-weather_codes = weather['Weather'].unique()
-sea_state_codes = sea_state['SeaState'].unique()
-
-# create empty dataframes with all possible codes as indices and columns
+# create full pivot tables with all possible codes as columns
 # this way all of the codes will display on the plot, not only ones used during the survey
-pivot_weather = pd.DataFrame(index=most_common_weather['Alpha'].unique(), columns=weather_codes)
-pivot_sea_state = pd.DataFrame(index=most_common_sea_state['Alpha'].unique(), columns=sea_state_codes)
+def code_pivot(most_common, column, table):
+    pivot = np.full((len(most_common), len(table)), np.nan)
 
-# popoulate the pivot tables with the codes
-for _, row in most_common_weather.iterrows():
-    pivot_weather.loc[row['Alpha'], row['Weather']] = row['Weather']
+    # the lookup index gives the column of each species' code directly, codes not in the table are left out
+    col = table.index(most_common[column])
+    row = np.arange(len(most_common))
+    pivot[row[col >= 0], col[col >= 0]] = table.codes[col[col >= 0]]
 
-for _, row in most_common_sea_state.iterrows():
-    pivot_sea_state.loc[row['Alpha'], row['SeaState']] = row['SeaState']
+    return pd.DataFrame(pivot, index=most_common['Alpha'].to_numpy(), columns=table.codes)
 
-# replace non-numeric values with NaN for heatmap compatibility
-pivot_weather = pivot_weather.apply(pd.to_numeric, errors='coerce')
-pivot_sea_state = pivot_sea_state.apply(pd.to_numeric, errors='coerce')
+pivot_weather = code_pivot(most_common_weather, 'Weather', weather)
+pivot_sea_state = code_pivot(most_common_sea_state, 'SeaState', sea_state)
 
 # plot sizing
 plt.figure(figsize=(18, 6))
@@ -71,18 +72,22 @@ plt.tight_layout()
 
 
 # save the plot as a PNG file
-plt.savefig('figures/heatmaps.png')
+with stage('write'):
+    plt.savefig('figures/heatmaps.png')
 
 
 
-# Filter the data for Alpha = 'GBBG' and SeaState = 10
-filtered_data = stationary_survey[(stationary_survey['Alpha'] == 'GBBG') & (stationary_survey['SeaState'] == 10)]
+# The species counts below are queried lazily from the relational store (see lazy_query.py),
+# so only the Count column of the matching stationary watches is read rather than the whole survey
+load_store()
+stationary_sightings = scan('tblSighting').select('Count').where(platform_class=2)
 
-# Calculate the number of times GBBG was observed
-observation_count = filtered_data.shape[0]
+# Filter the data for Alpha = 'GBBG' and SeaState = 10
+filtered_data = stationary_sightings.where(species='GBBG').filter('SeaState', '==', 10)
 
-# Calculate the total count of GBBG observed
-total_gbbg_count = filtered_data['Count'].sum()
+# Calculate the number of times GBBG was observed, and the total count of GBBG observed
+observation_count = filtered_data.count()
+total_gbbg_count = filtered_data.aggregate(None, Count='sum')['Count'].sum()
 
 # Print the results
 print(f"Number of observations where Alpha is 'GBBG' and Sea State is 10: {observation_count}")
@@ -90,15 +95,13 @@ print(f"Total count of 'GBBG' when Sea State is 10: {total_gbbg_count}")
 
 
 
-# Filter the data for Alpha = 'GBBG' and SeaState = 10
-filtered_data = stationary_survey[(stationary_survey['Alpha'] == 'COMU') & (stationary_survey['SeaState'] == 7)]
-
-# Calculate the number of times GBBG was observed
-observation_count = filtered_data.shape[0]
+# Filter the data for Alpha = 'COMU' and SeaState = 7
+filtered_data = stationary_sightings.where(species='COMU').filter('SeaState', '==', 7)
 
-# Calculate the total count of GBBG observed
-total_gbbg_count = filtered_data['Count'].sum()
+# Calculate the number of times COMU was observed, and the total count of COMU observed
+observation_count = filtered_data.count()
+total_comu_count = filtered_data.aggregate(None, Count='sum')['Count'].sum()
 
 # Print the results
 print(f"Number of observations where Alpha is 'COMU' and Sea State is 7: {observation_count}")
-print(f"Total count of 'COMU' when Sea State is 7: {total_gbbg_count}")
\ No newline at end of file
+print(f"Total count of 'COMU' when Sea State is 7: {total_comu_count}")
\ No newline at end of file
@@ -0,0 +1,218 @@
+#####################################################
+###############   LIGHTWEIGHT HTML    ###############
+
+"""
+`GAM_scatter.py` and `pie-chart.py` wrote their Plotly figures with the whole plotly.js bundle (about 3.5 MB) inlined in
+every file. The scatter plot also drew one SVG point per species and watch and set one x tick per WatchID, so at archive
+scale the files grow to tens of MB and browsers freeze opening them.
+
+Here I write Plotly figures in a lighter form:
+
+- every HTML file references one shared copy of plotly.js in `figures/` (named by the Plotly version) instead of
+  carrying its own
+- figures with more than BIN_THRESHOLD points are binned on a grid: each occupied cell becomes one marker at the mean
+  position of its points, sized by how many points it holds (shown on hover). The grid of every trace is sized so the
+  whole figure keeps at most MAX_MARKERS markers
+- line series with more than LINE_POINTS points are decimated to the minimum and maximum of each bucket, which keeps
+  peaks and dips where plain subsampling would lose them
+- when a figure still has more than WEBGL_THRESHOLD markers they're drawn with `Scattergl` (WebGL) instead of SVG
+- axes with more than MAX_TICKS explicit tick labels keep only evenly spaced ones
+
+Small figures only lose tick labels beyond MAX_TICKS, so the real cruise otherwise looks the same as before.
+"""
+
+# load the required modules
+import os
+
+import numpy as np
+
+
+# Define the folder for the shared plotly.js
+FIGURES_DIR = 'figures'
+
+# Size limits (markers per figure before and after binning, points per line, tick labels per axis)
+BIN_THRESHOLD = 20_000
+MAX_MARKERS = 50_000
+LINE_POINTS = 2_000
+WEBGL_THRESHOLD = 5_000
+MAX_TICKS = 40
+
+# Binning grids are this many times wider than they are tall (the x axis is the long one in these plots)
+BINS_ASPECT = 5
+
+# Marker sizes for binned cells (pixels), from a single point to the fullest cell
+BINNED_SIZES = (4, 14)
+
+
+###########################
+# Shared plotly.js
+
+def plotly_js_path(figures_dir=FIGURES_DIR):
+    """Path of the shared plotly.js; it's named by version so a Plotly upgrade never mixes bundles."""
+    import plotly
+    return os.path.join(figures_dir, f'plotly-{plotly.__version__}.min.js')
+
+
+def ensure_plotly_js(figures_dir=FIGURES_DIR):
+    """Write the shared plotly.js once and return its path."""
+    path = plotly_js_path(figures_dir)
+    if not os.path.exists(path):
+        from plotly.offline import get_plotlyjs
+        os.makedirs(figures_dir, exist_ok=True)
+        tmp_path = f'{path}.tmp{os.getpid()}'
+        with open(tmp_path, 'w', encoding='utf-8') as bundle:
+            bundle.write(get_plotlyjs())
+        os.replace(tmp_path, path)
+    return path
+
+
+###########################
+# Reducing the traces
+
+def grid_for(n_cells, aspect=BINS_ASPECT):
+    """(x, y) numbers of bins of a grid with at most n_cells cells."""
+    y_bins = max(1, int(np.sqrt(n_cells / aspect)))
+    return max(1, n_cells // y_bins), y_bins
+
+
+def bin_points(x, y, bins):
+    """
+    Bin points on a grid of `bins` (x, y) cells. Returns the mean x and y of every occupied cell and how many points
+    fell in it. Points with a missing coordinate are left out.
+    """
+    x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+    keep = np.isfinite(x) & np.isfinite(y)
+    x, y = x[keep], y[keep]
+    if len(x) == 0:
+        return x, y, np.zeros(0, dtype=np.int64)
+
+    def cell_index(values, n):
+        span = values.max() - values.min()
+        if span == 0:
+            return np.zeros(len(values), dtype=np.int64)
+        return np.minimum(((values - values.min()) / span * n).astype(np.int64), n - 1)
+
+    cells = cell_index(x, bins[0]) * bins[1] + cell_index(y, bins[1])
+    occupied, inverse, counts = np.unique(cells, return_inverse=True, return_counts=True)
+    mean_x = np.bincount(inverse, weights=x) / counts
+    mean_y = np.bincount(inverse, weights=y) / counts
+    return mean_x, mean_y, counts
+
+
+def decimate_minmax(x, y, n_points=LINE_POINTS):
+    """Keep the first, minimum, maximum and last point of each of n_points / 4 buckets of a line, in order."""
+    x, y = np.asarray(x), np.asarray(y, dtype=np.float64)
+    if len(x) <= n_points:
+        return x, y
+    n_buckets = max(1, n_points // 4)
+    edges = np.linspace(0, len(x), n_buckets + 1).astype(np.int64)
+    keep = []
+    for start, stop in zip(edges[:-1], edges[1:]):
+        if start == stop:
+            continue
+        bucket = y[start:stop]
+        finite = np.isfinite(bucket)
+        picks = [start, stop - 1]
+        if finite.any():
+            picks += [start + int(np.nanargmin(bucket)), start + int(np.nanargmax(bucket))]
+        keep.extend(sorted(set(picks)))
+    keep = np.asarray(keep)
+    return x[keep], y[keep]
+
+
+def _is_markers(trace):
+    return trace.type in ('scatter', 'scattergl') and 'markers' in (trace.mode or 'markers') and not trace.fill
+
+
+def _is_line(trace):
+    return trace.type in ('scatter', 'scattergl') and (trace.mode or '') == 'lines' and not trace.fill
+
+
+def _bin_trace(trace, bins):
+    """Replace a marker trace's points with one marker per occupied grid cell."""
+    x, y, counts = bin_points(trace.x, trace.y, bins)
+    low, high = BINNED_SIZES
+    sizes = low + (high - low) * np.sqrt(counts / counts.max()) if len(counts) else counts
+    name = trace.name or ''
+    trace.update(x=x, y=y, text=counts, customdata=None, hovertext=None, hovertemplate=(
+        f'{name}<br>x=%{{x:.1f}}<br>y=%{{y:.2f}}<br>%{{text}} points<extra></extra>'))
+    trace.marker.size = sizes
+
+
+def _to_webgl(fig):
+    """Redraw the marker traces of a figure with Scattergl."""
+    import plotly.graph_objects as go
+    traces = []
+    for trace in fig.data:
+        if trace.type == 'scatter' and _is_markers(trace):
+            properties = trace.to_plotly_json()
+            properties.pop('type', None)
+            traces.append(go.Scattergl(**properties))
+        else:
+            traces.append(trace)
+    fig.data = ()
+    fig.add_traces(traces)
+
+
+def thin_ticks(tickvals, ticktext=None, max_ticks=MAX_TICKS):
+    """Keep at most `max_ticks` evenly spaced tick values (and their labels)."""
+    if tickvals is None or len(tickvals) <= max_ticks:
+        return tickvals, ticktext
+    keep = np.unique(np.linspace(0, len(tickvals) - 1, max_ticks).round().astype(np.int64))
+    tickvals = [tickvals[i] for i in keep]
+    if ticktext is not None:
+        ticktext = [ticktext[i] for i in keep]
+    return tickvals, ticktext
+
+
+def lighten(fig, bin_threshold=BIN_THRESHOLD, max_markers=MAX_MARKERS, line_points=LINE_POINTS,
+            webgl_threshold=WEBGL_THRESHOLD, max_ticks=MAX_TICKS):
+    """Bin large point clouds, decimate long lines, switch to WebGL and thin tick labels, in place. Returns the figure."""
+    traces = [trace for trace in fig.data
+              if trace.type in ('scatter', 'scattergl') and trace.x is not None and trace.y is not None]
+    marker_traces = [trace for trace in traces if _is_markers(trace)]
+
+    # share the marker budget between the traces, so a figure with many species stays bounded too
+    if sum(len(trace.x) for trace in marker_traces) > bin_threshold:
+        budget = max(1, max_markers // len(marker_traces))
+        for trace in marker_traces:
+            if len(trace.x) > budget:
+                _bin_trace(trace, grid_for(budget))
+
+    for trace in traces:
+        if _is_line(trace) and len(trace.x) > line_points:
+            x, y = decimate_minmax(trace.x, trace.y, line_points)
+            trace.update(x=x, y=y)
+
+    markers = sum(len(trace.x) for trace in marker_traces)
+
+    if markers > webgl_threshold:
+        _to_webgl(fig)
+
+    for axis in ('xaxis', 'yaxis'):
+        layout_axis = fig.layout[axis]
+        if layout_axis.tickvals is not None and len(layout_axis.tickvals) > max_ticks:
+            tickvals, ticktext = thin_ticks(list(layout_axis.tickvals),
+                                            None if layout_axis.ticktext is None else list(layout_axis.ticktext),
+                                            max_ticks)
+            layout_axis.update(tickvals=tickvals, ticktext=ticktext)
+    return fig
+
+
+###########################
+# Writing
+
+def write_html(fig, path, destination=None, figures_dir=FIGURES_DIR, light=True):
+    """
+    Write a figure as HTML that loads the shared plotly.js, lightening it first (see `lighten`).
+
+    `destination` is where the file ends up if it's written somewhere else first (e.g. by the artifact cache), so the
+    link to plotly.js is relative to the right folder.
+    """
+    if light:
+        lighten(fig)
+    bundle = ensure_plotly_js(figures_dir)
+    folder = os.path.dirname(os.path.abspath(destination or path))
+    src = os.path.relpath(os.path.abspath(bundle), folder).replace(os.sep, '/')
+    fig.write_html(path, include_plotlyjs=src, full_html=True)
+    return path
@@ -0,0 +1,547 @@
+#####################################################
+#############   INCREMENTAL UPDATES    ##############
+
+"""
+At sea new watches come in every day, but `interactive_map.py` and `basic-metrics.py` rebuild everything from the whole
+dataset each time they run.
+
+Here I keep running results instead and only add the watches that are new since the last update:
+
+- the state (`cache/incremental/state.json`) holds the watermark, i.e. the StartTime and WatchID of the last processed
+  watch, and the WatchIDs processed so far (`processed.npy`)
+- the summaries (`summary.pkl`) can be merged: watch, sighting and count totals, effort, per-species counts, sightings
+  and watches, the first and last watch time and the watch furthest from port, all per platform type, plus the counts
+  summed into lat/lon grid cells anchored at 0,0 (so the cells of two updates always line up and just add up)
+- the map (`figures/incremental/survey_map.html`) loads its watches from chunked layer files
+  (`figures/incremental/layers/chunk-0000.js`, ...). An update only rewrites the last, not yet full, chunk and adds new
+  ones; the page itself is small and is rewritten with the new list of chunks and the new colour scale
+
+New watches are found from the watermark: those that started after the last processed watch (or at the same time with
+a bigger WatchID). Only their sightings are read (through the store offsets), so the work of an update grows with the
+new data, not with the whole survey: the observers and notes of the new watches are read from the row groups that hold
+them only. Watches that arrive late (with a StartTime before the watermark) or without a StartTime are caught by
+comparing the number of watches with the number processed, and are then found from the processed WatchIDs instead.
+Removed watches are caught the same way, from the number and the sum of the WatchIDs up to the watermark. If watches
+disappear from the export, or with `--rebuild`, everything is recomputed.
+
+The tables are still loaded into the relational store as usual, so `update` reads the memory-mapped arrays and store
+offsets just like the other analyses. That part is not incremental: when the export changes, store.py reads and sorts
+the whole export again before an update, so that step still grows with all the data.
+
+    python incremental.py update            # add the new watches
+    python incremental.py update --rebuild  # start again from the whole survey
+    python incremental.py report            # print the metrics table from the running summaries
+"""
+
+# load the required modules
+import argparse
+import json
+import os
+import pickle
+import time
+
+import numpy as np
+import pandas as pd
+
+from store import CACHE_DIR
+from survey_arrays import ARRAYS_DIR, NAT, haversine_km, open_arrays
+
+
+# Define the folders for the state and the outputs
+INCREMENTAL_DIR = os.path.join(CACHE_DIR, 'incremental')
+OUTPUT_DIR = os.path.join('figures', 'incremental')
+
+# Platform types reported separately (PlatformClass codes, as in preprocessing.py)
+PLATFORMS = {'stationary': 2, 'moving': 3}
+
+# Watches per map layer file and the size of the density grid cells (degrees)
+CHUNK_WATCHES = 5_000
+CELL_DEG = 0.1
+
+# Port the distance offshore is measured from (St. John's, as in basic-metrics.py)
+PORT = (47.569575, -52.698024)
+
+
+###########################
+# State
+
+def _state_path(directory):
+    return os.path.join(directory, 'state.json')
+
+
+def new_state():
+    return {
+        'watermark_ns': None,
+        'watermark_watch_id': None,
+        'watches': 0,
+        'watch_id_sum': 0,
+        'sightings': 0,
+        'chunks': [],
+        'max_total_birds': 0,
+        'cell_deg': CELL_DEG,
+        'updated': None,
+    }
+
+
+def load_state(directory=INCREMENTAL_DIR):
+    """Return the state, running summaries and processed WatchIDs of the last update (empty ones before the first)."""
+    if not os.path.exists(_state_path(directory)):
+        return new_state(), empty_summary(), np.zeros(0, dtype=np.int64)
+    with open(_state_path(directory)) as state_file:
+        state = json.load(state_file)
+    with open(os.path.join(directory, 'summary.pkl'), 'rb') as summary_file:
+        summary = pickle.load(summary_file)
+    processed = np.load(os.path.join(directory, 'processed.npy'))
+    return state, summary, processed
+
+
+def save_state(state, summary, processed, directory=INCREMENTAL_DIR):
+    """Write the state last, so an update that stops half way is simply redone from the previous state."""
+    os.makedirs(directory, exist_ok=True)
+    np.save(os.path.join(directory, 'processed.npy'), processed)
+    with open(os.path.join(directory, 'summary.pkl'), 'wb') as summary_file:
+        pickle.dump(summary, summary_file, protocol=pickle.HIGHEST_PROTOCOL)
+    tmp_path = _state_path(directory) + '.tmp'
+    with open(tmp_path, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+    os.replace(tmp_path, _state_path(directory))
+
+
+def _after_watermark(arrays, state):
+    """Flag the watches that started after the last processed one (untimed watches never do)."""
+    if state['watermark_ns'] is None:
+        return np.ones(arrays.n_watches, dtype=bool)
+    watch_ids = np.asarray(arrays.watch_id)
+    start_ns = np.asarray(arrays.start_ns)
+    watermark, watermark_id = state['watermark_ns'], state['watermark_watch_id']
+    return (start_ns > watermark) | ((start_ns == watermark) & (watch_ids > watermark_id))
+
+
+def watches_removed(arrays, state, processed):
+    """
+    Return True if processed watches are missing from the export.
+
+    Every processed watch is at or before the watermark, so without removals or late watches the watches up to the
+    watermark are exactly the processed ones: same number and same sum of WatchIDs. Only when late watches came in is
+    every processed WatchID looked up.
+    """
+    if len(processed) == 0:
+        return False
+    before = ~_after_watermark(arrays, state)
+    n_before = int(before.sum())
+    if n_before < len(processed):
+        return True
+    if n_before == len(processed) and state.get('watch_id_sum') is not None:
+        return int(np.asarray(arrays.watch_id)[before].sum(dtype=np.int64)) != state['watch_id_sum']
+    return not np.isin(processed, np.asarray(arrays.watch_id)).all()
+
+
+def new_watch_rows(arrays, state, processed):
+    """
+    Return the rows of the watches that haven't been processed yet.
+
+    The watermark finds the watches that started after the last processed one. When that doesn't add up to the number
+    of unprocessed watches (late or untimed watches), they are found by their WatchIDs instead.
+    """
+    rows = np.flatnonzero(_after_watermark(arrays, state))
+    if len(rows) != arrays.n_watches - len(processed):
+        rows = np.flatnonzero(~np.isin(np.asarray(arrays.watch_id), processed))
+    return rows
+
+
+def advance_watermark(state, arrays, rows):
+    """Move the watermark to the latest of the new watches."""
+    start_ns = np.asarray(arrays.start_ns)[rows]
+    timed = start_ns != NAT
+    if not timed.any():
+        return
+    # the latest start time, and the biggest WatchID among the watches that started then
+    latest = start_ns[timed].max()
+    latest_id = int(np.asarray(arrays.watch_id)[rows][timed & (start_ns == latest)].max())
+    if state['watermark_ns'] is None or (latest, latest_id) > (state['watermark_ns'], state['watermark_watch_id']):
+        state['watermark_ns'], state['watermark_watch_id'] = int(latest), latest_id
+
+
+###########################
+# Mergeable summaries
+
+def _empty_platform():
+    return {
+        'watches': 0,
+        'sightings': 0,
+        'count': 0.0,
+        'effort_min': 0.0,
+        'species': pd.DataFrame({'Count': [], 'Sightings': [], 'Watches': []}, index=pd.Index([], name='Alpha')),
+        'first_ns': None,
+        'last_ns': None,
+        'furthest': None,
+    }
+
+
+def _empty_grid():
+    return pd.Series(dtype=np.float64, index=pd.MultiIndex.from_arrays([[], []], names=['Row', 'Col']))
+
+
+def empty_summary(cell_deg=CELL_DEG):
+    return {
+        'platforms': {name: _empty_platform() for name in PLATFORMS},
+        'grid': _empty_grid(),
+        'cell_deg': cell_deg,
+    }
+
+
+def _block_rows(offsets, rows):
+    """The child rows of the parent `rows`, from an offsets array (children of i are offsets[i]:offsets[i + 1])."""
+    starts, stops = offsets[rows], offsets[rows + 1]
+    lengths = stops - starts
+    if lengths.sum() == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    # position of every child inside its block, added to the start of the block
+    parents = np.repeat(np.arange(len(rows)), lengths)
+    within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    return starts[parents] + within, parents
+
+
+def _grid_cells(lat, lon, counts, cell_deg):
+    """Counts summed per grid cell, keyed by (row, column) from 0,0, so cells from different updates line up."""
+    located = np.isfinite(lat) & np.isfinite(lon)
+    if not located.any():
+        return _empty_grid()
+    cells = pd.MultiIndex.from_arrays([np.floor(lat[located] / cell_deg).astype(np.int64),
+                                       np.floor(lon[located] / cell_deg).astype(np.int64)], names=['Row', 'Col'])
+    return pd.Series(counts[located], index=cells).groupby(level=['Row', 'Col']).sum()
+
+
+def summarize(arrays, watch_sighting, rows, cell_deg=CELL_DEG):
+    """Summaries of the watches in `rows` and their sightings, in the same form as `empty_summary`."""
+    sighting_rows, parents = _block_rows(watch_sighting, rows)
+    codes = np.asarray(arrays.species_code)[sighting_rows]
+    counts = np.asarray(arrays.count, dtype=np.float64)[sighting_rows]
+    species_names = np.append(np.asarray(arrays.species, dtype=object), 'UNKNOWN')
+    codes = np.where(codes >= 0, codes, len(species_names) - 1)
+
+    lat, lon = np.asarray(arrays.lat_start)[rows], np.asarray(arrays.lon_start)[rows]
+    start_ns = np.asarray(arrays.start_ns)[rows]
+    platform_class = np.asarray(arrays.platform_class)[rows]
+    distance = haversine_km(PORT[0], PORT[1], lat, lon)
+
+    summary = empty_summary(cell_deg)
+    for name, code in PLATFORMS.items():
+        watches = platform_class == code
+        if not watches.any():
+            continue
+        sightings = watches[parents]
+        frame = pd.DataFrame({'Alpha': species_names[codes[sightings]], 'Count': counts[sightings],
+                              'Watch': parents[sightings]})
+        species = frame.groupby('Alpha').agg(Count=('Count', 'sum'), Sightings=('Count', 'size'),
+                                             Watches=('Watch', 'nunique'))
+
+        timed = start_ns[watches][start_ns[watches] != NAT]
+        located = np.flatnonzero(watches & np.isfinite(distance))
+        furthest = None
+        if len(located):
+            row = located[np.argmax(distance[located])]
+            furthest = {'WatchID': int(arrays.watch_id[rows[row]]), 'LatStart': float(lat[row]),
+                        'LongStart': float(lon[row]), 'DistanceKm': float(distance[row])}
+        summary['platforms'][name] = {
+            'watches': int(watches.sum()),
+            'sightings': int(sightings.sum()),
+            'count': float(counts[sightings].sum()),
+            'effort_min': float(np.nansum(np.asarray(arrays.effort_min)[rows][watches])),
+            'species': species,
+            'first_ns': int(timed.min()) if len(timed) else None,
+            'last_ns': int(timed.max()) if len(timed) else None,
+            'furthest': furthest,
+        }
+
+    watch_totals = np.bincount(parents, weights=counts, minlength=len(rows))
+    summary['grid'] = _grid_cells(lat, lon, watch_totals, cell_deg)
+    return summary
+
+
+def _merge_optional(a, b, pick):
+    if a is None or b is None:
+        return b if a is None else a
+    return pick(a, b)
+
+
+def merge_summaries(a, b):
+    """Merge two summaries of disjoint sets of watches."""
+    if a['cell_deg'] != b['cell_deg']:
+        raise ValueError(f"Can't merge grids of {a['cell_deg']} and {b['cell_deg']} degree cells")
+    platforms = {}
+    for name in PLATFORMS:
+        left, right = a['platforms'][name], b['platforms'][name]
+        platforms[name] = {
+            'watches': left['watches'] + right['watches'],
+            'sightings': left['sightings'] + right['sightings'],
+            'count': left['count'] + right['count'],
+            'effort_min': left['effort_min'] + right['effort_min'],
+            # watches never appear in both, so the watches per species add up too
+            'species': left['species'].add(right['species'], fill_value=0),
+            'first_ns': _merge_optional(left['first_ns'], right['first_ns'], min),
+            'last_ns': _merge_optional(left['last_ns'], right['last_ns'], max),
+            'furthest': _merge_optional(left['furthest'], right['furthest'],
+                                        lambda x, y: x if x['DistanceKm'] >= y['DistanceKm'] else y),
+        }
+    return {'platforms': platforms, 'grid': a['grid'].add(b['grid'], fill_value=0), 'cell_deg': a['cell_deg']}
+
+
+###########################
+# Chunked map layers
+
+CHUNK_PREFIX = 'ecsasChunk('
+CHUNK_SUFFIX = ');\n'
+
+
+def _chunk_path(output_dir, index):
+    return os.path.join(output_dir, 'layers', f'chunk-{index:04d}.js')
+
+
+def _read_chunk(path):
+    with open(path) as chunk:
+        text = chunk.read()
+    return json.loads(text[len(CHUNK_PREFIX):-len(CHUNK_SUFFIX)])['features']
+
+
+def _write_chunk(path, features):
+    """Layer files are scripts calling `ecsasChunk`, so the page can load them from disk without a web server."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as chunk:
+        chunk.write(CHUNK_PREFIX + json.dumps({'type': 'FeatureCollection', 'features': features}) + CHUNK_SUFFIX)
+    os.replace(tmp_path, path)
+
+
+def _species_table(species, counts):
+    if not species:
+        return '<p>No birds observed during this watch</p>'
+    cell = "style='padding: 8px; border: 1px solid #ddd;'"
+    rows = ''.join(f"<tr><td {cell}>{alpha}</td><td {cell}>{count:g}</td></tr>" for alpha, count in zip(species, counts))
+    return (f"<table style='width:100%; border-collapse: collapse; border: 1px solid #ddd;'>"
+            f"<tr><th {cell}>Species</th><th {cell}>Count</th></tr>{rows}</table>")
+
+
+def watch_features(arrays, store, lookups, rows):
+    """One GeoJSON point per watch in `rows`, with the popup of interactive_map.py."""
+    sighting_rows, parents = _block_rows(store.watch_sighting, rows)
+    codes = np.asarray(arrays.species_code)[sighting_rows]
+    counts = np.asarray(arrays.count, dtype=np.float64)[sighting_rows]
+    species = np.where(codes >= 0, np.asarray(arrays.species, dtype=object)[np.maximum(codes, 0)], 'UNKNOWN')
+    totals = np.bincount(parents, weights=counts, minlength=len(rows))
+    # sightings come in watch order, so each watch's sightings are one slice
+    bounds = np.searchsorted(parents, np.arange(len(rows) + 1))
+
+    watch_ids = np.asarray(arrays.watch_id)[rows]
+    observers = lookups.decode(store.table('tblWatch', columns=['Observer'], rows=rows)['Observer'].to_numpy(),
+                               'lkpObserver', 'ObserverName')
+    notes = store.notes('tblWatchNotes', watch_ids)
+    start_ns = np.asarray(arrays.start_ns)[rows]
+    lat, lon = np.asarray(arrays.lat_start)[rows], np.asarray(arrays.lon_start)[rows]
+
+    features = []
+    for i in np.flatnonzero(np.isfinite(lat) & np.isfinite(lon)):
+        start = pd.Timestamp(start_ns[i]) if start_ns[i] != NAT else None
+        block = slice(bounds[i], bounds[i + 1])
+        popup = (
+            '<div style="font-family: Arial, sans-serif; width: 260px; text-align: left;">'
+            '<h6 style="color: #008CBA; font-weight: bold;">WATCH AND SIGHTINGS INFO</h6>'
+            f'<p><strong>Watch ID:</strong> {watch_ids[i]}</p>'
+            f"<p><strong>Date:</strong> {start.strftime('%Y-%m-%d') if start else ''}</p>"
+            f"<p><strong>Start Time:</strong> {start.strftime('%H:%M:%S') if start else ''}</p>"
+            f'<p><strong>Observer:</strong> {observers[i] if pd.notnull(observers[i]) else ""}</p>'
+            f'{_species_table(list(species[block]), counts[block])}'
+            f'<p><strong>Total birds:</strong> {totals[i]:g}</p>'
+            + (f"<p><strong>Observer's Notes:</strong> {notes[i]}</p>" if pd.notnull(notes[i]) else '')
+            + '</div>'
+        )
+        features.append({
+            'type': 'Feature',
+            'geometry': {'type': 'Point', 'coordinates': [float(lon[i]), float(lat[i])]},
+            'properties': {'WatchID': int(watch_ids[i]), 'TotalBirds': float(totals[i]), 'popup': popup},
+        })
+    return features
+
+
+def append_features(state, features, output_dir=OUTPUT_DIR, chunk_watches=CHUNK_WATCHES):
+    """Fill up the last chunk, then write new ones. Returns the chunks that were written."""
+    written = []
+    if state['chunks'] and state['chunks'][-1]['features'] < chunk_watches and features:
+        last = state['chunks'][-1]
+        room = chunk_watches - last['features']
+        path = _chunk_path(output_dir, last['index'])
+        combined = _read_chunk(path) + features[:room]
+        _write_chunk(path, combined)
+        last['features'] = len(combined)
+        written.append(last['index'])
+        features = features[room:]
+
+    for start in range(0, len(features), chunk_watches):
+        index = len(state['chunks'])
+        _write_chunk(_chunk_path(output_dir, index), features[start:start + chunk_watches])
+        state['chunks'].append({'index': index, 'file': os.path.relpath(_chunk_path(output_dir, index), output_dir),
+                                'features': len(features[start:start + chunk_watches])})
+        written.append(index)
+    return written
+
+
+def write_map_page(state, output_dir=OUTPUT_DIR):
+    """Write the map page: base map, port, colour scale and a loader for every chunk."""
+    import folium
+    from branca.colormap import linear
+    from branca.element import Element
+    from folium.plugins import MarkerCluster, MeasureControl
+
+    max_total = max(state['max_total_birds'], 1)
+    colormap = linear.YlOrRd_09.scale(0, max_total)
+    colormap.caption = 'Total Birds'
+
+    survey_map = folium.Map(location=list(PORT), zoom_start=7)
+    marker_cluster = MarkerCluster().add_to(survey_map)
+    colormap.add_to(survey_map)
+    folium.CircleMarker(location=list(PORT), radius=4, color='#3186cc', fill=True, fill_color='#3186cc',
+                        fill_opacity=0.7, popup='Port').add_to(survey_map)
+    survey_map.add_child(MeasureControl(position='topright', primary_length_unit='kilometers',
+                                        secondary_length_unit='miles', primary_area_unit='sqmeters',
+                                        secondary_area_unit='acres'))
+
+    # the colours of the scale, so the markers are coloured the same way in the browser
+    colors = [colormap.rgb_hex_str(value) for value in np.linspace(0, max_total, 9)]
+    chunks = [chunk['file'].replace(os.sep, '/') for chunk in state['chunks']]
+    survey_map.get_root().script.add_child(Element(f"""
+    var ecsasColors = {json.dumps(colors)};
+    function ecsasColor(total) {{
+        var step = Math.round(Math.min(total / {max_total}, 1) * (ecsasColors.length - 1));
+        return ecsasColors[step];
+    }}
+    function ecsasChunk(collection) {{
+        L.geoJSON(collection, {{
+            pointToLayer: function (feature, latlng) {{
+                var color = ecsasColor(feature.properties.TotalBirds);
+                return L.circleMarker(latlng, {{radius: 5, color: color, fill: true, fillColor: color,
+                                                fillOpacity: 0.7}}).bindPopup(feature.properties.popup, {{maxWidth: 300}});
+            }}
+        }}).eachLayer(function (layer) {{ {marker_cluster.get_name()}.addLayer(layer); }});
+    }}
+    // the map and the cluster are only set up further down the page, so the chunks are loaded once it has loaded
+    window.addEventListener('load', function () {{
+        {json.dumps(chunks)}.forEach(function (src) {{
+            var script = document.createElement('script');
+            script.src = src;
+            document.body.appendChild(script);
+        }});
+    }});
+    """))
+    os.makedirs(output_dir, exist_ok=True)
+    survey_map.save(os.path.join(output_dir, 'survey_map.html'))
+
+
+###########################
+# Updating and reporting
+
+def update(rebuild=False, directory=INCREMENTAL_DIR, output_dir=OUTPUT_DIR, arrays_dir=ARRAYS_DIR):
+    """Add the watches that are new since the last update to the summaries and the map. Returns the number added."""
+    import shutil
+    from lookups import load_lookups
+    from store import load_store
+
+    store = load_store()
+    arrays = open_arrays(arrays_dir)
+    state, summary, processed = load_state(directory)
+
+    if not rebuild and watches_removed(arrays, state, processed):
+        print("Watches were removed from the export, rebuilding")
+        rebuild = True
+    if rebuild:
+        shutil.rmtree(output_dir, ignore_errors=True)
+        state, summary, processed = new_state(), empty_summary(), np.zeros(0, dtype=np.int64)
+
+    rows = new_watch_rows(arrays, state, processed)
+    if len(rows) == 0:
+        print(f"No new watches since {state['updated']}")
+        return 0
+
+    summary = merge_summaries(summary, summarize(arrays, store.watch_sighting, rows, state['cell_deg']))
+    features = watch_features(arrays, store, load_lookups(), rows)
+    state['max_total_birds'] = max([state['max_total_birds']]
+                                   + [feature['properties']['TotalBirds'] for feature in features])
+    written = append_features(state, features, output_dir)
+    write_map_page(state, output_dir)
+
+    advance_watermark(state, arrays, rows)
+    processed = np.sort(np.concatenate([processed, np.asarray(arrays.watch_id)[rows].astype(np.int64)]))
+    state['watches'] = len(processed)
+    state['watch_id_sum'] = int(processed.sum())
+    state['sightings'] = int(sum(platform['sightings'] for platform in summary['platforms'].values()))
+    state['updated'] = time.strftime('%Y-%m-%d %H:%M:%S')
+    save_state(state, summary, processed, directory)
+    with open(os.path.join(output_dir, 'metrics.txt'), 'w') as metrics_file:
+        metrics_file.write(report(summary))
+
+    print(f"Added {len(rows)} watches ({len(features)} on the map, chunks {written}); "
+          f"{state['watches']} watches processed in total")
+    return len(rows)
+
+
+def report(summary):
+    """The metrics table of basic-metrics.py, from the running summaries."""
+    from prettytable import PrettyTable
+    from species_accumulation import ace, chao1
+
+    moving, stationary = summary['platforms']['moving'], summary['platforms']['stationary']
+
+    def observed(platform):
+        # sightings without a species are kept under 'UNKNOWN' in the summaries, basic-metrics.py leaves them out
+        return platform['species'].drop(index='UNKNOWN', errors='ignore')
+
+    def extreme(platform, pick):
+        species = observed(platform)['Count']
+        if species.empty:
+            return '', ''
+        alpha = species.idxmax() if pick == 'max' else species.idxmin()
+        return alpha, f"{species[alpha]:g}"
+
+    def richness(platform, estimator):
+        abundances = observed(platform)['Count'].round().astype(int).to_numpy()
+        abundances = abundances[abundances > 0]
+        return f"{estimator(abundances):.1f}" if len(abundances) else ''
+
+    table = PrettyTable()
+    table.field_names = ["Metric", "Moving Platforms", "Stationary Platforms"]
+    table.add_row(["Total surveys conducted", moving['watches'], stationary['watches']])
+    table.add_row(["Species or bird types observed", len(observed(moving)), len(observed(stationary))])
+    table.add_row(["Estimated species richness (Chao1)", richness(moving, chao1), richness(stationary, chao1)])
+    table.add_row(["Estimated species richness (ACE)", richness(moving, ace), richness(stationary, ace)])
+    table.add_row(["Total birds counted", f"{moving['count']:g}", f"{stationary['count']:g}"])
+    table.add_row(["Effort (minutes)", f"{moving['effort_min']:g}", f"{stationary['effort_min']:g}"])
+    most_moving, most_stationary = extreme(moving, 'max'), extreme(stationary, 'max')
+    least_moving, least_stationary = extreme(moving, 'min'), extreme(stationary, 'min')
+    table.add_row(["Most seen species", most_moving[0], most_stationary[0]])
+    table.add_row(["Count of most seen species", most_moving[1], most_stationary[1]])
+    table.add_row(["Least seen species", least_moving[0], least_stationary[0]])
+    table.add_row(["Count of least seen species", least_moving[1], least_stationary[1]])
+
+    firsts = [platform['first_ns'] for platform in (moving, stationary) if platform['first_ns'] is not None]
+    lasts = [platform['last_ns'] for platform in (moving, stationary) if platform['last_ns'] is not None]
+    furthest = [platform['furthest'] for platform in (moving, stationary) if platform['furthest'] is not None]
+    lines = []
+    if firsts:
+        start, end = pd.Timestamp(min(firsts)).normalize(), pd.Timestamp(max(lasts)).normalize()
+        lines += [f"      Start date: {start:%Y-%m-%d}", f"      End date: {end:%Y-%m-%d}",
+                  f"      Total trip length: {(end - start).days + 1} days"]
+    if furthest:
+        lines.append(f"      Distance offshore from port: {max(item['DistanceKm'] for item in furthest):.2f} km.")
+    grid = summary['grid']
+    lines.append(f"      Grid cells with sightings: {int((grid > 0).sum())} ({summary['cell_deg']} degree cells)")
+    return '\n'.join(lines) + '\n\n' + table.get_string() + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Add new watches to the running metrics and the map.')
+    parser.add_argument('command', choices=['update', 'report'])
+    parser.add_argument('--rebuild', action='store_true', help='recompute everything from the whole survey')
+    args = parser.parse_args()
+
+    if args.command == 'update':
+        update(args.rebuild)
+    print(report(load_state()[1]))
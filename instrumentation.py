@@ -0,0 +1,254 @@
+#####################################################
+###############   INSTRUMENTATION    ################
+
+"""
+When a run is slow, or gets killed for going over the 1 GB SLURM allocation, the only clues were the print statements
+scattered through the scripts.
+
+Here I measure every step of a run. A step is wrapped in `stage()`:
+
+    with stage('fit', rows_in=len(X)) as record:
+        gam = LinearGAM(s(0)).fit(X, y)
+        record.rows_out = len(X_pred)
+
+and gets a record with its:
+
+- wall time and CPU time (seconds)
+- peak resident memory of the process so far (the high-water mark the SLURM memory limit is checked against), and how
+  much the step raised it. Pipeline workers are reused, so the process peak of a stage can be an earlier stage's; the
+  growth is the step's own
+- peak memory allocated through Python during the step (tracemalloc, only when memory tracing is on, since it slows
+  allocation-heavy code down)
+- rows going in and out, where the code sets them
+- bytes read and written by the process during the step (from /proc/self/io, so Linux only)
+
+Stages nest: a `fit` inside the `gam` pipeline stage is recorded as `gam/fit`. The pipeline (pipeline.py) wraps every
+stage, `load_input` records loading the data, and the scripts wrap their fits and output writes. At the end of a run the
+pipeline writes all records to a JSON report in `cache/pipeline/reports/`. Scripts run on their own (outside
+pipeline.py) record their steps too, but no report is written for them. With profiling on, every pipeline stage also
+runs under cProfile and the profile of the hottest stage (longest wall time) is kept next to the report, as a `.prof` file
+for snakeviz or flameprof (to draw a flame graph) plus a text summary of its most expensive functions.
+"""
+
+# load the required modules
+import contextlib
+import cProfile
+import io
+import json
+import os
+import platform
+import pstats
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+
+
+# Folder for the run reports and profiles
+REPORTS_DIR = os.path.join('cache', 'pipeline', 'reports')
+
+# Functions listed in the text summary of a profile
+PROFILE_TOP = 40
+
+# Finished records in this process (shared by its threads, so they're added under a lock), and the stages currently
+# open in each thread (innermost last)
+_records = []
+_records_lock = threading.Lock()
+_local = threading.local()
+
+# Memory tracing can be turned on for scripts run on their own with ECSAS_TRACE_MEMORY=1
+if os.environ.get('ECSAS_TRACE_MEMORY') == '1':
+    tracemalloc.start()
+
+
+###########################
+# Measurements
+
+def _rss_mb():
+    """High-water mark of the resident memory of this process, in MB."""
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+
+
+def _io_counters():
+    """Bytes read and written by this process so far, or (None, None) where /proc isn't available."""
+    try:
+        with open('/proc/self/io') as counters:
+            values = dict(line.split(':') for line in counters.read().splitlines())
+        return int(values['rchar']), int(values['wchar'])
+    except (OSError, KeyError, ValueError):
+        return None, None
+
+
+def count_rows(value):
+    """Number of rows in a DataFrame or array, or in all the DataFrames of a dict; None for anything else."""
+    if hasattr(value, 'shape') and getattr(value, 'ndim', 0) >= 1:
+        return int(value.shape[0])
+    if isinstance(value, dict):
+        counts = [count_rows(item) for item in value.values()]
+        counts = [count for count in counts if count is not None]
+        return sum(counts) if counts else None
+    return None
+
+
+def _open_stages():
+    """The stages open in the calling thread, so stages run on different threads never nest into each other."""
+    if not hasattr(_local, 'open'):
+        _local.open = []
+    return _local.open
+
+
+class StageRecord:
+    """The measurements of one stage."""
+
+    def __init__(self, name, rows_in=None):
+        self.name = name
+        self.rows_in = rows_in
+        self.rows_out = None
+        self.status = 'running'
+        self.wall_s = self.cpu_s = None
+        self.process_peak_rss_mb = self.rss_growth_mb = self.traced_peak_mb = None
+        self.bytes_read = self.bytes_written = None
+        self.pid = os.getpid()
+        # the highest traced peak of the stages nested in this one (tracemalloc only keeps one peak)
+        self._nested_peak = 0
+
+    def as_dict(self):
+        return {key: value for key, value in vars(self).items() if not key.startswith('_')}
+
+
+@contextlib.contextmanager
+def stage(name, rows_in=None):
+    """
+    Measure the code in the `with` block as a stage called `name` (nested in any stage already open in this thread).
+
+    Stages can be used from several threads at once (e.g. a thread pool), but the memory and I/O measurements are
+    for the whole process, so those of stages that overlap in time include each other's work.
+    """
+    _open = _open_stages()
+    record = StageRecord(f'{_open[-1].name}/{name}' if _open else name, rows_in)
+
+    tracing = tracemalloc.is_tracing()
+    if tracing:
+        # remember the peak so far for the enclosing stage before it is reset for this one
+        if _open:
+            _open[-1]._nested_peak = max(_open[-1]._nested_peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.reset_peak()
+
+    read_start, written_start = _io_counters()
+    rss_start = _rss_mb()
+    wall_start, cpu_start = time.perf_counter(), time.process_time()
+    _open.append(record)
+    try:
+        yield record
+        record.status = 'ok'
+    except BaseException:
+        record.status = 'failed'
+        raise
+    finally:
+        _open.pop()
+        record.wall_s = round(time.perf_counter() - wall_start, 4)
+        record.cpu_s = round(time.process_time() - cpu_start, 4)
+        rss_end = _rss_mb()
+        record.process_peak_rss_mb = round(rss_end, 1)
+        record.rss_growth_mb = round(rss_end - rss_start, 1)
+
+        read_end, written_end = _io_counters()
+        if read_start is not None and read_end is not None:
+            record.bytes_read = read_end - read_start
+            record.bytes_written = written_end - written_start
+
+        if tracing:
+            peak = max(tracemalloc.get_traced_memory()[1], record._nested_peak)
+            record.traced_peak_mb = round(peak / 2 ** 20, 1)
+            if _open:
+                _open[-1]._nested_peak = max(_open[-1]._nested_peak, peak)
+        with _records_lock:
+            _records.append(record)
+
+
+def configure(trace_memory=False):
+    """Turn memory tracing on or off for the stages run in this process."""
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+    elif not trace_memory and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def collect():
+    """Return the finished records of this process as dicts (e.g. to send them back from a worker) and clear them."""
+    with _records_lock:
+        records = [record.as_dict() for record in _records]
+        _records.clear()
+    return records
+
+
+###########################
+# Profiling
+
+def profiled(path, function, *args, **kwargs):
+    """Run `function` under cProfile and dump its profile to `path`."""
+    profile = cProfile.Profile()
+    try:
+        return profile.runcall(function, *args, **kwargs)
+    finally:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        profile.dump_stats(path)
+
+
+def profile_summary(path, top=PROFILE_TOP):
+    """Text summary of a profile: the functions with the most cumulative and the most own time."""
+    output = io.StringIO()
+    stats = pstats.Stats(path, stream=output).strip_dirs()
+    stats.sort_stats('cumulative').print_stats(top)
+    stats.sort_stats('tottime').print_stats(top)
+    return output.getvalue()
+
+
+###########################
+# Run reports
+
+def write_report(records, status, profiles=None, reports_dir=REPORTS_DIR, trace_memory=None):
+    """
+    Write the records of a run to `<reports_dir>/run-<time>.json` (and `latest.json`), keeping only the profile of the
+    hottest stage. Returns the path of the report.
+    """
+    os.makedirs(reports_dir, exist_ok=True)
+    run_name = time.strftime('run-%Y%m%d-%H%M%S')
+
+    top_level = [record for record in records if '/' not in record['name']]
+    hottest = max(top_level, key=lambda record: record.get('wall_s') or 0, default=None)
+
+    profile = None
+    profiles = profiles or {}
+    if hottest is not None and hottest['name'] in profiles and os.path.exists(profiles[hottest['name']]):
+        profile = os.path.join(reports_dir, f"{run_name}-{hottest['name']}.prof")
+        os.replace(profiles[hottest['name']], profile)
+        with open(profile[:-len('.prof')] + '.txt', 'w') as summary:
+            summary.write(profile_summary(profile))
+    for path in profiles.values():
+        if os.path.exists(path):
+            os.remove(path)
+
+    report = {
+        'run': run_name,
+        'machine': {'python': platform.python_version(), 'platform': platform.platform(), 'cpus': os.cpu_count()},
+        'trace_memory': tracemalloc.is_tracing() if trace_memory is None else trace_memory,
+        'status': status,
+        'hottest_stage': hottest['name'] if hottest else None,
+        'profile': profile,
+        'totals': {
+            'wall_s': round(sum(record.get('wall_s') or 0 for record in top_level), 3),
+            'cpu_s': round(sum(record.get('cpu_s') or 0 for record in top_level), 3),
+            'process_peak_rss_mb': max((record.get('process_peak_rss_mb') or 0 for record in records), default=None),
+        },
+        'stages': records,
+    }
+
+    path = os.path.join(reports_dir, f'{run_name}.json')
+    for target in (path, os.path.join(reports_dir, 'latest.json')):
+        with open(target, 'w') as report_file:
+            json.dump(report, report_file, indent=2)
+    return path
@@ -4,39 +4,28 @@ import folium
 from branca.colormap import linear
 from folium.plugins import MarkerCluster, MeasureControl
 import geopy.distance
+from lookups import load_lookups
+from store import load_store
+from pipeline import load_input
+from instrumentation import stage
+import temporal
 
 # Define file paths using raw strings
 stationary_survey_path = r'data\stationary_platform_data.xlsx'
-cruise_metadata_path = r'ECSAS_tables\tblCruise.xlsx'
-watch_notes_path = r'ECSAS_tables\tblWatchNotes.xlsx'
 
 # Load the stationary survey data file
-stationary_survey = pd.read_excel(stationary_survey_path)
+stationary_survey = load_input('stationary_survey', stationary_survey_path)
 
-# Clean up StartTime column to extract only time
-stationary_survey['StartTime'] = pd.to_datetime(stationary_survey['StartTime']).dt.time
+# Keep StartTime and Date as datetimes, they're only written out as text for the popups (see temporal.py)
+stationary_survey['StartTime'] = pd.to_datetime(stationary_survey['StartTime'])
+stationary_survey['Date'] = pd.to_datetime(stationary_survey['Date'])
 
-# Clean up Date column to remove time component
-stationary_survey['Date'] = pd.to_datetime(stationary_survey['Date']).dt.strftime('%Y-%m-%d')
+# Open the relational store for the cruise info and watch notes (see store.py)
+store = load_store()
+df_cruise = store.cruises
 
-# Load metadata from Excel files for additional cruise info
-df_cruise = pd.read_excel(cruise_metadata_path)
-watch_notes = pd.read_excel(watch_notes_path)
-
-df_observer = pd.read_excel(r'ECSAS_tables\lkpObserver.xlsx')
-df_platform = pd.read_excel(r'ECSAS_tables\lkpPlatform.xlsx')
-df_company = pd.read_excel(r'ECSAS_tables\lkpCompany.xlsx')
-
-# Merge metadata files to get observer, platform names, and watch notes
-stationary_survey = pd.merge(stationary_survey, df_cruise[['CruiseID', 'Observer', 'PlatformName', 'Start Date', 'End Date', 'Company']], 
-                             left_on='CruiseID', right_on='CruiseID', how='left')
-
-stationary_survey = pd.merge(stationary_survey, watch_notes[['WatchID', 'Note']], 
-                             left_on='WatchID', right_on='WatchID', how='left')
-
-# Merge company details
-stationary_survey = pd.merge(stationary_survey, df_company[['CompanyID', 'CompanyText']], 
-                             left_on='Company', right_on='CompanyID', how='left')
+# Load the compiled lookup tables for observer, platform and company names
+lookups = load_lookups()
 
 # Aggregate species and counts for each WatchID
 aggregated_data = stationary_survey.groupby('WatchID').agg({
@@ -44,18 +33,24 @@ aggregated_data = stationary_survey.groupby('WatchID').agg({
     'LongStart': 'first', 
     'Alpha': lambda x: x.dropna().tolist(),
     'Count': lambda x: x.dropna().tolist(),
-    'Observer_x': 'first',  
-    'PlatformName': 'first',
+    'Observer': 'first',  
     'Date': 'first',
-    'StartTime': 'first',
-    'Note': 'first'
+    'StartTime': 'first'
 }).reset_index()
 
-# Merge observer and platform names
-aggregated_data = pd.merge(aggregated_data, df_observer[['ObserverID', 'ObserverName']], 
-                           left_on='Observer_x', right_on='ObserverID', how='left')
-aggregated_data = pd.merge(aggregated_data, df_platform[['PlatformID', 'PlatformText']], 
-                           left_on='PlatformName', right_on='PlatformID', how='left')
+# Look up the cruise details and watch notes once per watch from the store, instead of merging them onto every sighting
+# (the observer comes from each watch, so only the platform is taken from tblCruise)
+watch_rows = store.watch_rows(aggregated_data['WatchID'])
+aggregated_data['PlatformName'] = store.cruise_attributes(watch_rows, ['PlatformName'])['PlatformName'].to_numpy()
+aggregated_data['Note'] = store.notes('tblWatchNotes', aggregated_data['WatchID'])
+
+# Decode observer and platform names with the lookup tables
+aggregated_data['ObserverName'] = lookups.decode(aggregated_data['Observer'], 'lkpObserver', 'ObserverName')
+aggregated_data['PlatformText'] = lookups.decode(aggregated_data['PlatformName'], 'lkpPlatform', 'PlatformText')
+
+# Write the date and start time of each watch as text for its popup, for all watches at once
+aggregated_data['DateText'] = temporal.date_text(temporal.to_ns(aggregated_data['Date']))
+aggregated_data['StartText'] = temporal.clock_text(temporal.to_ns(aggregated_data['StartTime']))
 
 # Calculate total birds observed per watch for color scaling points on our map
 aggregated_data['TotalBirds'] = aggregated_data['Count'].apply(lambda x: sum(map(int, x)))
@@ -92,8 +87,8 @@ for _, row in aggregated_data.iterrows():
 <div style="font-family: Arial, sans-serif; width: 260px; text-align: left;">
     <h6 style="color: #008CBA; font-weight: bold;">WATCH AND SIGHTINGS INFO</h6>
     <p><strong>Watch ID:</strong> {row['WatchID']}</p>
-    <p><strong>Date:</strong> {row['Date']}</p>
-    <p><strong>Start Time:</strong> {row['StartTime']}</p>
+    <p><strong>Date:</strong> {row['DateText']}</p>
+    <p><strong>Start Time:</strong> {row['StartText']}</p>
     <p><strong>Watch Table: </strong> the count of seabird species sighted per watch</p>
     {species_table}
     <p><strong>Total birds:</strong> {sum(map(int, row['Count']))}</p>
@@ -124,15 +119,19 @@ colormap.add_to(m)
 def add_port_marker(map_obj, start_coords, end_coords):
     # Fetch cruise details from df_cruise
     cruise_info = df_cruise.iloc[0]
+
+    # Decode the company and platform names with the lookup tables
+    company_name = lookups.decode([cruise_info['Company']], 'lkpCompany', 'CompanyText')[0]
+    platform_text = lookups.decode([cruise_info['PlatformName']], 'lkpPlatform', 'PlatformText')[0]
     
     # Format popup HTML for port markers
     if start_coords == end_coords:
         popup_html = f"""
         <div style="font-family: Arial, sans-serif; width: 260px; text-align: left;">
-            <h6 style="color: #008CBA; font-weight: bold;">Port: {cruise_info['PlatformName']}</h6>
+            <h6 style="color: #008CBA; font-weight: bold;">Port: {platform_text}</h6>
             <p>Departed: {cruise_info['Start Date'].strftime('%Y-%m-%d')}</p>
             <p><strong>Cruise ID:</strong> {cruise_info['CruiseID']}</p>
-            <p><strong>Company:</strong> {cruise_info['Company']}</p>
+            <p><strong>Company:</strong> {company_name}</p>
         </div>
         """
         # Create CircleMarker for start/end port
@@ -149,18 +148,18 @@ def add_port_marker(map_obj, start_coords, end_coords):
         # Format popup HTML for start and end ports separately
         start_popup_html = f"""
         <div style="font-family: Arial, sans-serif; width: 260px; text-align: left;">
-            <h6 style="color: #008CBA; font-weight: bold;">Start Port: {cruise_info['PlatformName']}</h6>
+            <h6 style="color: #008CBA; font-weight: bold;">Start Port: {platform_text}</h6>
             <p>Departed: {cruise_info['Start Date'].strftime('%Y-%m-%d')}</p>
             <p><strong>Cruise ID:</strong> {cruise_info['CruiseID']}</p>
-            <p><strong>Company:</strong> {cruise_info['Company']}</p>
+            <p><strong>Company:</strong> {company_name}</p>
         </div>
         """
         end_popup_html = f"""
         <div style="font-family: Arial, sans-serif; width: 260px; text-align: left;">
-            <h6 style="color: #008CBA; font-weight: bold;">End Port: {cruise_info['PlatformName']}</h6>
+            <h6 style="color: #008CBA; font-weight: bold;">End Port: {platform_text}</h6>
             <p>Arrived: {cruise_info['End Date'].strftime('%Y-%m-%d')}</p>
             <p><strong>Cruise ID:</strong> {cruise_info['CruiseID']}</p>
-            <p><strong>Company:</strong> {cruise_info['Company']}</p>
+            <p><strong>Company:</strong> {company_name}</p>
         </div>
         """
         
@@ -224,6 +223,7 @@ def add_grid(map_obj, start_coords, end_coords, grid_size_km=10):
 add_grid(m, start_coords, end_coords, grid_size_km=10)
 
 # Save the map to an HTML file
-m.save(r'figures/survey_map.html')
+with stage('write'):
+    m.save(r'figures/survey_map.html')
 
 print("Map has been created and saved as 'survey_map.html'. Open this file in a web browser to view the map.")
\ No newline at end of file
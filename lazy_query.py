@@ -0,0 +1,374 @@
+#####################################################
+##############   LAZY QUERY LAYER    ################
+
+"""
+Every script used to load the whole survey dataset into pandas before filtering it, e.g.
+`final_df[final_df['PlatformClass'] == 3]` or the GBBG / COMU filters in `heatmaps.py`. That won't work once the
+full multi-program archive is larger than the memory on a node.
+
+Here I add a lazy query over the Parquet tables in the relational store (see `store.py`). A query only records which
+columns are needed and which filters apply; nothing is read until the results are asked for. Then:
+
+- only the selected columns are read from disk,
+- row groups whose min/max statistics can't match a filter (cruise, dates, PlatformClass, bounding box...) are skipped
+  without being read, which works especially well on CruiseID because the watch table is sorted by it,
+- filters on watch columns are applied to sightings through the store's watch -> sighting offsets, so only the row
+  groups that hold sightings of matching watches are read,
+- aggregations run one row group at a time and combine partial results, so only the final table is built in pandas.
+
+Example:
+
+    scan('tblSighting').select('Alpha', 'Count').where(platform_class=2, species='GBBG').aggregate('Alpha', Count='sum')
+"""
+
+# load the required modules
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+
+from store import STORE_DIR, RelationalStore
+
+
+# The comparison operators a filter can use
+OPERATORS = {
+    'in': lambda column, value: pc.is_in(column, value_set=pa.array(value)),
+    '==': pc.equal,
+    '!=': pc.not_equal,
+    '>=': pc.greater_equal,
+    '<=': pc.less_equal,
+    '>': pc.greater,
+    '<': pc.less,
+}
+
+# Aggregations that can be combined from partial results: how each partial is computed and how partials are merged
+AGGREGATIONS = {
+    'sum': ('sum', 'sum'),
+    'count': ('count', 'sum'),
+    'min': ('min', 'min'),
+    'max': ('max', 'max'),
+}
+
+# Columns on each sighting that come from its species, looked up in tblSpeciesInfo
+SPECIES_TABLE = 'tblSpeciesInfo'
+
+
+###############################
+# Row group statistics
+
+def _may_match(statistics, op, value):
+    """Return False only if the row group's min/max statistics prove that no row can pass the filter."""
+    if statistics is None or not statistics.has_min_max:
+        return True
+    low, high = statistics.min, statistics.max
+    try:
+        if op == 'in':
+            return any(low <= v <= high for v in value)
+        if op == '==':
+            return low <= value <= high
+        if op in ('>=', '>'):
+            return high >= value if op == '>=' else high > value
+        if op in ('<=', '<'):
+            return low <= value if op == '<=' else low < value
+    except TypeError:
+        # statistics of a different type (e.g. dates stored as timestamps) can't be compared, so the group is read
+        return True
+    return True
+
+
+def _comparable(value):
+    """Convert pandas timestamps into the plain datetimes that Parquet statistics are reported as."""
+    if isinstance(value, (list, tuple, set, np.ndarray, pd.Series)):
+        return [_comparable(v) for v in value]
+    if isinstance(value, pd.Timestamp):
+        return value.to_pydatetime()
+    if isinstance(value, np.generic):
+        return value.item()
+    return value
+
+
+def _mask(table, predicates):
+    """Evaluate the filters on an Arrow table and return a numpy boolean mask."""
+    mask = np.ones(table.num_rows, dtype=bool)
+    for column, op, value in predicates:
+        passed = OPERATORS[op](table.column(column), _comparable(value))
+        mask &= pc.fill_null(passed, False).to_numpy(zero_copy_only=False)
+    return mask
+
+
+def scan_row_groups(path, columns, predicates=(), row_mask=None):
+    """
+    Read a Parquet file one row group at a time, yielding (first row number, Arrow table, mask) for each group that
+    may contain matching rows.
+
+    Row groups are skipped using their statistics, or when `row_mask` (one flag per row of the file) selects nothing in
+    them. Only `columns` plus the filter columns are read.
+    """
+    parquet_file = pq.ParquetFile(path)
+    metadata = parquet_file.metadata
+    names = parquet_file.schema_arrow.names
+    read_columns = list(dict.fromkeys(list(columns) + [column for column, _, _ in predicates]))
+
+    first_row = 0
+    for group in range(metadata.num_row_groups):
+        n_rows = metadata.row_group(group).num_rows
+        start, first_row = first_row, first_row + n_rows
+
+        if row_mask is not None and not row_mask[start:start + n_rows].any():
+            continue
+
+        row_group = metadata.row_group(group)
+        if not all(_may_match(row_group.column(names.index(column)).statistics, op, _comparable(value))
+                   for column, op, value in predicates):
+            continue
+
+        table = parquet_file.read_row_group(group, columns=read_columns)
+        mask = _mask(table, predicates)
+        if row_mask is not None:
+            mask &= row_mask[start:start + n_rows]
+        yield start, table, mask
+
+
+###############################
+# The query
+
+class LazyQuery:
+    """
+    A query over one table of the relational store. `select`, `where` and `filter` return new queries, and the data is
+    only read by `batches`, `to_pandas`, `count` or `aggregate`.
+    """
+
+    def __init__(self, table='tblSighting', store_dir=STORE_DIR, columns=None, predicates=()):
+        self.table = table
+        self.store_dir = store_dir
+        self.columns = columns
+        self.predicates = tuple(predicates)
+
+    def _copy(self, **changes):
+        settings = dict(table=self.table, store_dir=self.store_dir, columns=self.columns, predicates=self.predicates)
+        settings.update(changes)
+        return LazyQuery(**settings)
+
+    def _path(self, table):
+        return os.path.join(self.store_dir, f'{table}.parquet')
+
+    def _schema(self, table):
+        return pq.read_schema(self._path(table)).names
+
+    # building the query
+
+    def select(self, *columns):
+        """Only read these columns (watch and species columns can also be selected on a sighting query)."""
+        return self._copy(columns=list(columns))
+
+    def filter(self, column, op, value):
+        """Add a filter on any watch, sighting or species column, e.g. filter('SeaState', '==', 10)."""
+        if op not in OPERATORS:
+            raise ValueError(f"Unknown operator {op!r}, use one of {', '.join(OPERATORS)}")
+        if op == 'in':
+            value = list(np.atleast_1d(value))
+        return self._copy(predicates=self.predicates + ((column, op, value),))
+
+    def where(self, cruise=None, date_range=None, species=None, platform_class=None, bbox=None):
+        """
+        Add the common survey filters:
+
+        - cruise: a CruiseID or list of CruiseIDs
+        - date_range: (start, end) dates, inclusive
+        - species: an Alpha code or list of Alpha codes
+        - platform_class: 2 (stationary), 3 (moving) or a list of classes
+        - bbox: (min_lat, min_lon, max_lat, max_lon) on the watch start position
+        """
+        query = self
+        if cruise is not None:
+            query = query.filter('CruiseID', 'in', cruise)
+        if date_range is not None:
+            start, end = date_range
+            query = query.filter('Date', '>=', pd.Timestamp(start)).filter('Date', '<=', pd.Timestamp(end))
+        if species is not None:
+            query = query.filter('Alpha', 'in', species)
+        if platform_class is not None:
+            query = query.filter('PlatformClass', 'in', platform_class)
+        if bbox is not None:
+            min_lat, min_lon, max_lat, max_lon = bbox
+            query = (query.filter('LatStart', '>=', min_lat).filter('LatStart', '<=', max_lat)
+                          .filter('LongStart', '>=', min_lon).filter('LongStart', '<=', max_lon))
+        return query
+
+    # planning
+
+    def _split(self):
+        """Sort the filters by the table they apply to: watch, sighting or species columns."""
+        watch_columns = set(self._schema('tblWatch'))
+        sighting_columns = set(self._schema('tblSighting'))
+        species_columns = set(self._schema(SPECIES_TABLE))
+
+        watch, sighting, species = [], [], []
+        for predicate in self.predicates:
+            column = predicate[0]
+            if self.table == 'tblSighting' and column in sighting_columns:
+                sighting.append(predicate)
+            elif column in watch_columns:
+                watch.append(predicate)
+            elif column in sighting_columns:
+                sighting.append(predicate)
+            elif column in species_columns:
+                species.append(predicate)
+            else:
+                raise KeyError(f"{column} isn't a watch, sighting or species column")
+        return watch, sighting, species
+
+    def _species_ids(self, species_predicates):
+        """Turn filters on species columns (e.g. Alpha) into the set of matching SpecInfoIDs."""
+        matched = []
+        for _, table, mask in scan_row_groups(self._path(SPECIES_TABLE), ['SpecInfoID'], species_predicates):
+            matched.append(table.column('SpecInfoID').to_numpy()[mask])
+        return np.concatenate(matched) if matched else np.array([], dtype=np.int64)
+
+    def _watch_mask(self, store, watch_predicates):
+        """Flag the watch rows that pass the watch filters, reading only the row groups that can match."""
+        n_watches = len(store.watch_sighting) - 1
+        if not watch_predicates:
+            return None
+        mask = np.zeros(n_watches, dtype=bool)
+        for start, _, group_mask in scan_row_groups(self._path('tblWatch'), [], watch_predicates):
+            mask[start:start + len(group_mask)] = group_mask
+        return mask
+
+    def _sighting_mask_from_watches(self, store, watch_mask):
+        """Expand a watch mask to the sighting rows of those watches using the offsets (no join needed)."""
+        offsets = store.watch_sighting
+        marks = np.zeros(offsets[-1] + 1, dtype=np.int8)
+        rows = np.flatnonzero(watch_mask)
+        np.add.at(marks, offsets[rows], 1)
+        np.add.at(marks, offsets[rows + 1], -1)
+        return np.cumsum(marks[:-1], dtype=np.int8) > 0
+
+    # running the query
+
+    def batches(self):
+        """Yield the matching rows one row group at a time as pandas DataFrames."""
+        store = RelationalStore(self.store_dir)
+        watch_predicates, sighting_predicates, species_predicates = self._split()
+
+        if species_predicates:
+            sighting_predicates = sighting_predicates + [('SpecInfoID', 'in', list(self._species_ids(species_predicates)))]
+
+        if self.table == 'tblWatch':
+            yield from self._watch_batches(store, watch_predicates, sighting_predicates)
+        elif self.table == 'tblSighting':
+            yield from self._sighting_batches(store, watch_predicates, sighting_predicates)
+        else:
+            columns = self.columns or self._schema(self.table)
+            for _, table, mask in scan_row_groups(self._path(self.table), columns, watch_predicates + sighting_predicates):
+                yield table.select(columns).filter(pa.array(mask)).to_pandas()
+
+    def _watch_batches(self, store, watch_predicates, sighting_predicates):
+        row_mask = None
+        if sighting_predicates:
+            # a watch matches if at least one of its sightings passes the sighting filters
+            row_mask = np.zeros(len(store.watch_sighting) - 1, dtype=bool)
+            for start, _, mask in scan_row_groups(self._path('tblSighting'), [], sighting_predicates):
+                rows = start + np.flatnonzero(mask)
+                watch_rows = np.searchsorted(store.watch_sighting, rows, side='right') - 1
+                row_mask[watch_rows[watch_rows >= 0]] = True
+
+        columns = self.columns or self._schema('tblWatch')
+        for _, table, mask in scan_row_groups(self._path('tblWatch'), columns, watch_predicates, row_mask):
+            yield table.select(columns).filter(pa.array(mask)).to_pandas()
+
+    def _sighting_batches(self, store, watch_predicates, sighting_predicates):
+        sighting_schema = self._schema('tblSighting')
+        watch_schema = set(self._schema('tblWatch'))
+        species_schema = set(self._schema(SPECIES_TABLE))
+
+        columns = self.columns or sighting_schema
+        own = [c for c in columns if c in sighting_schema]
+        from_watch = [c for c in columns if c not in sighting_schema and c in watch_schema]
+        from_species = [c for c in columns if c not in sighting_schema and c not in watch_schema and c in species_schema]
+
+        watch_mask = self._watch_mask(store, watch_predicates)
+        row_mask = None if watch_mask is None else self._sighting_mask_from_watches(store, watch_mask)
+
+        # watch and species columns asked for on a sighting query are read once, only for those columns
+        watch_values = pq.read_table(self._path('tblWatch'), columns=from_watch).to_pandas() if from_watch else None
+        species = store.table(SPECIES_TABLE, columns=['SpecInfoID'] + from_species) if from_species else None
+        read = own + (['SpecInfoID'] if from_species and 'SpecInfoID' not in own else [])
+
+        for start, table, mask in scan_row_groups(self._path('tblSighting'), read, sighting_predicates, row_mask):
+            batch = table.select(read).filter(pa.array(mask)).to_pandas()
+
+            if watch_values is not None:
+                rows = start + np.flatnonzero(mask)
+                watch_rows = np.searchsorted(store.watch_sighting, rows, side='right') - 1
+                for column in from_watch:
+                    # orphan sightings before the first watch block get a watch row of -1, and so NaN
+                    batch[column] = watch_values[column].reindex(watch_rows).to_numpy()
+
+            if species is not None:
+                species_rows = store.species_rows(batch['SpecInfoID'])
+                for column in from_species:
+                    batch[column] = species[column].reindex(species_rows).to_numpy()
+
+            yield batch[columns]
+
+    def to_pandas(self):
+        """Run the query and return all matching rows as one DataFrame."""
+        batches = list(self.batches())
+        if not batches:
+            return pd.DataFrame(columns=self.columns or [])
+        return pd.concat(batches, ignore_index=True)
+
+    def count(self):
+        """Count the matching rows without keeping them."""
+        return sum(len(batch) for batch in self.batches())
+
+    def aggregate(self, by=None, **aggregations):
+        """
+        Group and aggregate the matching rows one batch at a time, e.g. aggregate('Alpha', Count='sum').
+
+        Each batch is reduced to partial results, and partials are combined as they arrive, so memory only ever holds the
+        partial table rather than the rows. Supports sum, count, min, max and mean.
+        """
+        by = [] if by is None else list(np.atleast_1d(by))
+        partial_aggs, final_aggs = {}, {}
+        for column, how in aggregations.items():
+            if how == 'mean':
+                partial_aggs[f'{column}__sum'] = (column, 'sum')
+                partial_aggs[f'{column}__count'] = (column, 'count')
+                final_aggs[f'{column}__sum'] = 'sum'
+                final_aggs[f'{column}__count'] = 'sum'
+            elif how in AGGREGATIONS:
+                partial_aggs[column] = (column, AGGREGATIONS[how][0])
+                final_aggs[column] = AGGREGATIONS[how][1]
+            else:
+                raise ValueError(f"{how!r} can't be combined across batches, use one of sum, count, min, max, mean")
+
+        # without grouping columns everything falls into a single group
+        keys = by or ['_all']
+        query = self if self.columns is None else self.select(*dict.fromkeys(by + list(aggregations)))
+
+        combined = None
+        for batch in query.batches():
+            partial = batch.assign(_all=0).groupby(keys, dropna=False).agg(**partial_aggs)
+            if combined is not None:
+                partial = pd.concat([combined, partial]).groupby(level=keys, dropna=False).agg(final_aggs)
+            combined = partial
+
+        if combined is None:
+            combined = pd.DataFrame({name: pd.Series(dtype=np.float64) for name in partial_aggs})
+            combined.index = pd.MultiIndex.from_arrays([[]] * len(keys), names=keys)
+
+        for column, how in aggregations.items():
+            if how == 'mean':
+                combined[column] = combined.pop(f'{column}__sum') / combined.pop(f'{column}__count')
+
+        return combined.reset_index()[by + list(aggregations)]
+
+
+def scan(table='tblSighting', store_dir=STORE_DIR):
+    """Start a lazy query over a table in the relational store."""
+    return LazyQuery(table, store_dir)
@@ -0,0 +1,177 @@
+#####################################################
+##############   LOOKUP TABLE REGISTRY   ############
+
+"""
+The scripts attach descriptive labels to the ECSAS codes by merging each survey DataFrame with the `lkp*` tables
+(e.g. `lkpWeather`, `lkpSeaState`, `lkpObserver`). Every merge is a hash join that copies the whole frame, and merging
+tables that share column names (like `Observer` in `tblCruise` and `tblWatch`) leaves suffixes such as `Observer_x`.
+
+Here I compile each lookup table once into sorted code arrays. Small integer code domains (weather, sea state, glare...)
+also get a dense array indexed directly by the code, so finding the row for a code is a single array access. Decoding a
+column of codes into labels is then one vectorized `take`, and nothing is added to or renamed in the survey frame.
+
+The lookup relations that translate one code into a covariate (sea state -> wind speed, Beaufort force -> wind speed)
+are registered in RELATIONS and can be added to any watch-level frame with `add_covariates`.
+"""
+
+# load the required modules
+import os
+
+import numpy as np
+import pandas as pd
+
+
+# Define the folder holding the exported Access tables
+TABLES_DIR = 'ECSAS_tables'
+
+# Most lookup tables are keyed by their first column, these are the exceptions
+# (lkpSeaState has a SeaStateID column, but the watch table stores the SeaState code itself)
+KEY_COLUMNS = {
+    'lkpSeaState': 'SeaState',
+}
+
+# Code ranges up to this size get a dense direct-address array, larger ranges (e.g. the random ObserverIDs) use a
+# binary search over the sorted codes instead
+DENSE_LIMIT = 100_000
+
+# Covariates derived from a code through a lookup relation: name -> (code column, lookup table, value column)
+RELATIONS = {
+    'SeaStateWindspeed': ('SeaState', 'lkpSeastateWindspeed', 'Windspeed'),
+    'BeaufortWindspeed': ('WindForce', 'lkpBeaufortWindspeed', 'Windspeed'),
+}
+
+
+class LookupTable:
+    """
+    One compiled lookup table: the sorted codes, each column reordered to match, and optionally a dense
+    code -> row array.
+    """
+
+    def __init__(self, name, frame, key):
+        self.name = name
+        self.key = key
+
+        frame = frame.dropna(subset=[key]).drop_duplicates(subset=[key])
+        self.numeric = pd.api.types.is_numeric_dtype(frame[key])
+        keys = frame[key].to_numpy(dtype=np.int64 if self.numeric else str)
+        order = np.argsort(keys, kind='stable')
+
+        self.codes = keys[order]
+        self.columns = {column: frame[column].to_numpy()[order] for column in frame.columns}
+
+        # a dense array maps (code - offset) straight to a row number, -1 marks codes that aren't in the table
+        self.dense = None
+        if self.numeric and len(self.codes) and self.codes[-1] - self.codes[0] < DENSE_LIMIT:
+            self.offset = self.codes[0]
+            self.dense = np.full(self.codes[-1] - self.offset + 1, -1, dtype=np.int64)
+            self.dense[self.codes - self.offset] = np.arange(len(self.codes))
+
+        # each column gets one extra slot at the end so that unknown codes (-1) take the fill value
+        self._padded = {}
+
+    def __len__(self):
+        return len(self.codes)
+
+    def index(self, values):
+        """Return the row number of each code in `values`, or -1 for missing and unknown codes."""
+        values = pd.Series(np.asarray(values).ravel())
+        out = np.full(len(values), -1, dtype=np.int64)
+
+        if self.numeric:
+            numbers = pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64)
+            valid = np.isfinite(numbers) & (numbers == np.round(numbers))
+            codes = numbers[valid].astype(np.int64)
+        else:
+            valid = values.notna().to_numpy()
+            codes = values[valid].astype(str).to_numpy(dtype=str)
+
+        if len(self.codes) == 0:
+            found = np.full(len(codes), -1, dtype=np.int64)
+        elif self.dense is not None:
+            relative = codes - self.offset
+            inside = (relative >= 0) & (relative < len(self.dense))
+            found = np.full(len(codes), -1, dtype=np.int64)
+            found[inside] = self.dense[relative[inside]]
+        else:
+            position = np.searchsorted(self.codes, codes).clip(0, len(self.codes) - 1)
+            found = np.where(self.codes[position] == codes, position, -1)
+
+        out[valid] = found
+        return out
+
+    def decode(self, values, column, fill=np.nan):
+        """Translate codes into the matching values of `column` with a single `take`."""
+        if (column, repr(fill)) not in self._padded:
+            data = self.columns[column]
+            self._padded[(column, repr(fill))] = np.append(data.astype(object) if data.dtype.kind in 'OUS' else data, fill)
+        decoded = np.take(self._padded[(column, repr(fill))], self.index(values))
+
+        # keep the index of a Series so the result can be assigned straight back onto its frame
+        if isinstance(values, pd.Series):
+            return pd.Series(decoded, index=values.index, name=column)
+        return decoded
+
+    def categorical(self, values, column=None):
+        """
+        Return the codes as a pandas Categorical over every code in the table (or over the labels in `column`),
+        so value counts and pivots include codes that were never used.
+        """
+        categories = self.codes if column is None else self.columns[column]
+        if len(pd.unique(categories)) != len(categories):
+            raise ValueError(f"{self.name}.{column} has duplicate values and can't be used as categories")
+        return pd.Categorical.from_codes(self.index(values), categories=categories)
+
+    @property
+    def dtype(self):
+        """The categorical dtype of the table's codes."""
+        return pd.CategoricalDtype(categories=self.codes)
+
+
+class LookupRegistry:
+    """
+    Compiles `lkp*` tables from the exported Excel files the first time each one is used, and keeps them for the rest
+    of the run.
+    """
+
+    def __init__(self, tables_dir=TABLES_DIR):
+        self.tables_dir = tables_dir
+        self._tables = {}
+
+    def __getitem__(self, name):
+        if name not in self._tables:
+            self.compile(name, pd.read_excel(os.path.join(self.tables_dir, f'{name}.xlsx')))
+        return self._tables[name]
+
+    def compile(self, name, frame):
+        """Compile a lookup table from a DataFrame that's already loaded."""
+        table = LookupTable(name, frame, KEY_COLUMNS.get(name, frame.columns[0]))
+        self._tables[name] = table
+        return table
+
+    def available(self):
+        """List the names of every lookup table exported to the tables folder."""
+        return sorted(f[:-5] for f in os.listdir(self.tables_dir) if f.startswith('lkp') and f.endswith('.xlsx'))
+
+    def decode(self, values, table, column, fill=np.nan):
+        return self[table].decode(values, column, fill=fill)
+
+    def add_covariates(self, frame, relations=None):
+        """Add the covariates in RELATIONS (e.g. SeaStateWindspeed) as new columns on a watch-level frame."""
+        frame = frame.copy()
+        for name in relations or RELATIONS:
+            code_column, table, value_column = RELATIONS[name]
+            if code_column in frame:
+                frame[name] = self.decode(frame[code_column], table, value_column)
+        return frame
+
+
+# The scripts share one registry per process, so each table is read from Excel at most once
+_registry = None
+
+
+def load_lookups(tables_dir=TABLES_DIR):
+    """Return the shared lookup registry for `tables_dir`."""
+    global _registry
+    if _registry is None or _registry.tables_dir != tables_dir:
+        _registry = LookupRegistry(tables_dir)
+    return _registry
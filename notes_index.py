@@ -0,0 +1,366 @@
+#####################################################
+###############   NOTES SEARCH INDEX    #############
+
+"""
+The observers' notes are only ever shown in the map popups (tblWatchNotes), and tblSightingNotes, tblCruiseNotes and the
+tblInc*Notes tables can't be searched at all, so questions like "which watches mention fishing vessels or an oil sheen"
+meant scrolling through the spreadsheets.
+
+Here I build an inverted index over every notes table when the relational store is built (store.py calls
+`build_index`), and save it next to the store in `cache/notes_index/`:
+
+- notes are split into lowercase words (letters and digits, so "in/out" is two words and "~400m" is "400m") and every
+  word is stemmed with a light English stemmer, so "vessels", "circling" and "observed" also find "vessel", "circle"
+  and "observe"
+- the vocabulary is a sorted array of the stemmed words; for each word the index holds the notes it appears in
+  (postings), and for each posting the word positions in the note, which phrase queries need
+- every note keeps the table it came from, its key (WatchID, SightingID or CruiseID) and its NoteID, so results can be
+  joined straight to tblWatch, tblSighting (SightingID is the FlockID there) or tblCruise
+
+All of it is written as plain NumPy arrays and opened memory-mapped, so a query is a few binary searches and slices
+and runs in milliseconds without loading the index into memory.
+
+Queries:
+
+    vessel fog              notes with both words (stemmed)
+    "oil sheen"             the phrase, words next to each other in this order
+    drill*                  any word starting with "drill" (drillmaxx, drilling, ...); the prefix is stemmed like the
+                            words, so "vessels*" finds "vessel" and "circle*" finds "circling"
+    -fog                    leave out notes with the word
+    "oil sheen" OR "fishing vessel"    either side of an uppercase OR
+
+    python notes_index.py '"oil sheen" OR "fishing vessel"' --key WatchID
+"""
+
+# load the required modules
+import argparse
+import json
+import os
+import re
+import time
+
+import numpy as np
+import pandas as pd
+
+from store import CACHE_DIR
+
+
+# Define the folder for the index
+INDEX_DIR = os.path.join(CACHE_DIR, 'notes_index')
+
+# Version of the index layout, bumped when it changes
+FORMAT_VERSION = 1
+
+# The notes tables and the key each note belongs to
+NOTE_TABLES = {
+    'tblWatchNotes': 'WatchID',
+    'tblSightingNotes': 'SightingID',
+    'tblCruiseNotes': 'CruiseID',
+    'tblIncWatchNotes': 'WatchID',
+    'tblIncSightingNotes': 'SightingID',
+}
+
+# Words are runs of letters and digits
+WORD = re.compile(r'[a-z0-9]+')
+
+# Phrase positions are packed next to the note number in one int64, so notes can't be longer than this many words
+MAX_POSITIONS = 2 ** 20
+
+
+###########################
+# Words
+
+def _has_vowel(word):
+    return any(letter in 'aeiouy' for letter in word)
+
+
+def stem(word):
+    """
+    Strip common English endings: plurals (-s, -es, -ies), -ing, -ed, -ly and a final -e.
+
+    Much lighter than a Porter stemmer, but the same word forms end up together in observer notes, and query words are
+    stemmed the same way as the notes.
+    """
+    if len(word) <= 3 or not word.isalpha():
+        return word
+    for suffix, replacement in (('sses', 'ss'), ('ies', 'y'), ('ss', 'ss'), ('s', '')):
+        if word.endswith(suffix):
+            word = word[:-len(suffix)] + replacement
+            break
+    for suffix in ('ing', 'ed'):
+        if word.endswith(suffix) and len(word) - len(suffix) >= 3 and _has_vowel(word[:-len(suffix)]):
+            word = word[:-len(suffix)]
+            # undouble a final consonant (stopped -> stop), but not in words like "fall"
+            if word[-1] == word[-2] and word[-1] not in 'aeiouylsz':
+                word = word[:-1]
+            break
+    if word.endswith('ly') and len(word) > 5:
+        word = word[:-2]
+    if word.endswith('e') and len(word) > 4:
+        word = word[:-1]
+    return word
+
+
+def tokenize(text, stemmed=True):
+    """Split a note into lowercase (stemmed) words."""
+    words = WORD.findall(str(text).lower())
+    return [stem(word) for word in words] if stemmed else words
+
+
+###########################
+# Building
+
+def _write(index_dir, name, values):
+    np.save(os.path.join(index_dir, f'{name}.npy'), values)
+
+
+def build_index(tables, index_dir=INDEX_DIR):
+    """
+    Build the index from the notes tables in `tables` (a dict of DataFrames, e.g. the sorted tables of the store) and
+    write it to `index_dir`. Tables that are missing are skipped.
+    """
+    os.makedirs(index_dir, exist_ok=True)
+    names = [name for name in NOTE_TABLES if name in tables]
+
+    doc_table, doc_key, doc_note_id, doc_row = [], [], [], []
+    terms, docs, positions = [], [], []
+    vocabulary, stems = {}, {}
+    for table_code, name in enumerate(names):
+        frame = tables[name]
+        notes = frame['Note'].to_numpy(dtype=object)
+        keys = pd.to_numeric(frame[NOTE_TABLES[name]], errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+        note_ids = pd.to_numeric(frame['NoteID'], errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+        for row, note in enumerate(notes):
+            if not isinstance(note, str) or not note.strip():
+                continue
+            doc = len(doc_key)
+            doc_table.append(table_code)
+            doc_key.append(keys[row])
+            doc_note_id.append(note_ids[row])
+            doc_row.append(row)
+            for position, word in enumerate(WORD.findall(note.lower())[:MAX_POSITIONS]):
+                # stemming is memoized, the same few thousand words come up over and over
+                stemmed = stems.get(word)
+                if stemmed is None:
+                    stemmed = stems[word] = stem(word)
+                terms.append(vocabulary.setdefault(stemmed, len(vocabulary)))
+                docs.append(doc)
+                positions.append(position)
+
+    # number the words in sorted order, so prefixes are found with a binary search
+    words = sorted(vocabulary)
+    renumber = np.empty(len(words), dtype=np.int64)
+    renumber[[vocabulary[word] for word in words]] = np.arange(len(words))
+    terms = renumber[np.asarray(terms, dtype=np.int64)] if terms else np.zeros(0, dtype=np.int64)
+    docs, positions = np.asarray(docs, dtype=np.int64), np.asarray(positions, dtype=np.int64)
+
+    # sort by word, note and position; each (word, note) pair is one posting, with its positions in a block
+    order = np.lexsort((positions, docs, terms))
+    terms, docs, positions = terms[order], docs[order], positions[order]
+    new_posting = np.ones(len(terms), dtype=bool)
+    new_posting[1:] = (terms[1:] != terms[:-1]) | (docs[1:] != docs[:-1])
+    posting_starts = np.flatnonzero(new_posting)
+
+    width = max((len(word) for word in words), default=1)
+    _write(index_dir, 'vocabulary', np.array(words, dtype=f'<U{width}'))
+    _write(index_dir, 'term_offsets', np.searchsorted(terms[posting_starts], np.arange(len(words) + 1)))
+    _write(index_dir, 'posting_doc', docs[posting_starts])
+    _write(index_dir, 'position_offsets', np.append(posting_starts, len(positions)))
+    _write(index_dir, 'positions', positions.astype(np.int32))
+    _write(index_dir, 'doc_table', np.asarray(doc_table, dtype=np.int8))
+    _write(index_dir, 'doc_key', np.asarray(doc_key, dtype=np.int64))
+    _write(index_dir, 'doc_note_id', np.asarray(doc_note_id, dtype=np.int64))
+    _write(index_dir, 'doc_row', np.asarray(doc_row, dtype=np.int64))
+
+    header = {'version': FORMAT_VERSION, 'tables': names, 'n_notes': len(doc_key), 'n_words': len(words),
+              'n_postings': len(posting_starts)}
+    with open(os.path.join(index_dir, 'header.json'), 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+    return header
+
+
+###########################
+# Searching
+
+class NotesIndex:
+    """Memory-mapped inverted index over the notes tables."""
+
+    ARRAYS = ('vocabulary', 'term_offsets', 'posting_doc', 'position_offsets', 'positions', 'doc_table', 'doc_key',
+              'doc_note_id', 'doc_row')
+
+    def __init__(self, index_dir=INDEX_DIR):
+        self.index_dir = index_dir
+        with open(os.path.join(index_dir, 'header.json')) as header_file:
+            self.header = json.load(header_file)
+        for name in self.ARRAYS:
+            setattr(self, name, np.load(os.path.join(index_dir, f'{name}.npy'), mmap_mode='r'))
+        self.tables = self.header['tables']
+
+    def __len__(self):
+        return self.header['n_notes']
+
+    # words -> notes
+
+    def _word_range(self, word):
+        """Range of vocabulary numbers matching a (stemmed) word."""
+        start = int(np.searchsorted(self.vocabulary, word))
+        if start < len(self.vocabulary) and self.vocabulary[start] == word:
+            return start, start + 1
+        return start, start
+
+    def _prefix_range(self, prefix):
+        """Range of vocabulary numbers starting with a prefix (the vocabulary is sorted, so it's one range)."""
+        return (int(np.searchsorted(self.vocabulary, prefix)),
+                int(np.searchsorted(self.vocabulary, prefix + '\U0010ffff')))
+
+    def _mask(self, notes):
+        """Boolean mask over all notes; combining masks is much faster than sorting large note lists."""
+        mask = np.zeros(len(self), dtype=bool)
+        mask[notes] = True
+        return mask
+
+    def _notes(self, first, last):
+        """Notes containing any of the words numbered first..last-1 (their postings are one contiguous slice)."""
+        postings = np.asarray(self.posting_doc[self.term_offsets[first]:self.term_offsets[last]])
+        return np.flatnonzero(self._mask(postings)) if last - first > 1 else postings
+
+    def _positions_in(self, word, candidates):
+        """Note numbers and positions of every occurrence of a word in the notes marked in `candidates`."""
+        first, last = self._word_range(word)
+        start, stop = int(self.term_offsets[first]), int(self.term_offsets[last])
+        postings = start + np.flatnonzero(candidates[np.asarray(self.posting_doc[start:stop])])
+        bounds, ends = np.asarray(self.position_offsets)[postings], np.asarray(self.position_offsets)[postings + 1]
+        lengths = ends - bounds
+        # position i of posting j is positions[bounds[j] + i]
+        within = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        notes = np.repeat(np.asarray(self.posting_doc)[postings], lengths)
+        return notes, np.asarray(self.positions)[np.repeat(bounds, lengths) + within].astype(np.int64)
+
+    def _phrase(self, words):
+        """Notes with the words next to each other in this order."""
+        ranges = [self._word_range(word) for word in words]
+        if any(first == last for first, last in ranges):
+            return np.zeros(0, dtype=np.int64)
+        # first the notes that have every word, starting from the rarest word, so only those notes' positions are read
+        rarest = sorted(ranges, key=lambda pair: self.term_offsets[pair[1]] - self.term_offsets[pair[0]])
+        notes = self._notes(*rarest[0])
+        for pair in rarest[1:]:
+            notes = notes[self._mask(self._notes(*pair))[notes]]
+        if len(words) == 1 or len(notes) == 0:
+            return notes
+
+        # each occurrence is packed as (note, position of the phrase start), and the phrase is where all words agree
+        candidates = self._mask(notes)
+        found = None
+        for offset, word in enumerate(words):
+            occurrences, positions = self._positions_in(word, candidates)
+            # postings are in note order and positions in order within a note, so `packed` is already sorted
+            packed = occurrences * MAX_POSITIONS + (positions - offset)
+            if found is None:
+                found = packed
+            elif len(packed):
+                found = found[packed[np.minimum(np.searchsorted(packed, found), len(packed) - 1)] == found]
+            else:
+                found = packed
+        return np.unique(found // MAX_POSITIONS)
+
+    # queries
+
+    def _clause(self, clause):
+        """Notes matching one clause: a quoted phrase, a prefix* or a word."""
+        if clause.startswith('"'):
+            return self._phrase(tokenize(clause.strip('"')))
+        if clause.endswith('*'):
+            # the vocabulary is stemmed, so the prefix is stemmed too ("vessels*" finds "vessel"); stemming only ever
+            # shortens a word, except -ies -> -y, where the notes of both prefixes are taken
+            prefix = clause[:-1].lower()
+            stemmed = stem(prefix)
+            if prefix.startswith(stemmed):
+                return self._notes(*self._prefix_range(stemmed))
+            return np.flatnonzero(self._mask(np.concatenate([self._notes(*self._prefix_range(stemmed)),
+                                                             self._notes(*self._prefix_range(prefix))])))
+        words = tokenize(clause)
+        # a clause like "in/out" splits into several words, which are searched as a phrase
+        return self._phrase(words) if words else np.zeros(0, dtype=np.int64)
+
+    def search(self, query):
+        """Return the sorted note numbers matching a query (see the module docstring for the syntax)."""
+        matches = []
+        for alternative in re.split(r'\s+OR\s+', query.strip()):
+            clauses = re.findall(r'-?"[^"]+"|\S+', alternative)
+            included = [clause for clause in clauses if not clause.startswith('-')]
+            excluded = [clause[1:] for clause in clauses if clause.startswith('-')]
+            if not included:
+                continue
+            notes = self._clause(included[0])
+            for clause in included[1:]:
+                notes = notes[self._mask(self._clause(clause))[notes]]
+            for clause in excluded:
+                notes = notes[~self._mask(self._clause(clause))[notes]]
+            matches.append(notes)
+        if len(matches) == 1:
+            return matches[0]
+        return np.flatnonzero(self._mask(np.concatenate(matches))) if matches else np.zeros(0, dtype=np.int64)
+
+    def results(self, notes, store=None):
+        """
+        Table, key column, key and NoteID of the matched notes; with a store, the note text is added as well.
+        """
+        notes = np.asarray(notes, dtype=np.int64)
+        tables = np.asarray(self.tables, dtype=object)[np.asarray(self.doc_table)[notes]]
+        frame = pd.DataFrame({
+            'Table': tables,
+            'KeyColumn': [NOTE_TABLES[name] for name in tables],
+            'Key': np.asarray(self.doc_key)[notes],
+            'NoteID': np.asarray(self.doc_note_id)[notes],
+        })
+        if store is not None:
+            rows = np.asarray(self.doc_row)[notes]
+            frame['Note'] = [store.table(name)['Note'].iat[row] for name, row in zip(tables, rows)]
+        return frame
+
+    def ids(self, query, key='WatchID'):
+        """Unique keys (WatchIDs, SightingIDs or CruiseIDs) of the notes matching a query."""
+        notes = self.search(query)
+        codes = [code for code, name in enumerate(self.tables) if NOTE_TABLES[name] == key]
+        keep = np.isin(np.asarray(self.doc_table)[notes], codes)
+        return np.unique(np.asarray(self.doc_key)[notes[keep]])
+
+
+def load_index(index_dir=INDEX_DIR):
+    """Open the index, building the store (which builds the index) or just the index first if it's missing."""
+    from store import load_store
+
+    store = load_store()
+    header_path = os.path.join(index_dir, 'header.json')
+    current = False
+    if os.path.exists(header_path):
+        with open(header_path) as header_file:
+            current = json.load(header_file).get('version') == FORMAT_VERSION
+    if not current:
+        build_index({name: store.table(name) for name in NOTE_TABLES
+                     if os.path.exists(os.path.join(store.store_dir, f'{name}.parquet'))}, index_dir)
+    return NotesIndex(index_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Search the watch, sighting and cruise notes.')
+    parser.add_argument('query', help='words, "phrases", prefix* and -excluded words, alternatives joined with OR')
+    parser.add_argument('--key', choices=sorted(set(NOTE_TABLES.values())), default=None,
+                        help='only print the unique ids of this kind')
+    args = parser.parse_args()
+
+    index = load_index()
+    start = time.perf_counter()
+    if args.key:
+        ids = index.ids(args.query, args.key)
+        elapsed = (time.perf_counter() - start) * 1000
+        print('\n'.join(str(value) for value in ids))
+        print(f"{len(ids)} {args.key}s in {elapsed:.1f} ms")
+    else:
+        notes = index.search(args.query)
+        elapsed = (time.perf_counter() - start) * 1000
+        from store import load_store
+        with pd.option_context('display.max_colwidth', 120, 'display.width', 200):
+            print(index.results(notes, load_store()).to_string(index=False))
+        print(f"{len(notes)} notes in {elapsed:.1f} ms")
@@ -18,32 +18,34 @@ If you hover over each of the pie chart's you will see the description for each
 import pandas as pd
 import plotly.graph_objects as go
 from plotly.subplots import make_subplots
+from lookups import load_lookups
+from pipeline import load_input
+from instrumentation import stage
+from html_output import write_html
 
 # Define file paths using raw string literals
 stationary_survey_path = r'data/stationary_platform_data.xlsx'
 
 # Load the stationary survey data
-stationary_survey = pd.read_excel(stationary_survey_path)
+stationary_survey = load_input('stationary_survey', stationary_survey_path)
 
-# load the metadata files for weather, sea state, and glare
-sea_state = pd.read_excel('ECSAS_tables\\lkpSeaState.xlsx')
-weather = pd.read_excel('ECSAS_tables\\lkpWeather.xlsx')
-glare = pd.read_excel('ECSAS_tables\\lkpGlare.xlsx')
+# load the compiled lookup tables for weather, sea state, and glare
+lookups = load_lookups()
 
 # aggregate the most common Weather, SeaState, and Glare codes for the entire trip
 weather_counts = stationary_survey['Weather'].value_counts()
 sea_state_counts = stationary_survey['SeaState'].value_counts()
 glare_counts = stationary_survey['Glare'].value_counts()
 
-# convert to a df for merging
+# convert to a df so the descriptive labels can be added as a column
 weather_df = pd.DataFrame({'Code': weather_counts.index, 'Count': weather_counts.values})
 sea_state_df = pd.DataFrame({'Code': sea_state_counts.index, 'Count': sea_state_counts.values})
 glare_df = pd.DataFrame({'Code': glare_counts.index, 'Count': glare_counts.values})
 
-# merge with the metadata to get descriptive labels
-weather_df = weather_df.merge(weather, left_on='Code', right_on='Weather', how='left')
-sea_state_df = sea_state_df.merge(sea_state, left_on='Code', right_on='SeaState', how='left')
-glare_df = glare_df.merge(glare, left_on='Code', right_on='Glare', how='left')
+# decode the codes into their descriptive labels with the lookup tables
+weather_df['WeatherText'] = lookups.decode(weather_df['Code'], 'lkpWeather', 'WeatherText', fill='')
+sea_state_df['SeaStateText'] = lookups.decode(sea_state_df['Code'], 'lkpSeaState', 'SeaStateText', fill='')
+glare_df['GlareText'] = lookups.decode(glare_df['Code'], 'lkpGlare', 'GlareText', fill='')
 
 # use this small function to manually adjust the hover text and avoid cutting off any words incorrectly
 def format_hover_text(code, count, text, max_length=30):
@@ -124,5 +126,6 @@ fig.update_layout(
     title_text="Figure 2. Weather, glare and sea state codes used by the observer most during the cruise period (May 12 - May 29)",
     )
 
-# Save the figure as an HTML file
-fig.write_html('figures/pie_charts.html')
+# Save the figure as an HTML file that loads the shared plotly.js (see html_output.py)
+with stage('write'):
+    write_html(fig, 'figures/pie_charts.html')
@@ -0,0 +1,389 @@
+#####################################################
+###############   ANALYSIS PIPELINE    ##############
+
+"""
+Each analysis used to be a separate script run by hand, and every one of them read the survey data from Excel again.
+
+Here I declare the whole analysis as stages with dependencies:
+
+    ingest -> merge -> metrics, map, heatmaps, pies, gam, visibility
+    ingest -> figures
+
+- `ingest` copies the exported Access tables into the relational store (store.py)
+- `merge` joins watches, sightings and species and splits stationary and moving platforms (as in preprocessing.py)
+- `export` (only when asked for) writes the merged data to `data/` as Parquet, so the scripts can be run on their own
+- the analysis stages run the existing scripts, handing them the merged data that's already in memory
+- `figures` renders the per-cruise and per-species figures in parallel (render.py)
+
+Stages run on a process pool as soon as the stages they depend on are done, so independent analyses run at the same time.
+Each stage gets a fingerprint made from its code (its scripts and every repository module they import), its input files
+and the fingerprints of the stages it depends on. A stage is only re-run when its fingerprint changed or one of its
+outputs is missing; otherwise its saved result is reused.
+
+Run everything with:
+
+    python pipeline.py
+
+or only some stages (plus whatever they depend on) with `python pipeline.py map gam`, e.g. `python pipeline.py export`.
+"""
+
+# load the required modules
+import argparse
+import ast
+import functools
+import glob
+import hashlib
+import json
+import os
+import pickle
+import runpy
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import instrumentation
+from store import CACHE_DIR, TABLES_DIR
+
+
+# Define the repository folder (scripts are run from here so their relative paths work) and the pipeline cache
+ROOT = os.path.dirname(os.path.abspath(__file__))
+PIPELINE_DIR = os.path.join(CACHE_DIR, 'pipeline')
+STATE_PATH = os.path.join(PIPELINE_DIR, 'state.json')
+PROFILES_DIR = os.path.join(PIPELINE_DIR, 'profiles')
+
+# Folder the merged data is exported to for running the scripts on their own
+EXPORT_DIR = 'data'
+
+# Columns dropped from the merged data, as in preprocessing.py
+COLUMNS_TO_EXCLUDE = ['Key', 'OldWatchID', 'Kilometers', 'PlatformDir', 'PlatformDirDeg', 'OldFlockID', 'OldPiropID']
+
+
+###########################
+# Sharing data with scripts
+
+# Inputs handed to a script by the pipeline, keyed by the script's variable name
+_shared_inputs = {}
+
+
+def load_input(name, path, loader=None):
+    """
+    Return the input `name` if the pipeline handed it in, otherwise read it from `path`.
+
+    Scripts use this instead of reading their data directly, so they still work on their own but don't re-read anything
+    when they run as a pipeline stage. A copy is returned so a script can't change the data seen by another stage.
+    On their own, the Parquet copy of `path` written by the `export` stage is read when there is one.
+    """
+    with instrumentation.stage('load') as record:
+        if name in _shared_inputs:
+            data = _shared_inputs[name].copy()
+        else:
+            import pandas as pd
+            exported = os.path.join(EXPORT_DIR, f'{name}.parquet')
+            if loader is None and os.path.exists(exported):
+                data = pd.read_parquet(exported)
+            else:
+                data = (loader or pd.read_excel)(path)
+        record.rows_out = instrumentation.count_rows(data)
+    return data
+
+
+def run_script(script, **inputs):
+    """Run one of the analysis scripts with `inputs` shared to it through `load_input`."""
+    _shared_inputs.clear()
+    _shared_inputs.update(inputs)
+    try:
+        runpy.run_path(os.path.join(ROOT, script), run_name='__main__')
+    finally:
+        _shared_inputs.clear()
+
+
+###########################
+# Stage functions
+
+def ingest():
+    """
+    Build the relational store from the exported tables. The runner only runs this stage when the exports or the
+    ingest code changed, so the store is always rebuilt here rather than reused by `load_store`, which only notices
+    changed exports.
+    """
+    from store import build_store
+    return build_store(TABLES_DIR).store_dir
+
+
+def merge(ingest):
+    """Join watches, sightings and species info and split stationary (class 2) and moving (class 3) platforms."""
+    from store import RelationalStore
+
+    with instrumentation.stage('merge') as record:
+        final_df = RelationalStore(ingest).watch_sightings()
+        final_df['Count'] = final_df['Count'].fillna(0)
+        final_df = final_df.drop(columns=COLUMNS_TO_EXCLUDE, errors='ignore')
+
+        surveys = {
+            'moving_survey': final_df[final_df['PlatformClass'] == 3].reset_index(drop=True),
+            'stationary_survey': final_df[final_df['PlatformClass'] == 2].reset_index(drop=True),
+        }
+        record.rows_out = len(final_df)
+    return surveys
+
+
+def export(merge):
+    """Write the merged survey data to EXPORT_DIR, where `load_input` finds it when a script runs on its own."""
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    with instrumentation.stage('write', rows_in=instrumentation.count_rows(merge)):
+        for name, survey in merge.items():
+            survey.to_parquet(os.path.join(EXPORT_DIR, f'{name}.parquet'), index=False)
+    return sorted(merge)
+
+
+def figures(ingest):
+    """Render the per-cruise and per-species figures on a process pool (see render.py)."""
+    from render import render_all
+    return render_all()
+
+
+def _script_stage(script, merge):
+    run_script(script, **merge)
+
+
+def script_stage(script):
+    """Make a stage that runs an analysis script with the merged survey data."""
+    # a partial of a module-level function can be sent to a worker process, a nested function can't
+    return functools.partial(_script_stage, script)
+
+
+###########################
+# The stage graph
+
+class Stage:
+    """One step of the pipeline: what it runs, which stages it needs, and the files it reads and writes."""
+
+    def __init__(self, name, function, deps=(), inputs=(), outputs=(), code=(), optional=False):
+        self.name = name
+        self.function = function
+        self.deps = list(deps)
+        self.inputs = list(inputs)
+        self.outputs = list(outputs)
+        self.code = list(code)
+        # optional stages only run when they're asked for by name
+        self.optional = optional
+
+
+STAGES = [
+    Stage('ingest', ingest,
+          inputs=[os.path.join(TABLES_DIR, '*.xlsx'), os.path.join(TABLES_DIR, '*.parquet')],
+          code=['store.py', 'survey_arrays.py', 'validation.py', 'notes_index.py', 'lookups.py']),
+    Stage('merge', merge, deps=['ingest'], code=['store.py']),
+    Stage('export', export, deps=['merge'], optional=True,
+          outputs=[os.path.join(EXPORT_DIR, f'{name}.parquet') for name in ('stationary_survey', 'moving_survey')]),
+    Stage('metrics', script_stage('basic-metrics.py'), deps=['merge'],
+          code=['basic-metrics.py', 'species_accumulation.py']),
+    Stage('map', script_stage('interactive_map.py'), deps=['merge'],
+          outputs=['figures/survey_map.html'], code=['interactive_map.py', 'lookups.py', 'temporal.py']),
+    Stage('heatmaps', script_stage('heatmaps.py'), deps=['merge'],
+          outputs=['figures/heatmaps.png'], code=['heatmaps.py', 'lookups.py', 'lazy_query.py']),
+    Stage('pies', script_stage('pie-chart.py'), deps=['merge'],
+          outputs=['figures/pie_charts.html'], code=['pie-chart.py', 'lookups.py', 'html_output.py']),
+    Stage('gam', script_stage('GAM_scatter.py'), deps=['merge'],
+          outputs=['figures/interactive_scatter_plot.html', 'sorted_species_avg.csv'],
+          code=['GAM_scatter.py', 'temporal.py', 'html_output.py']),
+    Stage('visibility', script_stage('visibility.py'), deps=['merge'],
+          outputs=['figures/visibility_vs_total_counts.png'], code=['visibility.py', 'render.py']),
+    Stage('figures', figures, deps=['ingest'],
+          outputs=['figures/cruises', 'figures/species'], code=['render.py', 'survey_arrays.py', 'temporal.py']),
+]
+
+
+def _file_signature(pattern):
+    """Size and modification time of every file matching `pattern` (cheap to check, changes whenever a file is saved)."""
+    return [(path, os.path.getsize(path), os.path.getmtime(path)) for path in sorted(glob.glob(pattern))]
+
+
+@functools.lru_cache(maxsize=None)
+def _imported_modules(path):
+    """The repository modules a file imports (anywhere in it, so imports inside functions count too)."""
+    with open(os.path.join(ROOT, path), 'rb') as code_file:
+        tree = ast.parse(code_file.read())
+    modules = set()
+    for node in ast.walk(tree):
+        if isinstance(node, ast.Import):
+            modules.update(alias.name for alias in node.names)
+        elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+            modules.add(node.module)
+    return sorted(f'{module}.py' for module in {name.split('.')[0] for name in modules}
+                  if os.path.isfile(os.path.join(ROOT, f'{module}.py')))
+
+
+def code_files(paths):
+    """`paths` plus every repository module they import, directly or through other modules."""
+    found, queue = set(), list(paths)
+    while queue:
+        path = queue.pop()
+        if path not in found:
+            found.add(path)
+            queue.extend(_imported_modules(path))
+    return sorted(found)
+
+
+def fingerprint(stage, dep_fingerprints):
+    """Hash a stage's code (with the modules it imports), input files and upstream fingerprints into one fingerprint."""
+    digest = hashlib.sha256(stage.name.encode())
+    for path in code_files(stage.code + [os.path.basename(__file__)]):
+        with open(os.path.join(ROOT, path), 'rb') as code_file:
+            digest.update(code_file.read())
+    for pattern in stage.inputs:
+        digest.update(json.dumps(_file_signature(pattern)).encode())
+    for dep in stage.deps:
+        digest.update(dep_fingerprints[dep].encode())
+    return digest.hexdigest()
+
+
+def _select(stages, wanted):
+    """Return the stages in `wanted` (every stage that isn't optional by default) plus everything they depend on."""
+    by_name = {stage.name: stage for stage in stages}
+    needed = set()
+
+    def visit(name):
+        if name not in by_name:
+            raise KeyError(f"Unknown stage {name!r}, choose from {', '.join(by_name)}")
+        if name not in needed:
+            needed.add(name)
+            for dep in by_name[name].deps:
+                visit(dep)
+
+    for name in wanted or [stage.name for stage in stages if not stage.optional]:
+        visit(name)
+    return [stage for stage in stages if stage.name in needed]
+
+
+def _result_path(name):
+    return os.path.join(PIPELINE_DIR, f'{name}.pkl')
+
+
+def _run_stage(name, function, kwargs, trace_memory=False, profile_path=None):
+    """Run one stage in a worker process, measured (see instrumentation.py) and optionally profiled."""
+    os.chdir(ROOT)
+    instrumentation.configure(trace_memory)
+    instrumentation.collect()
+    with instrumentation.stage(name, rows_in=instrumentation.count_rows(kwargs)) as record:
+        if profile_path:
+            result = instrumentation.profiled(profile_path, function, **kwargs)
+        else:
+            result = function(**kwargs)
+        record.rows_out = instrumentation.count_rows(result)
+    return result, instrumentation.collect()
+
+
+###########################
+# Running the pipeline
+
+def run(wanted=None, force=False, max_workers=None, stages=STAGES, trace_memory=False, profile=False):
+    """
+    Run the pipeline, re-running only the stages whose fingerprint changed. Returns {stage name: status}, where the
+    status is 'ran', 'cached', 'failed' or 'skipped' (a stage it depends on failed).
+
+    Every stage that runs is measured and a JSON report of the run is written to cache/pipeline/reports (see
+    instrumentation.py). `trace_memory` adds tracemalloc peaks, `profile` keeps a cProfile dump of the hottest stage.
+    """
+    os.chdir(ROOT)
+    os.makedirs(PIPELINE_DIR, exist_ok=True)
+    selected = _select(stages, wanted)
+
+    # every stage runs headless: matplotlib draws off-screen and never waits on a window
+    os.environ.setdefault('MPLBACKEND', 'Agg')
+
+    state = {}
+    if os.path.exists(STATE_PATH):
+        with open(STATE_PATH) as state_file:
+            state = json.load(state_file)
+
+    fingerprints, results, status = {}, {}, {}
+    records, profiles = [], {}
+    for stage in selected:
+        fingerprints[stage.name] = fingerprint(stage, fingerprints)
+
+    def up_to_date(stage):
+        return (not force
+                and state.get(stage.name) == fingerprints[stage.name]
+                and all(os.path.exists(path) for path in stage.outputs)
+                and os.path.exists(_result_path(stage.name)))
+
+    def load_result(name):
+        if name not in results:
+            with open(_result_path(name), 'rb') as result_file:
+                results[name] = pickle.load(result_file)
+        return results[name]
+
+    pending = {stage.name: stage for stage in selected}
+    running = {}
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        while pending or running:
+
+            # start every stage whose dependencies are finished
+            for name, stage in list(pending.items()):
+                if any(status.get(dep) in ('failed', 'skipped') for dep in stage.deps):
+                    status[name] = 'skipped'
+                    del pending[name]
+                    continue
+                if not all(status.get(dep) in ('ran', 'cached') for dep in stage.deps):
+                    continue
+
+                del pending[name]
+                if up_to_date(stage):
+                    status[name] = 'cached'
+                    print(f"[{name}] up to date")
+                    continue
+
+                kwargs = {dep: load_result(dep) for dep in stage.deps}
+                if profile:
+                    profiles[name] = os.path.join(PROFILES_DIR, f'{name}.prof')
+                running[pool.submit(_run_stage, name, stage.function, kwargs, trace_memory,
+                                    profiles.get(name))] = stage
+                print(f"[{name}] started")
+
+            if not running:
+                continue
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage = running.pop(future)
+                try:
+                    result, stage_records = future.result()
+                except Exception as error:
+                    status[stage.name] = 'failed'
+                    state.pop(stage.name, None)
+                    records.append({'name': stage.name, 'status': 'failed', 'error': repr(error)})
+                    print(f"[{stage.name}] failed: {error!r}")
+                    continue
+
+                records.extend(stage_records)
+                seconds = stage_records[-1]['wall_s']
+                results[stage.name] = result
+                with open(_result_path(stage.name), 'wb') as result_file:
+                    pickle.dump(result, result_file)
+                state[stage.name] = fingerprints[stage.name]
+                status[stage.name] = 'ran'
+                print(f"[{stage.name}] finished in {seconds:.1f} s")
+
+    with open(STATE_PATH, 'w') as state_file:
+        json.dump(state, state_file, indent=2)
+
+    report = instrumentation.write_report(records, status, profiles, trace_memory=trace_memory)
+    print(f"Run report written to {report}")
+    return status
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the ECSAS analysis pipeline.')
+    parser.add_argument('stages', nargs='*', help='stages to run (default: all), their dependencies are included')
+    parser.add_argument('--force', action='store_true', help='re-run stages even if nothing changed')
+    parser.add_argument('--workers', type=int, default=None, help='number of worker processes')
+    parser.add_argument('--trace-memory', action='store_true', help='record tracemalloc peaks (slower)')
+    parser.add_argument('--profile', action='store_true', help='keep a cProfile dump of the hottest stage')
+    args = parser.parse_args()
+
+    # run through the imported module, so the scripts and the workers share the same `load_input` state
+    from pipeline import run
+
+    status = run(args.stages, force=args.force, max_workers=args.workers, trace_memory=args.trace_memory,
+                 profile=args.profile)
+    print(json.dumps(status, indent=2))
@@ -15,6 +15,7 @@ Here I connect to the Access database using a driver, and I perfrom two tasks:
 import os
 import pandas as pd
 import pyodbc
+from store import build_store
 
 
 # Define the output directory if it exists already using a raw string (r)
@@ -144,23 +145,22 @@ Here I draw data from the following tables to create final datasets:
 - `lkpPlatformClass.xlsx` contains metadata on stationary vs moving platform surveys
     
 - `tblSpeciesInfo.xlsx` contains info on the Latin, English and Alpha codes for seabird species (SpecInfoID)
-"""
 
-# Start by reading the Excel files into their own pandas df
-watch_df = pd.read_excel(os.path.join(output_directory, 'tblWatch.xlsx'))
-sighting_df = pd.read_excel(os.path.join(output_directory, 'tblSighting.xlsx'))
-species_info_df = pd.read_excel(os.path.join(output_directory, 'tblSpeciesInfo.xlsx'))
-platform_class_df = pd.read_excel(os.path.join(output_directory, 'lkpPlatformClass.xlsx'))
+Instead of merging the tables directly, I first copy them into a relational store (see `store.py`), where tblWatch is
+sorted by CruiseID and WatchID and tblSighting is sorted in the same watch order. Each watch's sightings are then one
+contiguous block, so joining them is just repeating each watch row by the size of its block (a merge-join), and the
+species info is looked up by binary search on the sorted SpecInfoID.
+"""
 
-# First, merge watch_df with sighting_df on WatchID to retain all WatchID entries
-merged_sighting_df = pd.merge(watch_df, sighting_df, on='WatchID', how='left')
+# Start by copying the Excel files into the sorted store
+store = build_store(output_directory)
 
-# Before merging more file together, let's see what this looks like
-merged_sighting_df
+# First, join the watches with their sightings (and species info) to retain all WatchID entries
+merged_sighting_df = store.watch_sightings()
 
 # inspect those columns or just refer to the list of tables we made at the beginning
-print(watch_df.columns)
-print(sighting_df.columns)
+print(store.watches.columns)
+print(store.sightings.columns)
 
 
 """We can see there are many NaN values in the dataset, this is because some watch periods had no seabird sightings, 
@@ -168,15 +168,15 @@ so the sightings file does not contain those unique Watch IDs. This results in a
 We can take those NaN values and represent them as 0 values to denote that no birds were found during those watch periods."""
 
 # Fill NaN values in Count column with 0
+# (sightings with a missing or negative Count were already quarantined when the store was built, see validation.py,
+# so only the watches without sightings are filled here)
 merged_sighting_df['Count'].fillna(0, inplace=True)
 
 # Now we can see our count values are filled in accordingly
 print(merged_sighting_df[['Count']])
 
-# Now we can finish merging our main file with some other important files here
-
-# Merge with species_info_df based on SpecInfoID
-final_df = pd.merge(merged_sighting_df, species_info_df, on='SpecInfoID', how='left')
+# The species info (Latin, English and Alpha codes) was already joined by the store
+final_df = merged_sighting_df
 
 
 #################
@@ -0,0 +1,650 @@
+#####################################################
+###############   QUERY SERVICE    ##################
+
+"""
+Every question about the survey meant running a script that writes a static HTML or PNG file into `figures/`, which
+takes a minute or more each time.
+
+Here I serve the answers over HTTP instead, from a small asyncio server that runs on the local machine:
+
+    GET /species?cruise=&platform_class=&start=&end=         counts, sightings and watches per species, plus effort
+    GET /cruises                                            one summary row per cruise
+    GET /crosstab?row=Weather&col=SeaState&value=count      survey conditions against each other (count, watches,
+                                                            mean or sightings), optionally for one species
+    GET /density?species=NOFU&cell_deg=0.1                  counts summed into lat/lon grid cells
+    GET /tiles/{z}/{x}/{y}.geojson                          vector map tile: the watches in a web map tile
+    GET /tiles/{z}/{x}/{y}.png                              raster map tile: the counts drawn as a heat layer
+    GET /                                                   a Leaflet map of the raster tiles
+    GET /health                                             data version and cache statistics
+
+The filters `cruise`, `platform_class`, `species`, `start` and `end` (YYYY-MM-DD) work on every endpoint except
+/cruises. Everything is answered from the memory-mapped survey arrays (survey_arrays.py) and a few watch-level columns
+(conditions, total count per watch) loaded once when the service starts, so no request reads the Excel export or
+builds a DataFrame of the whole survey.
+
+- responses are kept in an in-memory LRU cache (RESPONSE_CACHE_ENTRIES responses, up to RESPONSE_CACHE_MB), so
+  repeated dashboard requests are answered without recomputing anything
+- requests are computed on a thread pool so the event loop keeps accepting connections while numpy works, and when
+  several clients ask for the same thing at once it's computed only once
+- when the store is rebuilt (new data), the service reloads the arrays and empties the cache on the next request
+
+    python query_service.py --port 8765
+    python query_service.py bench --requests 400 --concurrency 16   # latency of a mix of requests
+"""
+
+# load the required modules
+import argparse
+import asyncio
+import collections
+import io
+import json
+import math
+import os
+import statistics
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import parse_qsl, urlsplit
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from survey_arrays import ARRAYS_DIR, NAT, grid_totals, open_arrays
+
+
+# Default address of the service
+HOST = '127.0.0.1'
+PORT = 8765
+
+# Size of the response cache and the number of threads computing responses
+RESPONSE_CACHE_ENTRIES = 1_024
+RESPONSE_CACHE_MB = 128
+WORKERS = 4
+
+# Survey conditions that can be cross-tabulated, with the lookup table and column of their labels
+CONDITIONS = {
+    'Weather': ('lkpWeather', 'WeatherText'),
+    'SeaState': ('lkpSeaState', 'SeaStateText'),
+    'Glare': ('lkpGlare', 'GlareText'),
+    'WindForce': ('lkpWindForce', 'WindForceText'),
+    'Visibility': None,
+}
+
+# Map tiles are the usual 256 pixel web mercator (XYZ) tiles
+TILE_SIZE = 256
+MAX_ZOOM = 18
+
+# Longest time a client may take to send its request headers, in seconds
+REQUEST_TIMEOUT = 30
+
+
+###########################
+# Survey data
+
+class QueryError(ValueError):
+    """A request the service can't answer (sent back as a 400 response)."""
+
+
+class SurveyData:
+    """
+    The arrays and watch-level columns every response is computed from. Read-only once loaded, so any number of
+    threads can use it at the same time.
+    """
+
+    def __init__(self, arrays_dir=ARRAYS_DIR):
+        from lookups import load_lookups
+        from store import load_store
+
+        self.store = load_store()
+        self.arrays = open_arrays(arrays_dir)
+        self.version = os.path.getmtime(os.path.join(arrays_dir, 'header.json'))
+        self.lookups = load_lookups()
+
+        arrays = self.arrays
+        self.watch_row = np.asarray(arrays.watch_row)
+        self.has_watch = self.watch_row >= 0
+        self.watch_totals = arrays.watch_totals()
+        self.cruise_ids, self.cruise_index = np.unique(np.asarray(arrays.cruise_id), return_inverse=True)
+        start_ns = np.asarray(arrays.start_ns)
+        # dates as days since 1970, so a date range is two integer comparisons
+        self.start_day = np.where(start_ns != NAT, start_ns // (86_400 * 10 ** 9), NAT)
+
+        # the condition columns are read from the stored watch table, only those columns
+        stored = pq.read_schema(os.path.join(self.store.store_dir, 'tblWatch.parquet')).names
+        watches = self.store.table('tblWatch', columns=[name for name in CONDITIONS if name in stored])
+        self.conditions = {name: pd.to_numeric(watches[name], errors='coerce').to_numpy(dtype=np.float64)
+                           for name in watches.columns}
+
+    # filters
+
+    def watch_mask(self, params):
+        """Boolean mask of the watches passing the cruise, platform class and date filters."""
+        arrays = self.arrays
+        mask = np.ones(arrays.n_watches, dtype=bool)
+        if 'cruise' in params:
+            mask &= np.asarray(arrays.cruise_id) == _int(params, 'cruise')
+        if 'platform_class' in params:
+            mask &= np.asarray(arrays.platform_class) == _int(params, 'platform_class')
+        for name, keep in (('start', np.greater_equal), ('end', np.less_equal)):
+            if name in params:
+                try:
+                    day = pd.Timestamp(params[name]).value // (86_400 * 10 ** 9)
+                except ValueError:
+                    raise QueryError(f"{name} must be a date (YYYY-MM-DD), not {params[name]!r}")
+                mask &= (self.start_day != NAT) & keep(self.start_day, day)
+        return mask
+
+    def species_code(self, params):
+        """Species code of the `species` filter, or None without one."""
+        if 'species' not in params:
+            return None
+        code = self.arrays.species_index(params['species'].upper())
+        if code < 0:
+            raise QueryError(f"Unknown species {params['species']!r}")
+        return code
+
+    def sighting_mask(self, watch_mask, species_code=None):
+        """Sightings of the watches in `watch_mask` (and of one species)."""
+        mask = self.has_watch & watch_mask[np.maximum(self.watch_row, 0)]
+        if species_code is not None:
+            mask &= np.asarray(self.arrays.species_code) == species_code
+        return mask
+
+    def totals(self, watch_mask, species_code=None):
+        """Total count per watch (of one species) for the watches in `watch_mask`."""
+        if species_code is None:
+            return self.watch_totals[watch_mask]
+        return self.arrays.watch_totals(species_code)[watch_mask]
+
+    # endpoints
+
+    def species(self, params):
+        from cluster import partial_metrics
+
+        watch_mask = self.watch_mask(params)
+        species_code = self.species_code(params)
+        metrics = partial_metrics(self.arrays, watch_mask, None)
+        species = metrics['species'].sort_values('Count', ascending=False)
+        if species_code is not None:
+            species = species.loc[species.index == params['species'].upper()]
+        return {
+            'filters': params,
+            'effort': metrics['effort'],
+            'species': [{'Alpha': alpha, **row} for alpha, row in species.to_dict('index').items()],
+        }
+
+    def cruises(self, params):
+        arrays = self.arrays
+        n = len(self.cruise_ids)
+        sightings = self.has_watch
+        cruise_of_sighting = self.cruise_index[self.watch_row[sightings]]
+        codes = np.asarray(arrays.species_code)[sightings]
+        start_ns = np.asarray(arrays.start_ns)
+        timed = start_ns != NAT
+
+        # first and last watch of every cruise, from the timed watches sorted by cruise and time
+        first = np.full(n, NAT)
+        last = np.full(n, NAT)
+        order = np.lexsort((start_ns[timed], self.cruise_index[timed]))
+        timed_cruises, timed_starts = self.cruise_index[timed][order], start_ns[timed][order]
+        bounds = np.searchsorted(timed_cruises, np.arange(n + 1))
+        has_times = bounds[1:] > bounds[:-1]
+        first[has_times] = timed_starts[bounds[:-1][has_times]]
+        last[has_times] = timed_starts[bounds[1:][has_times] - 1]
+
+        species_pairs = np.unique(cruise_of_sighting.astype(np.int64) * (len(arrays.species) + 1) + codes + 1)
+        cruise_rows = self.store.cruise_rows(self.cruise_ids)
+        cruise_table = self.store.cruises
+        platforms = self.lookups.decode(cruise_table['PlatformName'].to_numpy()[np.maximum(cruise_rows, 0)],
+                                        'lkpPlatform', 'PlatformText')
+        return {'cruises': [
+            {
+                'CruiseID': int(self.cruise_ids[i]),
+                'Platform': platforms[i] if cruise_rows[i] >= 0 and pd.notnull(platforms[i]) else None,
+                'Watches': int(count),
+                'Sightings': int(n_sightings),
+                'TotalCount': float(total),
+                'EffortMinutes': float(effort),
+                'Species': int(n_species),
+                'FirstWatch': _iso(first[i]),
+                'LastWatch': _iso(last[i]),
+            }
+            for i, (count, n_sightings, total, effort, n_species) in enumerate(zip(
+                np.bincount(self.cruise_index, minlength=n),
+                np.bincount(cruise_of_sighting, minlength=n),
+                np.bincount(self.cruise_index, weights=self.watch_totals, minlength=n),
+                np.bincount(self.cruise_index, weights=np.nan_to_num(np.asarray(arrays.effort_min)), minlength=n),
+                np.bincount(species_pairs // (len(arrays.species) + 1), minlength=n),
+            ))
+        ]}
+
+    def crosstab(self, params):
+        row, col = params.get('row', 'Weather'), params.get('col', 'SeaState')
+        for name in (row, col):
+            if name not in self.conditions:
+                raise QueryError(f"Unknown condition {name!r}, choose from {', '.join(self.conditions)}")
+        value = params.get('value', 'count')
+        if value not in ('count', 'watches', 'mean', 'sightings'):
+            raise QueryError("value must be count, watches, mean or sightings")
+
+        watch_mask = self.watch_mask(params)
+        species_code = self.species_code(params)
+        frame = pd.DataFrame({'row': self.conditions[row][watch_mask], 'col': self.conditions[col][watch_mask]})
+        if value == 'sightings':
+            sightings = self.sighting_mask(watch_mask, species_code)
+            frame['value'] = np.bincount(self.watch_row[sightings], minlength=self.arrays.n_watches)[watch_mask]
+        else:
+            frame['value'] = self.totals(watch_mask, species_code)
+        aggregate = {'count': 'sum', 'sightings': 'sum', 'watches': 'size', 'mean': 'mean'}[value]
+        table = frame.pivot_table(index='row', columns='col', values='value', aggfunc=aggregate, fill_value=0)
+
+        return {
+            'filters': params,
+            'value': value,
+            'row': {'name': row, 'codes': table.index.tolist(), 'labels': self._labels(row, table.index)},
+            'col': {'name': col, 'codes': table.columns.tolist(), 'labels': self._labels(col, table.columns)},
+            'table': table.to_numpy().tolist(),
+        }
+
+    def _labels(self, condition, codes):
+        if CONDITIONS.get(condition) is None:
+            return [f'{code:g}' for code in codes]
+        table, column = CONDITIONS[condition]
+        labels = self.lookups.decode(np.asarray(codes), table, column)
+        return [label if pd.notnull(label) else f'{code:g}' for code, label in zip(codes, labels)]
+
+    def density(self, params):
+        cell_deg = _float(params, 'cell_deg', 0.1)
+        if not 0.001 <= cell_deg <= 10:
+            raise QueryError("cell_deg must be between 0.001 and 10")
+        sightings = self.sighting_mask(self.watch_mask(params), self.species_code(params))
+        rows = self.watch_row[sightings]
+        grid, corner = grid_totals(np.asarray(self.arrays.lat_start)[rows], np.asarray(self.arrays.lon_start)[rows],
+                                   np.asarray(self.arrays.count)[sightings], cell_deg)
+        cells = np.argwhere(grid > 0)
+        return {
+            'filters': params,
+            'cell_deg': cell_deg,
+            'corner': [None if np.isnan(value) else float(value) for value in corner],
+            'shape': list(grid.shape),
+            # only the cells with counts: [row, column, total], rows counted north from the corner
+            'cells': [[int(r), int(c), float(grid[r, c])] for r, c in cells],
+        }
+
+    # tiles
+
+    def _tile_watches(self, z, x, y, params):
+        """Watches (and their totals) inside tile z/x/y, with their pixel position in the tile."""
+        if not (0 <= z <= MAX_ZOOM and 0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            raise QueryError(f"No tile {z}/{x}/{y}")
+        watch_mask = self.watch_mask(params)
+        lat, lon = np.asarray(self.arrays.lat_start), np.asarray(self.arrays.lon_start)
+        west, north = _tile_corner(z, x, y)
+        east, south = _tile_corner(z, x + 1, y + 1)
+        inside = watch_mask & (lon >= west) & (lon < east) & (lat <= north) & (lat > south)
+        px, py = _pixels(lat[inside], lon[inside], z)
+        rows = np.flatnonzero(inside)
+        return rows, px - x * TILE_SIZE, py - y * TILE_SIZE, self.totals(inside, self.species_code(params))
+
+    def tile_geojson(self, z, x, y, params):
+        rows, _, _, totals = self._tile_watches(z, x, y, params)
+        arrays = self.arrays
+        return {'type': 'FeatureCollection', 'features': [
+            {
+                'type': 'Feature',
+                'geometry': {'type': 'Point', 'coordinates': [float(arrays.lon_start[row]), float(arrays.lat_start[row])]},
+                'properties': {'WatchID': int(arrays.watch_id[row]), 'CruiseID': int(arrays.cruise_id[row]),
+                               'TotalCount': float(total)},
+            }
+            for row, total in zip(rows, totals)
+        ]}
+
+    def tile_png(self, z, x, y, params):
+        """Counts summed per pixel, spread over a 3 pixel dot, on a log colour scale; empty pixels are transparent."""
+        from matplotlib import colormaps
+        from PIL import Image
+
+        _, px, py, totals = self._tile_watches(z, x, y, params)
+        px, py = np.clip(px.astype(np.int64), 0, TILE_SIZE - 1), np.clip(py.astype(np.int64), 0, TILE_SIZE - 1)
+        heat = np.bincount(py * TILE_SIZE + px, weights=totals + 1, minlength=TILE_SIZE ** 2)
+        heat = heat.reshape(TILE_SIZE, TILE_SIZE)
+        padded = np.pad(heat, 1)
+        heat = np.max([padded[1 + dy:TILE_SIZE + 1 + dy, 1 + dx:TILE_SIZE + 1 + dx]
+                       for dy in (-1, 0, 1) for dx in (-1, 0, 1)], axis=0)
+
+        # the colour scale is fixed by the busiest watch of the survey, so neighbouring tiles match
+        scale = np.log1p(max(float(self.watch_totals.max()), 1) + 1)
+        rgba = (colormaps['YlOrRd'](np.log1p(heat) / scale) * 255).astype(np.uint8)
+        rgba[..., 3] = np.where(heat > 0, 220, 0)
+        output = io.BytesIO()
+        Image.fromarray(rgba, 'RGBA').save(output, format='PNG', optimize=False)
+        return output.getvalue()
+
+
+def _int(params, name):
+    try:
+        return int(params[name])
+    except ValueError:
+        raise QueryError(f"{name} must be a whole number, not {params[name]!r}")
+
+
+def _float(params, name, default):
+    try:
+        return float(params.get(name, default))
+    except ValueError:
+        raise QueryError(f"{name} must be a number, not {params[name]!r}")
+
+
+def _iso(ns):
+    return None if ns == NAT else pd.Timestamp(int(ns)).isoformat()
+
+
+def _tile_corner(z, x, y):
+    """Longitude and latitude of the north-west corner of tile z/x/y."""
+    n = 2 ** z
+    return x / n * 360 - 180, math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
+
+
+def _pixels(lat, lon, z):
+    """Global web mercator pixel coordinates at zoom z."""
+    size = TILE_SIZE * 2 ** z
+    lat = np.clip(lat, -85.0511, 85.0511)
+    px = (lon + 180) / 360 * size
+    py = (1 - np.log(np.tan(np.radians(lat)) + 1 / np.cos(np.radians(lat))) / math.pi) / 2 * size
+    return px, py
+
+
+###########################
+# Response cache
+
+class ResponseCache:
+    """Least recently used cache of response bodies, bounded by number of entries and total size."""
+
+    def __init__(self, max_entries=RESPONSE_CACHE_ENTRIES, max_mb=RESPONSE_CACHE_MB):
+        self.max_entries, self.max_bytes = max_entries, max_mb * 2 ** 20
+        self._entries = collections.OrderedDict()
+        self._bytes = 0
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry
+
+    def put(self, key, entry):
+        if len(entry[1]) > self.max_bytes:
+            return
+        if key in self._entries:
+            self._bytes -= len(self._entries.pop(key)[1])
+        self._entries[key] = entry
+        self._bytes += len(entry[1])
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            _, (_, body) = self._entries.popitem(last=False)
+            self._bytes -= len(body)
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def stats(self):
+        return {'entries': len(self._entries), 'mb': round(self._bytes / 2 ** 20, 2), 'hits': self.hits,
+                'misses': self.misses}
+
+
+###########################
+# HTTP
+
+REASONS = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 405: 'Method Not Allowed', 500: 'Internal Server Error'}
+
+INDEX_PAGE = """<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>ECSAS survey</title>
+<link rel="stylesheet" href="https://unpkg.com/leaflet@1.9.4/dist/leaflet.css">
+<script src="https://unpkg.com/leaflet@1.9.4/dist/leaflet.js"></script>
+<style>html, body, #map {height: 100%; margin: 0}</style></head>
+<body><div id="map"></div><script>
+var map = L.map('map').setView([48.5, -50], 6);
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {attribution: '&copy; OpenStreetMap'}).addTo(map);
+L.tileLayer('/tiles/{z}/{x}/{y}.png' + window.location.search, {opacity: 0.9}).addTo(map);
+</script></body></html>
+"""
+
+
+class QueryService:
+    """Routes requests to SurveyData, with the response cache and the thread pool in front of it."""
+
+    def __init__(self, arrays_dir=ARRAYS_DIR, workers=WORKERS, cache=None):
+        self.arrays_dir = arrays_dir
+        self.data = SurveyData(arrays_dir)
+        self.cache = cache or ResponseCache()
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='query')
+        self._pending = {}
+        self._reload = None
+
+    async def _current_data(self):
+        """
+        The survey data, reloaded (and the cache emptied) if the store was rebuilt since it was loaded.
+
+        This runs on the event loop, so swapping the data and emptying the cache can't interleave with a request; only
+        loading the new data runs on the thread pool, once however many requests are waiting for it.
+        """
+        version = os.path.getmtime(os.path.join(self.arrays_dir, 'header.json'))
+        if version != self.data.version:
+            if self._reload is None:
+                self._reload = asyncio.get_running_loop().run_in_executor(self.executor, SurveyData, self.arrays_dir)
+            reload = self._reload
+            try:
+                data = await asyncio.shield(reload)
+            finally:
+                if self._reload is reload:
+                    self._reload = None
+            if data.version != self.data.version:
+                self.data = data
+                self.cache.clear()
+        return self.data
+
+    def route(self, path, params, data):
+        """Compute a response from `data`: (status, content type, body)."""
+        parts = path.strip('/').split('/')
+        if path == '/':
+            return 200, 'text/html; charset=utf-8', INDEX_PAGE.encode()
+        if path == '/health':
+            return _json({'version': data.version, 'watches': data.arrays.n_watches,
+                          'sightings': data.arrays.n_sightings, 'cache': self.cache.stats()})
+        endpoints = {'/species': data.species, '/cruises': data.cruises, '/crosstab': data.crosstab,
+                     '/density': data.density}
+        if path in endpoints:
+            return _json(endpoints[path](params))
+        if len(parts) == 4 and parts[0] == 'tiles':
+            y, _, extension = parts[3].partition('.')
+            try:
+                z, x, y = int(parts[1]), int(parts[2]), int(y)
+            except ValueError:
+                return _error(404, f"No tile {path}")
+            if extension == 'geojson':
+                return _json(data.tile_geojson(z, x, y, params))
+            if extension == 'png':
+                return 200, 'image/png', data.tile_png(z, x, y, params)
+        return _error(404, f"No endpoint {path}")
+
+    def _compute(self, path, params, data):
+        try:
+            return self.route(path, params, data)
+        except QueryError as error:
+            return _error(400, str(error))
+        except Exception as error:
+            return _error(500, repr(error))
+
+    async def respond(self, target):
+        """Answer a request target from the cache, from a computation already running, or by computing it."""
+        url = urlsplit(target)
+        params = dict(parse_qsl(url.query))
+        try:
+            data = await self._current_data()
+        except Exception as error:
+            # the store couldn't be reloaded (e.g. it's being rebuilt); the next request tries again
+            return _error(500, repr(error)), 'bypass'
+        loop = asyncio.get_running_loop()
+        if url.path == '/health':
+            return await loop.run_in_executor(self.executor, self._compute, url.path, params, data), 'bypass'
+
+        # the same question asked with its parameters in another order is the same cache entry, and responses computed
+        # from data that has since been replaced are stored under its version, so they're never served
+        key = (data.version, url.path + '?' + '&'.join(f'{name}={value}' for name, value in sorted(params.items())))
+
+        cached = self.cache.get(key)
+        if cached is not None:
+            return (200,) + cached, 'hit'
+        if key in self._pending:
+            return await asyncio.shield(self._pending[key]), 'shared'
+
+        future = loop.run_in_executor(self.executor, self._compute, url.path, params, data)
+        self._pending[key] = future
+        try:
+            status, content_type, body = await future
+        finally:
+            del self._pending[key]
+        if status == 200:
+            self.cache.put(key, (content_type, body))
+        return (status, content_type, body), 'miss'
+
+    async def handle(self, reader, writer):
+        """Serve one connection, keeping it open for further requests unless the client asks to close it."""
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+                except asyncio.TimeoutError:
+                    break
+                if not request_line:
+                    break
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                start = time.perf_counter()
+                try:
+                    method, target, version = request_line.decode('latin-1').split()
+                except ValueError:
+                    method, target, version = None, '/', 'HTTP/1.0'
+                if method not in ('GET', 'HEAD'):
+                    (status, content_type, body), source = _error(405, 'Only GET and HEAD are supported'), 'bypass'
+                else:
+                    (status, content_type, body), source = await self.respond(target)
+
+                keep_alive = (version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close')
+                head = (f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                        f"Content-Type: {content_type}\r\n"
+                        f"Content-Length: {len(body)}\r\n"
+                        f"Cache-Control: max-age=60\r\n"
+                        f"Access-Control-Allow-Origin: *\r\n"
+                        f"X-Cache: {source}\r\n"
+                        f"X-Response-Time-Ms: {(time.perf_counter() - start) * 1000:.1f}\r\n"
+                        f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n")
+                writer.write(head.encode('latin-1') + (body if method != 'HEAD' else b''))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def serve(self, host=HOST, port=PORT, ready=None):
+        server = await asyncio.start_server(self.handle, host, port)
+        address = server.sockets[0].getsockname()
+        if ready is not None:
+            ready(address)
+        else:
+            print(f"Serving the ECSAS survey on http://{address[0]}:{address[1]}/")
+        async with server:
+            await server.serve_forever()
+
+
+def _json(value):
+    return 200, 'application/json', json.dumps(value, default=_to_json).encode()
+
+
+def _to_json(value):
+    if isinstance(value, np.generic):
+        return value.item()
+    if isinstance(value, float) and math.isnan(value):
+        return None
+    raise TypeError(f"Can't encode {type(value).__name__}")
+
+
+def _error(status, message):
+    return status, 'application/json', json.dumps({'error': message}).encode()
+
+
+###########################
+# Benchmark
+
+BENCH_TARGETS = [
+    '/species', '/species?platform_class=2', '/cruises', '/crosstab?row=Weather&col=SeaState',
+    '/crosstab?row=Glare&col=SeaState&value=mean', '/crosstab?row=Weather&col=SeaState&species=NOFU',
+    '/density?cell_deg=0.1', '/density?species=NOFU&cell_deg=0.05', '/tiles/5/11/11.png', '/tiles/6/23/22.geojson',
+]
+
+
+async def _fetch(host, port, target):
+    reader, writer = await asyncio.open_connection(host, port)
+    start = time.perf_counter()
+    writer.write(f"GET {target} HTTP/1.1\r\nHost: {host}\r\nConnection: close\r\n\r\n".encode())
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    return (time.perf_counter() - start) * 1000, response.split(b' ', 2)[1]
+
+
+async def bench(requests=400, concurrency=16, targets=BENCH_TARGETS):
+    """Start the service on a free port and time `requests` requests sent `concurrency` at a time."""
+    service = QueryService()
+    address = asyncio.get_running_loop().create_future()
+    server = asyncio.ensure_future(service.serve('127.0.0.1', 0, ready=address.set_result))
+    host, port = await address
+
+    cold = [(await _fetch(host, port, target))[0] for target in targets]
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def limited(target):
+        async with semaphore:
+            return await _fetch(host, port, target)
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(limited(targets[i % len(targets)]) for i in range(requests)))
+    elapsed = time.perf_counter() - start
+    server.cancel()
+
+    warm = sorted(milliseconds for milliseconds, _ in results)
+    errors = sum(status != b'200' for _, status in results)
+    print(f"cold (first request of each kind): median {statistics.median(cold):.1f} ms, max {max(cold):.1f} ms")
+    print(f"{requests} requests, {concurrency} at a time: {requests / elapsed:.0f} requests/s, "
+          f"median {statistics.median(warm):.1f} ms, p95 {warm[int(len(warm) * 0.95) - 1]:.1f} ms, {errors} errors")
+    print(f"cache: {service.cache.stats()}")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve survey summaries, crosstabs, densities and map tiles.')
+    parser.add_argument('command', nargs='?', choices=['serve', 'bench'], default='serve')
+    parser.add_argument('--host', default=HOST)
+    parser.add_argument('--port', type=int, default=PORT)
+    parser.add_argument('--workers', type=int, default=WORKERS, help='threads computing responses')
+    parser.add_argument('--requests', type=int, default=400, help='requests to send with bench')
+    parser.add_argument('--concurrency', type=int, default=16, help='requests in flight at once with bench')
+    args = parser.parse_args()
+
+    if args.command == 'bench':
+        asyncio.run(bench(args.requests, args.concurrency))
+    else:
+        try:
+            asyncio.run(QueryService(workers=args.workers).serve(args.host, args.port))
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,420 @@
+#####################################################
+###############   FIGURE RENDERING    ###############
+
+"""
+`heatmaps.py` and `visibility.py` draw with matplotlib/seaborn (and `visibility.py` ended with `plt.show()`, which waits
+for a window on a headless cluster node), and `pie-chart.py` and `GAM_scatter.py` build their Plotly figures one after
+the other, all from the full survey frame.
+
+Here I render a set of figures for every cruise and every species on a process pool:
+
+- per cruise (`figures/cruises/<CruiseID>/`): the ship track coloured by count, heatmaps of the mean count per species by
+  weather and sea state code, the count per watch against visibility, and pie charts of the weather, glare and sea
+  state codes (Plotly)
+- per species (`figures/species/<Alpha>/`): a density grid of its counts and its counts per month
+
+The main process pre-aggregates everything from the relational store and the memory-mapped arrays (survey_arrays.py),
+using the offsets to slice out each cruise's watches and sightings, so a worker only gets the few small arrays its figure
+needs, never the survey frame. Workers use the non-interactive Agg backend and never open a window.
+
+The pool is sized to a memory budget (`--memory-mb`, the 1 GB SLURM allocation by default): every worker is counted at
+its import footprint plus a multiple of the largest payload. The largest payload is bounded from counts (the watches of
+the largest cruise and the size of the density grid), so the payloads themselves are only aggregated as the jobs are
+submitted. Only a couple of jobs per worker are queued at a time, so neither the main process nor a worker ever holds
+more than the payloads of the figures being drawn, and workers are replaced after a number of jobs so memory held on to
+by matplotlib doesn't build up.
+"""
+
+# load the required modules
+import argparse
+import multiprocessing
+import os
+import resource
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+import numpy as np
+
+from store import load_store
+from survey_arrays import grid_totals, open_arrays
+from temporal import month_of_year
+
+
+# Define the folder for the figures
+FIGURES_DIR = 'figures'
+
+# Memory budget for the whole render (MB), and the estimated footprint of one worker with matplotlib and plotly loaded
+MEMORY_BUDGET_MB = 1024
+WORKER_BASE_MB = 300
+
+# A worker is counted at WORKER_BASE_MB plus this many times the size of the largest payload
+PAYLOAD_FACTOR = 8
+
+# Jobs queued per worker, and jobs a worker renders before it is replaced
+QUEUED_PER_WORKER = 2
+JOBS_PER_WORKER = 50
+
+# Species shown on the per-cruise heatmaps (the most counted ones), and the density grid cell size in degrees
+TOP_SPECIES = 15
+DENSITY_CELL_DEG = 0.25
+
+# Backends that never open a window
+NON_INTERACTIVE = ('agg', 'pdf', 'ps', 'svg', 'cairo', 'template')
+
+
+###########################
+# Headless plotting
+
+def use_headless_backend():
+    """Make matplotlib draw off-screen (has to happen before pyplot is imported to take effect everywhere)."""
+    os.environ['MPLBACKEND'] = 'Agg'
+    import matplotlib
+    matplotlib.use('Agg')
+
+
+def show():
+    """`plt.show()` for scripts: only opens a window with an interactive backend, so headless runs never wait on it."""
+    import matplotlib
+    import matplotlib.pyplot as plt
+    if matplotlib.get_backend().lower() not in NON_INTERACTIVE:
+        plt.show()
+    plt.close('all')
+
+
+###########################
+# Pre-aggregating the payloads
+
+def _code_counts(codes):
+    """Counts of every code (NaN left out), as two small arrays."""
+    codes = np.asarray(codes, dtype=np.float64)
+    values, counts = np.unique(codes[np.isfinite(codes)], return_counts=True)
+    return values, counts
+
+
+def _mean_matrix(row_codes, column_codes, counts, rows, columns):
+    """Mean count for every (row, column) pair of codes, NaN where a pair was never seen."""
+    row_index = np.searchsorted(rows, row_codes)
+    column_index = np.searchsorted(columns, column_codes)
+    keep = ((row_index < len(rows)) & (column_index < len(columns)) & np.isfinite(column_codes))
+    keep[keep] &= (rows[row_index[keep]] == row_codes[keep]) & (columns[column_index[keep]] == column_codes[keep])
+    cell = row_index[keep] * len(columns) + column_index[keep]
+    sums = np.bincount(cell, weights=counts[keep], minlength=len(rows) * len(columns))
+    seen = np.bincount(cell, minlength=len(rows) * len(columns))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums / seen).reshape(len(rows), len(columns))
+
+
+def cruise_payloads(store, arrays):
+    """Yield (cruise_id, payload) for every cruise, sliced out of the arrays with the store offsets."""
+    conditions = store.table('tblWatch', columns=['Visibility', 'Weather', 'SeaState', 'Glare'])
+    weather = conditions['Weather'].to_numpy(dtype=np.float64)
+    sea_state = conditions['SeaState'].to_numpy(dtype=np.float64)
+    watch_totals = arrays.watch_totals()
+
+    for row, cruise_id in enumerate(store.cruises['CruiseID'].to_numpy()):
+        watches = slice(store.cruise_watch[row], store.cruise_watch[row + 1])
+        if watches.start == watches.stop:
+            continue
+        sightings = slice(store.watch_sighting[watches.start], store.watch_sighting[watches.stop])
+
+        codes = np.asarray(arrays.species_code[sightings])
+        counts = np.asarray(arrays.count[sightings], dtype=np.float64)
+        watch_rows = np.asarray(arrays.watch_row[sightings])
+
+        # the most counted species of the cruise, for the heatmaps
+        known = codes >= 0
+        species_totals = np.bincount(codes[known], weights=counts[known], minlength=len(arrays.species))
+        top = np.argsort(-species_totals, kind='stable')[:TOP_SPECIES]
+        top = np.sort(top[species_totals[top] > 0])
+
+        payload = {
+            'lat': np.asarray(arrays.lat_start[watches]),
+            'lon': np.asarray(arrays.lon_start[watches]),
+            'totals': watch_totals[watches],
+            'visibility': conditions['Visibility'].to_numpy(dtype=np.float64)[watches],
+            'species': arrays.species[top].tolist(),
+            'pies': {name: _code_counts(conditions[name].to_numpy()[watches])
+                     for name in ('Weather', 'Glare', 'SeaState')},
+        }
+        for name, watch_codes in (('weather', weather), ('sea_state', sea_state)):
+            sighting_codes = watch_codes[watch_rows]
+            columns = np.unique(sighting_codes[np.isfinite(sighting_codes)])
+            payload[f'{name}_codes'] = columns
+            payload[f'{name}_means'] = _mean_matrix(codes, sighting_codes, counts, top, columns)
+        yield int(cruise_id), payload
+
+
+def species_payloads(arrays, cell_deg=DENSITY_CELL_DEG):
+    """Yield (alpha, payload) for every species that was seen: its density grid and counts per month."""
+    lat, lon = np.asarray(arrays.lat_start), np.asarray(arrays.lon_start)
+    located = np.isfinite(lat) & np.isfinite(lon)
+    if not located.any():
+        return
+    # one grid for every species, so their figures line up
+    bounds = (lat[located].min(), lon[located].min(), lat[located].max(), lon[located].max())
+
+    rows = np.asarray(arrays.watch_row)
+    codes = np.asarray(arrays.species_code)
+    counts = np.asarray(arrays.count, dtype=np.float64)
+    # month of each watch, 0 for January and negative where the StartTime is missing (see temporal.py)
+    months = month_of_year(arrays.start_ns) - 1
+
+    # sort the sightings by species once so every species is one slice
+    keep = (rows >= 0) & (codes >= 0)
+    order = np.argsort(codes[keep], kind='stable')
+    rows, codes, counts = rows[keep][order], codes[keep][order], counts[keep][order]
+    bounds_per_code = np.searchsorted(codes, np.arange(len(arrays.species) + 1))
+
+    for code, alpha in enumerate(arrays.species):
+        part = slice(bounds_per_code[code], bounds_per_code[code + 1])
+        if part.start == part.stop or not alpha:
+            continue
+        grid, corner = grid_totals(lat[rows[part]], lon[rows[part]], counts[part], cell_deg, bounds)
+        month = months[rows[part]]
+        yield alpha, {
+            'grid': grid.astype(np.float32),
+            'corner': corner,
+            'cell_deg': cell_deg,
+            'monthly': np.bincount(month[month >= 0], weights=counts[part][month >= 0], minlength=12),
+        }
+
+
+def figure_jobs(store=None, arrays=None, figures_dir=FIGURES_DIR):
+    """Yield (kind, output path, payload) for every figure, pre-aggregating lazily as the jobs are taken."""
+    store = store or load_store()
+    arrays = arrays or open_arrays()
+    for cruise_id, payload in cruise_payloads(store, arrays):
+        folder = os.path.join(figures_dir, 'cruises', str(cruise_id))
+        yield 'track', os.path.join(folder, 'track.png'), {k: payload[k] for k in ('lat', 'lon', 'totals')}
+        yield 'heatmaps', os.path.join(folder, 'heatmaps.png'), {
+            k: payload[k] for k in ('species', 'weather_codes', 'weather_means', 'sea_state_codes', 'sea_state_means')}
+        yield 'visibility', os.path.join(folder, 'visibility.png'), {k: payload[k] for k in ('visibility', 'totals')}
+        yield 'pies', os.path.join(folder, 'conditions.html'), {'pies': payload['pies'], 'cruise_id': cruise_id}
+    for alpha, payload in species_payloads(arrays):
+        folder = os.path.join(figures_dir, 'species', alpha)
+        yield 'density', os.path.join(folder, 'density.png'), {**payload, 'alpha': alpha}
+        yield 'seasonality', os.path.join(folder, 'seasonality.png'), {'monthly': payload['monthly'], 'alpha': alpha}
+
+
+###########################
+# Renderers (run in the workers)
+
+def _save(fig, path):
+    import matplotlib.pyplot as plt
+    fig.savefig(path, dpi=100, bbox_inches='tight')
+    plt.close(fig)
+
+
+def render_track(payload, path):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(7, 6))
+    order = np.argsort(payload['totals'], kind='stable')
+    points = ax.scatter(payload['lon'][order], payload['lat'][order], c=payload['totals'][order], s=12, cmap='viridis')
+    fig.colorbar(points, ax=ax, label='Count per watch')
+    ax.set_xlabel('Longitude')
+    ax.set_ylabel('Latitude')
+    ax.grid(True, linewidth=0.3)
+    _save(fig, path)
+
+
+def render_heatmaps(payload, path):
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    import pandas as pd
+    fig, axes = plt.subplots(1, 2, figsize=(18, 6))
+    for ax, name, label in zip(axes, ('weather', 'sea_state'), ('Weather Code', 'Sea State Code')):
+        means = pd.DataFrame(payload[f'{name}_means'], index=payload['species'],
+                             columns=payload[f'{name}_codes'].astype(int))
+        if means.size:
+            sns.heatmap(means, ax=ax, cmap='Greys', annot=True, fmt='.1f', cbar=True, linewidths=.3, linecolor='grey')
+        ax.set_xlabel(label)
+    axes[0].set_ylabel('Species (mean count per sighting)')
+    fig.tight_layout()
+    _save(fig, path)
+
+
+def render_visibility(payload, path):
+    import matplotlib.pyplot as plt
+    x, y = payload['visibility'], payload['totals']
+    keep = np.isfinite(x) & np.isfinite(y)
+    fig, ax = plt.subplots(figsize=(10, 6))
+    ax.scatter(x[keep], y[keep], s=50)
+    if np.unique(x[keep]).size > 1:
+        slope, intercept = np.polyfit(x[keep], y[keep], 1)
+        line = np.linspace(x[keep].min(), x[keep].max(), 50)
+        ax.plot(line, slope * line + intercept, color='red')
+    ax.set_xlabel('Visibility (km)')
+    ax.set_ylabel('Count per watch')
+    ax.grid(True)
+    _save(fig, path)
+
+
+def render_pies(payload, path):
+    import plotly.graph_objects as go
+    from plotly.subplots import make_subplots
+    from html_output import write_html
+    names = list(payload['pies'])
+    fig = make_subplots(rows=1, cols=len(names), specs=[[{'type': 'domain'}] * len(names)], subplot_titles=names)
+    for column, name in enumerate(names, start=1):
+        values, counts = payload['pies'][name]
+        fig.add_trace(go.Pie(labels=[f'{value:g}' for value in values], values=counts, name=name), row=1, col=column)
+    fig.update_layout(showlegend=False, title_text=f"Observation conditions, cruise {payload['cruise_id']}")
+    write_html(fig, path)
+
+
+def render_density(payload, path):
+    import matplotlib.pyplot as plt
+    grid, (min_lat, min_lon), cell = payload['grid'], payload['corner'], payload['cell_deg']
+    fig, ax = plt.subplots(figsize=(7, 6))
+    image = ax.imshow(np.where(grid > 0, grid, np.nan), origin='lower', cmap='magma_r', aspect='auto',
+                      extent=(min_lon, min_lon + grid.shape[1] * cell, min_lat, min_lat + grid.shape[0] * cell))
+    fig.colorbar(image, ax=ax, label='Total count')
+    ax.set_title(payload['alpha'])
+    ax.set_xlabel('Longitude')
+    ax.set_ylabel('Latitude')
+    _save(fig, path)
+
+
+def render_seasonality(payload, path):
+    import matplotlib.pyplot as plt
+    fig, ax = plt.subplots(figsize=(8, 4))
+    ax.bar(np.arange(1, 13), payload['monthly'], color='grey')
+    ax.set_xticks(np.arange(1, 13))
+    ax.set_xlabel('Month')
+    ax.set_ylabel('Total count')
+    ax.set_title(payload['alpha'])
+    _save(fig, path)
+
+
+RENDERERS = {
+    'track': render_track,
+    'heatmaps': render_heatmaps,
+    'visibility': render_visibility,
+    'pies': render_pies,
+    'density': render_density,
+    'seasonality': render_seasonality,
+}
+
+
+def _init_worker():
+    use_headless_backend()
+
+
+def render_job(kind, path, payload):
+    """Render one figure in a worker and return its path, time and the worker's peak memory (MB)."""
+    start = time.perf_counter()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    RENDERERS[kind](payload, path)
+    unit = 1 if sys.platform == 'darwin' else 1024
+    return path, time.perf_counter() - start, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+
+
+###########################
+# Running the pool
+
+def payload_mb(payload):
+    """Rough size of a payload in MB (its arrays, the rest is negligible)."""
+    if isinstance(payload, np.ndarray):
+        return payload.nbytes / 2 ** 20
+    if isinstance(payload, dict):
+        return sum(payload_mb(value) for value in payload.values())
+    if isinstance(payload, (list, tuple)):
+        return sum(payload_mb(value) for value in payload)
+    return 0.0
+
+
+def largest_payload_mb(store, arrays, cell_deg=DENSITY_CELL_DEG):
+    """
+    Size of the largest payload (MB), estimated from counts only: the per-watch arrays of the largest cruise, or a
+    species density grid with its monthly counts. The heatmaps and pie charts are a few codes by a few species.
+    """
+    most_watches = int(np.diff(store.cruise_watch).max(initial=0))
+    # lat, lon, totals and visibility for every watch of the cruise
+    cruise_bytes = 4 * 8 * most_watches
+
+    lat, lon = np.asarray(arrays.lat_start), np.asarray(arrays.lon_start)
+    located = np.isfinite(lat) & np.isfinite(lon)
+    grid_bytes = 0
+    if located.any():
+        # the grid of species_payloads (float32 cells), sized like grid_totals
+        n_rows = int(np.floor((lat[located].max() - lat[located].min()) / cell_deg)) + 1
+        n_cols = int(np.floor((lon[located].max() - lon[located].min()) / cell_deg)) + 1
+        grid_bytes = 4 * n_rows * n_cols + 8 * 12
+    return max(cruise_bytes, grid_bytes) / 2 ** 20
+
+
+def pool_size(largest_payload_mb, memory_mb=MEMORY_BUDGET_MB, max_workers=None):
+    """Number of workers that fit in the memory budget, next to the main process."""
+    unit = 1 if sys.platform == 'darwin' else 1024
+    main_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * unit / 2 ** 20
+    per_worker = WORKER_BASE_MB + PAYLOAD_FACTOR * largest_payload_mb
+    fitting = int((memory_mb - main_mb) // per_worker)
+    return max(1, min(fitting, max_workers or os.cpu_count() or 1))
+
+
+def render_all(jobs=None, memory_mb=MEMORY_BUDGET_MB, max_workers=None, largest_mb=None):
+    """
+    Render every figure job on a process pool sized to the memory budget. Returns a summary with the number of figures,
+    failures, the workers used and the highest peak memory seen in a worker.
+
+    Without `jobs`, every figure is rendered and the payloads are aggregated one at a time as jobs are submitted. Jobs
+    passed in are measured first, unless `largest_mb` gives the size of their largest payload.
+    """
+    if jobs is None:
+        store, arrays = load_store(), open_arrays()
+        jobs = figure_jobs(store, arrays)
+        largest = largest_payload_mb(store, arrays) if largest_mb is None else largest_mb
+    elif largest_mb is None:
+        jobs = list(jobs)
+        largest = max((payload_mb(payload) for _, _, payload in jobs), default=0.0)
+    else:
+        largest = largest_mb
+    workers = pool_size(largest, memory_mb, max_workers)
+
+    summary = {'figures': 0, 'failed': [], 'workers': workers, 'largest_payload_mb': round(largest, 3),
+               'worker_peak_mb': 0.0}
+    # spawned workers start clean (no copy of the main process's data), and can be replaced after JOBS_PER_WORKER jobs
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker,
+                             max_tasks_per_child=JOBS_PER_WORKER) as pool:
+        pending = iter(jobs)
+        running = {}
+        while True:
+            # keep only a few jobs per worker queued, so payloads are sent as workers free up
+            while len(running) < workers * QUEUED_PER_WORKER:
+                job = next(pending, None)
+                if job is None:
+                    break
+                running[pool.submit(render_job, *job)] = job[1]
+            if not running:
+                break
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                path = running.pop(future)
+                try:
+                    _, _, peak_mb = future.result()
+                except Exception as error:
+                    summary['failed'].append(f'{path}: {error!r}')
+                    continue
+                summary['figures'] += 1
+                summary['worker_peak_mb'] = max(summary['worker_peak_mb'], round(peak_mb, 1))
+
+    if summary['worker_peak_mb'] > WORKER_BASE_MB + PAYLOAD_FACTOR * largest:
+        print(f"Warning: a render worker peaked at {summary['worker_peak_mb']} MB, more than the "
+              f"{WORKER_BASE_MB + PAYLOAD_FACTOR * largest:.0f} MB it was counted at, so the render may have gone "
+              f"over the memory budget")
+    return summary
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Render the per-cruise and per-species figures in parallel.')
+    parser.add_argument('--memory-mb', type=float, default=MEMORY_BUDGET_MB, help='memory budget for the render')
+    parser.add_argument('--workers', type=int, default=None, help='upper limit on the number of workers')
+    args = parser.parse_args()
+
+    summary = render_all(memory_mb=args.memory_mb, max_workers=args.workers)
+    print(f"Rendered {summary['figures']} figures on {summary['workers']} workers "
+          f"(largest payload {summary['largest_payload_mb']} MB, worker peak {summary['worker_peak_mb']} MB)")
+    for failure in summary['failed']:
+        print(f"failed: {failure}")
@@ -1,19 +1,14 @@
 #!/bin/bash
-#SBATCH --time= 00:05:00 #adjusted to 5 mins
-#SBATCH --mem= 1 GB #adjusted to 1GB
+#SBATCH --time=00:05:00 #adjusted to 5 mins
+#SBATCH --mem=1G #adjusted to 1GB
 
 #load the modules
 module load StdEnv/2023
 module load python
 module load scipy-stack
 
-# Create and activate a virtual environment
-python -m venv myenv
-source myenv/bin/activate
-
-# Install necessary packages in the virtual environment
-pip install folium
-pip install openpyxl
+# Activate the environment built once by setup-env.sh (instead of creating one and installing folium every job)
+source "${ECSAS_ENV:-$HOME/ecsas-env}/bin/activate"
 
 # Run your script
 python interactive_map.py
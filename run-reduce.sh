@@ -0,0 +1,19 @@
+#!/bin/bash
+#SBATCH --time=00:10:00
+#SBATCH --mem=2G
+#SBATCH --output=slurm-%j.out
+
+# Merge the partial results of the job array. Submitted by `python cluster.py submit` with a dependency on
+# the array, so it only starts once every array task finished.
+
+#load the modules
+module load StdEnv/2023
+module load python
+module load scipy-stack
+
+# Use the environment built by setup-env.sh
+source "${ECSAS_ENV:-$HOME/ecsas-env}/bin/activate"
+
+python cluster.py reduce "$@"
+
+deactivate
@@ -0,0 +1,21 @@
+#!/bin/bash
+#SBATCH --time=00:15:00
+#SBATCH --mem=2G
+#SBATCH --cpus-per-task=1
+#SBATCH --output=slurm-%A_%a.out
+
+# One task of the sharded job array, submitted by `python cluster.py submit`, which passes the
+# sharding options as arguments (e.g. --tasks 8 --by tile). The array index comes from SLURM_ARRAY_TASK_ID.
+
+#load the modules
+module load StdEnv/2023
+module load python
+module load scipy-stack
+
+# Use the environment built by setup-env.sh
+source "${ECSAS_ENV:-$HOME/ecsas-env}/bin/activate"
+
+# Write this task's partial results to the shared cache
+python cluster.py shard "$@"
+
+deactivate
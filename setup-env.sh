@@ -0,0 +1,20 @@
+#!/bin/bash
+# Build the Python environment for the cluster jobs once (on the login node), instead of in every job.
+# The jobs activate it from $ECSAS_ENV (default: ~/ecsas-env).
+
+ECSAS_ENV=${ECSAS_ENV:-$HOME/ecsas-env}
+
+#load the modules
+module load StdEnv/2023
+module load python
+module load scipy-stack
+
+# Create the virtual environment and install the packages that aren't in the scipy-stack module,
+# from the cluster's wheelhouse so nothing is downloaded
+python -m venv "$ECSAS_ENV"
+source "$ECSAS_ENV/bin/activate"
+pip install --no-index --upgrade pip
+pip install --no-index folium openpyxl pyarrow pygam scikit-learn plotly prettytable geopy
+deactivate
+
+echo "Built $ECSAS_ENV"
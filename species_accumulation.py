@@ -0,0 +1,293 @@
+#####################################################
+#########   SPECIES ACCUMULATION CURVES    ##########
+
+"""
+The number of species observed on a cruise depends a lot on how many watches were done, so a raw count of unique `Alpha`
+codes can't be compared between moving and stationary platforms, or between cruises of different lengths.
+
+Here I build species accumulation and rarefaction curves from a sparse watch x species incidence matrix:
+
+1) Sample-based accumulation curves, where the watches are shuffled many times and the species seen so far are counted
+   after each watch. All of the permutations are drawn at once as arrays, so no Python loop runs per watch.
+
+2) Individual-based rarefaction curves (Hurlbert 1971), computed analytically from the species totals.
+
+3) Chao1 and ACE estimates of the total species richness, including species that were likely present but not seen.
+
+Each cruise and platform class is processed in its own worker process.
+"""
+
+# load the required modules
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from scipy.special import gammaln
+
+
+# the largest number of (permutation x sighting) cells held in memory at once when shuffling watches
+MAX_CHUNK_CELLS = 5_000_000
+
+
+##############################
+# Building the incidence data
+
+def incidence_matrix(survey, watch_col='WatchID', species_col='Alpha', count_col='Count'):
+    """
+    Build a sparse watch x species matrix of summed counts.
+
+    Every watch in the survey gets a row, even watches without sightings, because they are still part of the effort.
+    Returns the CSC matrix along with the sorted WatchIDs (rows) and species codes (columns).
+    """
+    watch_ids = np.unique(survey[watch_col].to_numpy())
+
+    # only rows with a species and a positive count are sightings
+    sightings = survey[survey[species_col].notna() & (survey[count_col] > 0)]
+    species, species_idx = np.unique(sightings[species_col].to_numpy(dtype=str), return_inverse=True)
+    watch_idx = np.searchsorted(watch_ids, sightings[watch_col].to_numpy())
+
+    # duplicate (watch, species) pairs are summed when the matrix is built
+    matrix = sparse.csc_matrix(
+        (sightings[count_col].to_numpy(dtype=np.float64), (watch_idx, species_idx)),
+        shape=(len(watch_ids), len(species))
+    )
+    matrix.sum_duplicates()
+    return matrix, watch_ids, species
+
+
+#############################
+# Sample-based accumulation
+
+def accumulation_curve(matrix, n_permutations=100, seed=None):
+    """
+    Calculate a sample-based species accumulation curve by randomly reordering the watches.
+
+    For each permutation the position of every watch is drawn at once, and the first position at which each species
+    appears is found with a segmented minimum over the CSC row indices. Counting those first appearances and taking a
+    cumulative sum gives the number of species seen after 1, 2, ..., n watches.
+    """
+    matrix = sparse.csc_matrix(matrix)
+    matrix.eliminate_zeros()
+    n_watches = matrix.shape[0]
+
+    # species that were never counted can't contribute to the curve
+    nonempty = np.diff(matrix.indptr) > 0
+    matrix = matrix[:, nonempty]
+    rows, indptr = matrix.indices, matrix.indptr
+
+    curves = np.zeros((n_permutations, n_watches), dtype=np.int64)
+    if n_watches == 0 or matrix.shape[1] == 0:
+        return _curve_frame(curves, n_watches)
+
+    rng = np.random.default_rng(seed)
+    chunk = max(1, MAX_CHUNK_CELLS // max(len(rows), n_watches))
+
+    for start in range(0, n_permutations, chunk):
+        n = min(chunk, n_permutations - start)
+
+        # position[i, w] is where watch w lands in permutation i
+        position = rng.permuted(np.tile(np.arange(n_watches), (n, 1)), axis=1)
+
+        # first position at which each species shows up, per permutation
+        first_seen = np.minimum.reduceat(position[:, rows], indptr[:-1], axis=1)
+
+        # count first appearances per position in one bincount by offsetting each permutation
+        offsets = first_seen + (np.arange(n) * n_watches)[:, None]
+        new_species = np.bincount(offsets.ravel(), minlength=n * n_watches).reshape(n, n_watches)
+        curves[start:start + n] = new_species.cumsum(axis=1)
+
+    return _curve_frame(curves, n_watches)
+
+
+def _curve_frame(curves, n_watches):
+    """Summarise permutation curves as a mean, standard deviation and 95% interval per number of watches."""
+    return pd.DataFrame({
+        'Watches': np.arange(1, n_watches + 1),
+        'Species': curves.mean(axis=0),
+        'SD': curves.std(axis=0),
+        'Lower': np.percentile(curves, 2.5, axis=0) if len(curves) else np.nan,
+        'Upper': np.percentile(curves, 97.5, axis=0) if len(curves) else np.nan,
+    })
+
+
+#################################
+# Individual-based rarefaction
+
+def rarefaction_curve(abundances, n_points=100):
+    """
+    Calculate the expected number of species in a random subsample of n individuals (Hurlbert 1971).
+
+    E[S_n] = sum over species of 1 - C(N - N_i, n) / C(N, n), with the binomial coefficients evaluated on a log scale
+    so large counts don't overflow.
+    """
+    abundances = np.asarray(abundances, dtype=np.float64)
+    abundances = abundances[abundances > 0]
+    total = abundances.sum()
+    if total == 0:
+        return pd.DataFrame({'Individuals': [], 'Species': []})
+
+    sizes = np.unique(np.linspace(1, total, min(n_points, int(total))).round())
+
+    def log_choose(n, k):
+        return gammaln(n + 1) - gammaln(k + 1) - gammaln(n - k + 1)
+
+    # rows are subsample sizes, columns are species
+    n = sizes[:, None]
+    remaining = total - abundances[None, :]
+    with np.errstate(invalid='ignore'):
+        p_absent = np.where(remaining >= n, np.exp(log_choose(remaining, n) - log_choose(total, n)), 0.0)
+
+    return pd.DataFrame({'Individuals': sizes.astype(np.int64), 'Species': (1.0 - p_absent).sum(axis=1)})
+
+
+##########################
+# Richness estimators
+
+def chao1(abundances):
+    """
+    Estimate total species richness from singletons (f1) and doubletons (f2) (Chao 1984).
+
+    The bias-corrected form is used when no species was seen exactly twice.
+    """
+    abundances = np.asarray(abundances, dtype=np.int64)
+    abundances = abundances[abundances > 0]
+    total = abundances.sum()
+    if total == 0:
+        return 0.0
+
+    observed = len(abundances)
+    f1 = np.count_nonzero(abundances == 1)
+    f2 = np.count_nonzero(abundances == 2)
+    correction = (total - 1) / total
+
+    if f2 > 0:
+        return observed + correction * f1 ** 2 / (2 * f2)
+    return observed + correction * f1 * (f1 - 1) / 2
+
+
+def ace(abundances, rare_threshold=10):
+    """
+    Estimate total species richness with the Abundance-based Coverage Estimator (Chao & Lee 1992).
+
+    Species with counts at or below `rare_threshold` are treated as rare and used to estimate sample coverage.
+    Falls back to Chao1 when every rare species is a singleton, because the coverage estimate is then zero.
+    """
+    abundances = np.asarray(abundances, dtype=np.int64)
+    abundances = abundances[abundances > 0]
+    if len(abundances) == 0:
+        return 0.0
+
+    rare = abundances[abundances <= rare_threshold]
+    s_abund = np.count_nonzero(abundances > rare_threshold)
+    s_rare = len(rare)
+    n_rare = rare.sum()
+    if s_rare == 0:
+        return float(s_abund)
+
+    f1 = np.count_nonzero(rare == 1)
+    coverage = 1 - f1 / n_rare
+    if coverage == 0:
+        return chao1(abundances)
+
+    # frequency counts f_i for i = 1..rare_threshold
+    f = np.bincount(rare, minlength=rare_threshold + 1)
+    i = np.arange(len(f))
+    gamma_sq = 0.0
+    if n_rare > 1:
+        gamma_sq = max(s_rare / coverage * np.sum(i * (i - 1) * f) / (n_rare * (n_rare - 1)) - 1, 0.0)
+
+    return s_abund + s_rare / coverage + f1 / coverage * gamma_sq
+
+
+#################################
+# Running groups in parallel
+
+def summarise_group(watch_ids, species, counts, n_permutations=100, seed=None):
+    """
+    Build the curves and estimators for one group of watches from plain arrays.
+
+    This takes arrays instead of a DataFrame so that only the three needed columns are sent to a worker process.
+    """
+    frame = pd.DataFrame({'WatchID': watch_ids, 'Alpha': species, 'Count': counts})
+    matrix, watches, species_codes = incidence_matrix(frame)
+    abundances = np.asarray(matrix.sum(axis=0)).ravel().round().astype(np.int64)
+
+    summary = {
+        'Watches': len(watches),
+        'SpeciesObserved': len(species_codes),
+        'Individuals': int(abundances.sum()),
+        'Chao1': chao1(abundances),
+        'ACE': ace(abundances),
+    }
+    curves = {
+        'accumulation': accumulation_curve(matrix, n_permutations=n_permutations, seed=seed),
+        'rarefaction': rarefaction_curve(abundances),
+    }
+    return summary, curves
+
+
+def richness_by_group(survey, by=('CruiseID', 'PlatformClass'), n_permutations=100, seed=None, max_workers=None):
+    """
+    Calculate the richness summary and curves for every group (by default each cruise and platform class).
+
+    Groups are run on a process pool; returns a summary DataFrame with one row per group and a dict of curves
+    keyed by the group values.
+    """
+    by = list(by)
+    groups = list(survey.groupby(by, sort=True))
+    if max_workers is None:
+        max_workers = min(len(groups), os.cpu_count() or 1) or 1
+
+    with ProcessPoolExecutor(max_workers=max_workers) as pool:
+        futures = [
+            pool.submit(
+                summarise_group,
+                group['WatchID'].to_numpy(),
+                group['Alpha'].to_numpy(dtype=object),
+                group['Count'].to_numpy(),
+                n_permutations,
+                seed,
+            )
+            for _, group in groups
+        ]
+        results = [future.result() for future in futures]
+
+    rows, curves = [], {}
+    for (key, _), (summary, group_curves) in zip(groups, results):
+        key = key if isinstance(key, tuple) else (key,)
+        rows.append(dict(zip(by, key), **summary))
+        curves[key] = group_curves
+
+    return pd.DataFrame(rows), curves
+
+
+if __name__ == '__main__':
+    import matplotlib.pyplot as plt
+
+    # Load the stationary and moving survey data and pool them so both platform classes are compared
+    stationary_survey = pd.read_excel(os.path.join('data', 'stationary_platform_data.xlsx'))
+    moving_survey = pd.read_excel(os.path.join('data', 'moving_platform_data.xlsx'))
+    survey = pd.concat([stationary_survey, moving_survey], ignore_index=True)
+
+    summary, curves = richness_by_group(survey, n_permutations=200, seed=42)
+
+    print("Species richness per cruise and platform class (observed vs estimated):")
+    print(summary.round(2).to_string(index=False))
+
+    # Plot the accumulation curves with their 95% intervals, one line per cruise and platform class
+    plt.figure(figsize=(10, 6))
+    for key, group_curves in curves.items():
+        curve = group_curves['accumulation']
+        label = ', '.join(str(k) for k in key)
+        plt.plot(curve['Watches'], curve['Species'], label=label)
+        plt.fill_between(curve['Watches'], curve['Lower'], curve['Upper'], alpha=0.2)
+
+    plt.xlabel('Number of watches')
+    plt.ylabel('Species observed')
+    plt.legend(title='CruiseID, PlatformClass')
+    plt.grid(True)
+
+    # Save the plot as a PNG file
+    plt.savefig('figures/species_accumulation.png')
@@ -0,0 +1,448 @@
+#####################################################
+###########   KEYED RELATIONAL STORE    #############
+
+"""
+`preprocessing.py` used to build the survey dataset by hash-merging tblWatch -> tblSighting -> tblSpeciesInfo, and
+`interactive_map.py` merged tblCruise and tblWatchNotes back onto every sighting row, copying the cruise details once
+per bird.
+
+Here I keep the tables normalized in a cache folder instead, with each fact table sorted by its keys:
+
+- `tblCruise` sorted by CruiseID
+- `tblWatch` sorted by CruiseID, then WatchID, so each cruise's watches sit in one contiguous block
+- `tblSighting` sorted in the same watch order, then FlockID, so each watch's sightings sit in one contiguous block
+
+Offset arrays saved next to the tables give the block for each key (cruise -> watch rows, watch -> sighting rows), so
+slicing out a cruise or a watch is a direct slice, and joining watches to sightings is a merge-join done with
+`np.repeat` over the block sizes rather than a hash join. Dimension tables (tblSpeciesInfo and the notes tables) are sorted
+by their key and looked up with a binary search.
+
+The tables are saved as Parquet files so they can be read column by column. Before they're sorted, they're checked
+against the validation rules in `validation.py`, and rows that break them are quarantined.
+"""
+
+# load the required modules
+import json
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+
+from instrumentation import count_rows, stage
+
+
+# Define the folders for the exported Access tables and the cache
+TABLES_DIR = 'ECSAS_tables'
+CACHE_DIR = 'cache'
+STORE_DIR = os.path.join(CACHE_DIR, 'store')
+
+# Rows per Parquet row group, small enough that filters on sorted keys can skip most of a large file
+ROW_GROUP_SIZE = 65_536
+
+# Tables copied into the store and the key each one is sorted by
+FACT_TABLES = ['tblCruise', 'tblWatch', 'tblSighting']
+DIMENSION_TABLES = {
+    'tblSpeciesInfo': 'SpecInfoID',
+    'tblWatchNotes': 'WatchID',
+    'tblSightingNotes': 'SightingID',
+    'tblCruiseNotes': 'CruiseID',
+    'tblIncWatchNotes': 'WatchID',
+    'tblIncSightingNotes': 'SightingID',
+}
+
+# Watches are minutes long, so an EndTime this many hours before the StartTime means the watch crossed midnight
+MIDNIGHT_HOURS = 12
+
+# Exported tables are read from Parquet if there is a Parquet copy (e.g. large tables from synthetic_data.py),
+# otherwise from the Excel export
+SOURCE_FORMATS = ('.parquet', '.xlsx')
+
+
+###########################
+# Building the store
+
+def _combine_date_time(dates, times):
+    """
+    Combine the watch Date with the time of day in StartTime/EndTime.
+
+    Access exports some times as full datetimes and others as bare times, so only the time of day (to the second) is
+    kept from each value and it is added to the watch date.
+    """
+    times = pd.Series(times, index=dates.index)
+    if pd.api.types.is_datetime64_any_dtype(times):
+        times = times.dt.floor('s')
+        time_of_day = times - times.dt.normalize()
+    else:
+        # bare times (or a mix of types): there are at most a day's worth of distinct values, so each is read once
+        codes, uniques = pd.factorize(times)
+        seconds = np.array([t.hour * 3600 + t.minute * 60 + t.second if hasattr(t, 'hour') else np.nan
+                            for t in uniques] + [np.nan])
+        time_of_day = pd.Series(pd.to_timedelta(seconds[codes], unit='s'), index=dates.index)
+    return pd.to_datetime(dates).dt.normalize() + time_of_day
+
+
+def combine_watch_times(watches):
+    """
+    Return tblWatch with StartTime and EndTime as full timestamps (see `_combine_date_time`).
+
+    Both get the watch Date, so the EndTime of a watch that crossed midnight would come out hours before its StartTime;
+    an EndTime at least MIDNIGHT_HOURS before the StartTime is moved to the next day.
+    """
+    watches = watches.copy()
+    for column in ['StartTime', 'EndTime']:
+        if column in watches:
+            watches[column] = _combine_date_time(watches['Date'], watches[column])
+    if 'StartTime' in watches and 'EndTime' in watches:
+        crossed = watches['StartTime'] - watches['EndTime'] >= pd.Timedelta(hours=MIDNIGHT_HOURS)
+        watches.loc[crossed, 'EndTime'] += pd.Timedelta(days=1)
+    return watches
+
+
+def _write_table(frame, store_dir, name):
+    path = os.path.join(store_dir, f'{name}.parquet')
+    frame.reset_index(drop=True).to_parquet(path, index=False, row_group_size=ROW_GROUP_SIZE)
+    return path
+
+
+def _source_path(tables_dir, name):
+    """Path of the exported table `name`, or None if it wasn't exported."""
+    for extension in SOURCE_FORMATS:
+        path = os.path.join(tables_dir, f'{name}{extension}')
+        if os.path.exists(path):
+            return path
+    return None
+
+
+def _read_table(path):
+    if path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_excel(path)
+
+
+def _read_rows(path, columns, rows):
+    """Read only the row groups of a stored table that hold `rows`, and return those rows in the order given."""
+    parquet_file = pq.ParquetFile(path)
+    sizes = np.array([parquet_file.metadata.row_group(group).num_rows
+                      for group in range(parquet_file.num_row_groups)], dtype=np.int64)
+    starts = np.concatenate([[0], np.cumsum(sizes)])
+    rows = np.asarray(rows, dtype=np.int64)
+    groups = np.searchsorted(starts, rows, side='right') - 1
+    needed = np.unique(groups)
+    table = parquet_file.read_row_groups(needed.tolist(), columns=columns).to_pandas()
+    # the row groups that were read are stacked, so each row moves up by the rows of the groups that were skipped
+    read_starts = np.concatenate([[0], np.cumsum(sizes[needed])])
+    positions = read_starts[np.searchsorted(needed, groups)] + rows - starts[groups]
+    return table.iloc[positions].reset_index(drop=True)
+
+
+def sort_tables(tables):
+    """
+    Sort the fact and dimension tables by their keys and calculate the offset arrays.
+
+    `tables` maps table names to DataFrames (with the watch times already combined, see `combine_watch_times`); the
+    sorted tables are returned in a new dict along with the offsets.
+    """
+    cruises = tables['tblCruise'].sort_values('CruiseID', kind='stable').reset_index(drop=True)
+
+    # position of every watch's cruise, -1 if the cruise doesn't exist; orphan watches (no matching cruise) are
+    # quarantined by validation, but if that rule is turned off they're kept at the front, outside every cruise block
+    cruise_ids = cruises['CruiseID'].to_numpy()
+    watch_cruise = _positions(cruise_ids, np.arange(len(cruise_ids)), tables['tblWatch']['CruiseID'].to_numpy())
+    watches = tables['tblWatch'].assign(_cruise_row=watch_cruise)
+    watches = watches.sort_values(['_cruise_row', 'WatchID'], kind='stable').reset_index(drop=True)
+    cruise_rows = watches.pop('_cruise_row').to_numpy()
+
+    # position of every sighting's watch in the sorted watch table, -1 if the watch doesn't exist
+    watch_order = np.argsort(watches['WatchID'].to_numpy(), kind='stable')
+    sightings = tables['tblSighting']
+    sighting_watch = _positions(watches['WatchID'].to_numpy(), watch_order, sightings['WatchID'].to_numpy())
+    sightings = sightings.assign(_watch_row=sighting_watch)
+    sightings = sightings.sort_values(['_watch_row', 'FlockID'], kind='stable').reset_index(drop=True)
+
+    # orphan sightings (no matching watch) are quarantined by validation, but if that rule is turned off they're kept
+    # at the front of the table, outside every watch block
+    watch_rows = sightings.pop('_watch_row').to_numpy()
+
+    offsets = {
+        'cruise_watch': _block_offsets(cruise_rows, len(cruises)),
+        'watch_sighting': _block_offsets(watch_rows, len(watches)),
+        'watch_order': watch_order,
+    }
+
+    sorted_tables = {'tblCruise': cruises, 'tblWatch': watches, 'tblSighting': sightings}
+    for name, key in DIMENSION_TABLES.items():
+        if name in tables:
+            sorted_tables[name] = tables[name].sort_values(key, kind='stable').reset_index(drop=True)
+
+    return sorted_tables, offsets
+
+
+def _positions(keys, order, values):
+    """Find the row of each value in the (unsorted) `keys` using their argsort `order`; -1 where a value is missing."""
+    if len(keys) == 0:
+        return np.full(len(values), -1, dtype=np.int64)
+    sorted_keys = keys[order]
+    values = np.asarray(values)
+    found = np.searchsorted(sorted_keys, values).clip(0, len(keys) - 1)
+    return np.where(sorted_keys[found] == values, order[found], -1).astype(np.int64)
+
+
+def _block_offsets(parent_rows, n_parents):
+    """
+    Turn the (sorted) parent row of each child row into an offsets array: the children of parent i are the rows
+    offsets[i]:offsets[i + 1].
+    """
+    return np.searchsorted(parent_rows, np.arange(n_parents + 1), side='left').astype(np.int64)
+
+
+def build_store(tables_dir=TABLES_DIR, store_dir=STORE_DIR):
+    """
+    Read the exported Access tables, sort them by key and save them with their offset arrays to `store_dir`.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+
+    names = FACT_TABLES + list(DIMENSION_TABLES)
+    sources = {name: _source_path(tables_dir, name) for name in names}
+    sources = {name: path for name, path in sources.items() if path is not None}
+    with stage('load') as record:
+        tables = {name: _read_table(path) for name, path in sources.items()}
+        # Access stores times of day separately from the date, so both are combined into one timestamp here
+        if 'tblWatch' in tables:
+            tables['tblWatch'] = combine_watch_times(tables['tblWatch'])
+        record.rows_out = count_rows(tables)
+
+    # check the loaded tables against the validation rules and take out the quarantined rows (see validation.py)
+    from validation import describe, lookup_sources, rules_version, validate, write_violations
+    with stage('validate', rows_in=record.rows_out) as record:
+        tables, violations, quarantined = validate(tables, tables_dir)
+        write_violations(violations, quarantined, store_dir)
+        record.rows_out = count_rows(tables)
+
+    with stage('sort', rows_in=record.rows_out):
+        sorted_tables, offsets = sort_tables(tables)
+    with stage('write', rows_in=record.rows_out):
+        for name, frame in sorted_tables.items():
+            _write_table(frame, store_dir, name)
+        np.savez(os.path.join(store_dir, 'offsets.npz'), **offsets)
+
+    # the manifest records the source files so the store can tell when it is out of date
+    manifest = {
+        'tables': {name: len(frame) for name, frame in sorted_tables.items()},
+        'sources': {name: [os.path.basename(path), os.path.getmtime(path)] for name, path in sources.items()},
+        'quarantined': {name: len(frame) for name, frame in quarantined.items()},
+        'violations': {str(rule): int(n) for rule, n in violations['Rule'].value_counts().items() if n},
+        # the validation depends on the lookup tables and the rules too, so a change to either rebuilds the store
+        'lookups': lookup_sources(tables_dir),
+        'rules': rules_version(),
+    }
+    with open(os.path.join(store_dir, 'manifest.json'), 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+
+    # also write the coordinate, time and count columns as memory-mapped arrays (see survey_arrays.py)
+    from survey_arrays import write_arrays
+    store = RelationalStore(store_dir)
+    with stage('write_arrays'):
+        write_arrays(store, os.path.join(os.path.dirname(store_dir), 'arrays'))
+
+    # and index the notes tables for full-text search (see notes_index.py)
+    from notes_index import build_index
+    with stage('write_notes_index'):
+        build_index(sorted_tables, os.path.join(os.path.dirname(store_dir), 'notes_index'))
+
+    print(describe(violations, quarantined))
+    print(f"Relational store written to {store_dir}")
+    return store
+
+
+def load_store(tables_dir=TABLES_DIR, store_dir=STORE_DIR):
+    """
+    Open the store, (re)building it first if it is missing or older than the exported tables, or if the lookup tables
+    or the rules it was validated with have changed since.
+    """
+    from validation import lookup_sources, rules_version
+
+    manifest_path = os.path.join(store_dir, 'manifest.json')
+    if os.path.exists(manifest_path):
+        with open(manifest_path) as manifest_file:
+            manifest = json.load(manifest_file)
+        sources = manifest['sources']
+        current = all(
+            isinstance(source, list) and _source_path(tables_dir, name) == os.path.join(tables_dir, source[0])
+            and os.path.getmtime(os.path.join(tables_dir, source[0])) == source[1]
+            for name, source in sources.items()
+        )
+        current = (current and manifest.get('rules') == rules_version()
+                   and manifest.get('lookups') == lookup_sources(tables_dir))
+        if current:
+            return RelationalStore(store_dir)
+    return build_store(tables_dir, store_dir)
+
+
+###########################
+# Reading from the store
+
+class RelationalStore:
+    """
+    Read access to the sorted tables. Tables are read from Parquet the first time they are used.
+    """
+
+    def __init__(self, store_dir=STORE_DIR):
+        self.store_dir = store_dir
+        self._tables = {}
+        with np.load(os.path.join(store_dir, 'offsets.npz')) as offsets:
+            self.cruise_watch = offsets['cruise_watch']
+            self.watch_sighting = offsets['watch_sighting']
+            self.watch_order = offsets['watch_order']
+
+    def table(self, name, columns=None, rows=None):
+        """
+        Return a stored table; asking for specific columns reads only those columns, and asking for specific rows reads
+        only the row groups that hold them.
+        """
+        if rows is not None:
+            return _read_rows(os.path.join(self.store_dir, f'{name}.parquet'),
+                              None if columns is None else list(columns), rows)
+        if columns is not None:
+            return pd.read_parquet(os.path.join(self.store_dir, f'{name}.parquet'), columns=list(columns))
+        if name not in self._tables:
+            self._tables[name] = pd.read_parquet(os.path.join(self.store_dir, f'{name}.parquet'))
+        return self._tables[name]
+
+    @property
+    def cruises(self):
+        return self.table('tblCruise')
+
+    @property
+    def watches(self):
+        return self.table('tblWatch')
+
+    @property
+    def sightings(self):
+        return self.table('tblSighting')
+
+    # key -> row lookups
+
+    def watch_rows(self, watch_ids):
+        """Return the row of each WatchID in the watch table (-1 for unknown watches)."""
+        return _positions(self.watches['WatchID'].to_numpy(), self.watch_order, watch_ids)
+
+    def cruise_rows(self, cruise_ids):
+        """Return the row of each CruiseID in the cruise table (-1 for unknown cruises)."""
+        keys = self.cruises['CruiseID'].to_numpy()
+        return _positions(keys, np.arange(len(keys)), cruise_ids)
+
+    # per-key slices
+
+    def watch_slice(self, cruise_id):
+        """Return the slice of watch rows belonging to a cruise."""
+        row = self.cruise_rows([cruise_id])[0]
+        if row < 0:
+            return slice(0, 0)
+        return slice(self.cruise_watch[row], self.cruise_watch[row + 1])
+
+    def sighting_slice(self, watch_id):
+        """Return the slice of sighting rows belonging to a watch."""
+        row = self.watch_rows([watch_id])[0]
+        if row < 0:
+            return slice(0, 0)
+        return slice(self.watch_sighting[row], self.watch_sighting[row + 1])
+
+    def watches_for_cruise(self, cruise_id):
+        return self.watches.iloc[self.watch_slice(cruise_id)]
+
+    def sightings_for_watch(self, watch_id):
+        return self.sightings.iloc[self.sighting_slice(watch_id)]
+
+    def sightings_for_cruise(self, cruise_id):
+        """All sightings of a cruise are one contiguous block too, because sightings follow the watch order."""
+        watches = self.watch_slice(cruise_id)
+        if watches.start == watches.stop:
+            return self.sightings.iloc[0:0]
+        return self.sightings.iloc[self.watch_sighting[watches.start]:self.watch_sighting[watches.stop]]
+
+    # merge-joins
+
+    def sighting_watch_rows(self):
+        """Return the watch row of every sighting in a watch block, expanded from the offsets."""
+        return np.repeat(np.arange(len(self.watch_sighting) - 1), np.diff(self.watch_sighting))
+
+    def watch_cruise_rows(self):
+        """Return the cruise row of every watch, expanded from the offsets."""
+        orphans = np.full(self.cruise_watch[0], -1, dtype=np.int64)
+        return np.concatenate([orphans, np.repeat(np.arange(len(self.cruise_watch) - 1), np.diff(self.cruise_watch))])
+
+    def cruise_attributes(self, watch_rows, columns):
+        """
+        Return cruise columns for the given watch rows (NaN for rows of -1), without widening the watch or sighting
+        tables.
+        """
+        watch_rows = np.asarray(watch_rows)
+        cruise_rows = np.where(watch_rows >= 0, self.watch_cruise_rows()[watch_rows.clip(0)], -1)
+        return self.cruises[list(columns)].reindex(cruise_rows).reset_index(drop=True)
+
+    def dimension_rows(self, name, ids):
+        """Return the row of each id in a dimension table sorted by its key (-1 where there is no match)."""
+        keys = self.table(name)[DIMENSION_TABLES[name]].to_numpy()
+        values = pd.to_numeric(pd.Series(np.asarray(ids)), errors='coerce').fillna(-1).to_numpy(dtype=np.int64)
+        return _positions(keys, np.arange(len(keys)), values)
+
+    def species_rows(self, spec_info_ids):
+        """Return the tblSpeciesInfo row of each SpecInfoID (-1 for unknown species)."""
+        return self.dimension_rows('tblSpeciesInfo', spec_info_ids)
+
+    def notes(self, name, ids):
+        """
+        Return the first non-empty note in a notes table for each id, or NaN where there is none.
+
+        The notes tables are sorted by their key, so only the row groups between the smallest and biggest id are read.
+        """
+        key = DIMENSION_TABLES[name]
+        numeric = pd.to_numeric(pd.Series(np.asarray(ids)), errors='coerce')
+        values = numeric.fillna(-1).to_numpy(dtype=np.int64)
+        known = numeric.dropna()
+        if len(known) == 0:
+            return np.full(len(values), np.nan, dtype=object)
+        notes = pd.read_parquet(os.path.join(self.store_dir, f'{name}.parquet'),
+                                filters=[(key, '>=', int(known.min())), (key, '<=', int(known.max()))])
+        notes = notes[notes['Note'].notna()].drop_duplicates(subset=[key])
+        keys = notes[key].to_numpy(dtype=np.int64)
+        found = _positions(keys, np.arange(len(keys)), values)
+
+        result = np.full(len(found), np.nan, dtype=object)
+        result[found >= 0] = notes['Note'].to_numpy()[found[found >= 0]]
+        return result
+
+    def watch_sightings(self, watch_columns=None, sighting_columns=None, species_columns=None):
+        """
+        Return one row per sighting, plus one row for each watch without sightings, with the watch, sighting and species
+        columns side by side (the layout of `final_df` in preprocessing.py).
+
+        Because sightings are stored in watch order, every watch's rows are found from the offsets alone: the watch
+        columns are repeated by block size and the sighting columns are taken in order.
+        """
+        watches = self.watches if watch_columns is None else self.watches[list(watch_columns)]
+        sightings = self.sightings if sighting_columns is None else self.sightings[list(sighting_columns)]
+        sightings = sightings.drop(columns=[c for c in sightings.columns if c in watches.columns and c != 'WatchID'])
+
+        # every watch gets at least one row, watches without sightings get a row of NaN sighting columns
+        n_sightings = np.diff(self.watch_sighting)
+        n_rows = np.maximum(n_sightings, 1)
+        watch_idx = np.repeat(np.arange(len(watches)), n_rows)
+        within = np.arange(len(watch_idx)) - np.repeat(np.cumsum(n_rows) - n_rows, n_rows)
+        sighting_idx = np.repeat(self.watch_sighting[:-1], n_rows) + within
+        sighting_idx[np.repeat(n_sightings == 0, n_rows)] = -1
+
+        joined = watches.iloc[watch_idx].reset_index(drop=True)
+        sighting_part = sightings.drop(columns='WatchID').reset_index(drop=True).reindex(sighting_idx)
+        joined = pd.concat([joined, sighting_part.reset_index(drop=True)], axis=1)
+
+        if 'SpecInfoID' in joined:
+            species = self.table('tblSpeciesInfo')
+            if species_columns is not None:
+                species = species[['SpecInfoID'] + [c for c in species_columns if c != 'SpecInfoID']]
+            species = species.drop(columns=[c for c in species.columns if c in joined.columns and c != 'SpecInfoID'])
+            species_part = species.drop(columns='SpecInfoID').reindex(self.species_rows(joined['SpecInfoID']))
+            joined = pd.concat([joined, species_part.reset_index(drop=True)], axis=1)
+
+        return joined
@@ -0,0 +1,210 @@
+#####################################################
+##########   MEMORY-MAPPED SURVEY ARRAYS    #########
+
+"""
+The map, distance and density calculations each pull `LatStart`, `LongStart`, `Count` and `WatchID` out of a DataFrame,
+which copies the columns every time, and every worker process ends up holding its own copy.
+
+Here I write the columns those calculations need as plain fixed-width NumPy arrays (one `.npy` file per column) next to
+the relational store, with a small JSON header describing them:
+
+- one row per watch (in store order): WatchID, CruiseID, start/end coordinates, start/end times as int64 nanoseconds,
+  effort (ObsLen, minutes) and PlatformClass
+- one row per sighting (in store order): the watch row it belongs to, SpecInfoID, a species code and the count
+
+`open_arrays` opens them memory-mapped and read-only, so every process on a node shares the same page-cache copy and
+nothing is read until it is used. The helpers at the bottom work directly on those arrays.
+"""
+
+# load the required modules
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from store import CACHE_DIR
+
+
+# Define the folder for the arrays
+ARRAYS_DIR = os.path.join(CACHE_DIR, 'arrays')
+
+# Bumped whenever the layout of the arrays changes
+FORMAT_VERSION = 1
+
+# Fixed dtypes for every array, so readers never have to guess
+WATCH_ARRAYS = {
+    'watch_id': np.int64,
+    'cruise_id': np.int64,
+    'lat_start': np.float64,
+    'lon_start': np.float64,
+    'lat_end': np.float64,
+    'lon_end': np.float64,
+    'start_ns': np.int64,
+    'end_ns': np.int64,
+    'effort_min': np.float32,
+    'platform_class': np.int8,
+}
+SIGHTING_ARRAYS = {
+    'watch_row': np.int64,
+    'spec_info_id': np.int64,
+    'species_code': np.int32,
+    'count': np.float32,
+}
+
+# Marks missing times in the int64 time arrays (the same value pandas uses for NaT)
+NAT = np.iinfo(np.int64).min
+
+# Mean radius of the Earth in kilometers
+EARTH_RADIUS_KM = 6371.0
+
+
+#######################
+# Writing the arrays
+
+def _times_ns(values):
+    """Convert a datetime column into int64 nanoseconds since 1970, with NAT for missing times."""
+    times = pd.to_datetime(values, errors='coerce').astype('datetime64[ns]')
+    return times.to_numpy().view(np.int64)
+
+
+def _write(directory, name, values, dtype):
+    """Write one array to `<name>.npy` and return its header entry."""
+    np.save(os.path.join(directory, f'{name}.npy'), np.asarray(values).astype(dtype, copy=False))
+    return {'dtype': np.dtype(dtype).str, 'shape': [len(values)]}
+
+
+def write_arrays(store, arrays_dir=ARRAYS_DIR):
+    """
+    Write the watch and sighting arrays from a RelationalStore. Called at the end of `build_store`, so the arrays
+    always match the store they were built from.
+    """
+    os.makedirs(arrays_dir, exist_ok=True)
+    watches = store.watches
+    sightings = store.sightings
+
+    watch_columns = {
+        'watch_id': watches['WatchID'].to_numpy(),
+        'cruise_id': watches['CruiseID'].to_numpy(),
+        'lat_start': watches['LatStart'].to_numpy(dtype=np.float64),
+        'lon_start': watches['LongStart'].to_numpy(dtype=np.float64),
+        'lat_end': watches['LatEnd'].to_numpy(dtype=np.float64),
+        'lon_end': watches['LongEnd'].to_numpy(dtype=np.float64),
+        'start_ns': _times_ns(watches['StartTime']),
+        'end_ns': _times_ns(watches['EndTime']),
+        'effort_min': watches['ObsLen'].to_numpy(dtype=np.float64),
+        'platform_class': watches['PlatformClass'].fillna(0).to_numpy(),
+    }
+
+    # sightings outside every watch block (orphans) get a watch row of -1
+    watch_rows = np.full(len(sightings), -1, dtype=np.int64)
+    watch_rows[store.watch_sighting[0]:store.watch_sighting[-1]] = store.sighting_watch_rows()
+
+    # species are numbered by their position in the sorted tblSpeciesInfo, so the codes can index the species list
+    species = store.table('tblSpeciesInfo')
+    sighting_columns = {
+        'watch_row': watch_rows,
+        'spec_info_id': sightings['SpecInfoID'].fillna(-1).to_numpy(),
+        'species_code': store.species_rows(sightings['SpecInfoID']),
+        'count': sightings['Count'].to_numpy(dtype=np.float64),
+    }
+
+    header = {
+        'version': FORMAT_VERSION,
+        'n_watches': len(watches),
+        'n_sightings': len(sightings),
+        'nat': NAT,
+        'species': species['Alpha'].fillna('').tolist(),
+        'watch': {name: _write(arrays_dir, name, values, WATCH_ARRAYS[name]) for name, values in watch_columns.items()},
+        'sighting': {name: _write(arrays_dir, name, values, SIGHTING_ARRAYS[name])
+                     for name, values in sighting_columns.items()},
+    }
+    with open(os.path.join(arrays_dir, 'header.json'), 'w') as header_file:
+        json.dump(header, header_file, indent=2)
+
+    return open_arrays(arrays_dir)
+
+
+#######################
+# Reading the arrays
+
+class SurveyArrays:
+    """
+    Read-only memory-mapped watch and sighting arrays, available as attributes (e.g. `arrays.lat_start`).
+    """
+
+    def __init__(self, arrays_dir=ARRAYS_DIR):
+        self.arrays_dir = arrays_dir
+        with open(os.path.join(arrays_dir, 'header.json')) as header_file:
+            self.header = json.load(header_file)
+        if self.header['version'] != FORMAT_VERSION:
+            raise ValueError(f"{arrays_dir} was written with format {self.header['version']}, "
+                             f"expected {FORMAT_VERSION}; rebuild the store")
+
+        self.species = np.array(self.header['species'], dtype=object)
+        for group in ('watch', 'sighting'):
+            for name, entry in self.header[group].items():
+                # an empty file can't be memory-mapped, so empty arrays are simply loaded
+                mmap_mode = 'r' if entry['shape'][0] else None
+                setattr(self, name, np.load(os.path.join(arrays_dir, f'{name}.npy'), mmap_mode=mmap_mode))
+
+    @property
+    def n_watches(self):
+        return self.header['n_watches']
+
+    @property
+    def n_sightings(self):
+        return self.header['n_sightings']
+
+    def watch_totals(self, species_code=None):
+        """Total count per watch (optionally for one species code), from the sighting arrays without copying them."""
+        keep = self.watch_row >= 0
+        if species_code is not None:
+            keep &= self.species_code == species_code
+        return np.bincount(self.watch_row[keep], weights=self.count[keep], minlength=self.n_watches)
+
+    def species_index(self, alpha):
+        """Return the species code of an Alpha code, or -1 if it isn't in tblSpeciesInfo."""
+        matches = np.flatnonzero(self.species == alpha)
+        return int(matches[0]) if len(matches) else -1
+
+
+def open_arrays(arrays_dir=ARRAYS_DIR):
+    """Open the memory-mapped survey arrays."""
+    return SurveyArrays(arrays_dir)
+
+
+#######################
+# Spatial helpers
+
+def haversine_km(lat1, lon1, lat2, lon2):
+    """Great circle distance in kilometers between points given in decimal degrees (works on whole arrays)."""
+    lat1, lon1, lat2, lon2 = map(np.radians, (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(a))
+
+
+def grid_totals(lat, lon, weights, cell_deg=0.1, bounds=None):
+    """
+    Sum `weights` into a regular lat/lon grid of `cell_deg` degree cells.
+
+    Returns the grid (rows are latitude bands from south to north) and the (min_lat, min_lon) of its corner.
+    Points with missing coordinates are left out.
+    """
+    lat, lon, weights = np.asarray(lat), np.asarray(lon), np.asarray(weights, dtype=np.float64)
+    keep = np.isfinite(lat) & np.isfinite(lon)
+    lat, lon, weights = lat[keep], lon[keep], weights[keep]
+    if bounds is None:
+        if len(lat) == 0:
+            return np.zeros((0, 0)), (np.nan, np.nan)
+        bounds = (lat.min(), lon.min(), lat.max(), lon.max())
+
+    min_lat, min_lon, max_lat, max_lon = bounds
+    n_rows = int(np.floor((max_lat - min_lat) / cell_deg)) + 1
+    n_cols = int(np.floor((max_lon - min_lon) / cell_deg)) + 1
+    rows = np.floor((lat - min_lat) / cell_deg).astype(np.int64)
+    cols = np.floor((lon - min_lon) / cell_deg).astype(np.int64)
+    inside = (rows >= 0) & (rows < n_rows) & (cols >= 0) & (cols < n_cols)
+
+    cells = np.bincount(rows[inside] * n_cols + cols[inside], weights=weights[inside], minlength=n_rows * n_cols)
+    return cells.reshape(n_rows, n_cols), (min_lat, min_lon)
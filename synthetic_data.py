@@ -0,0 +1,308 @@
+#####################################################
+##############   SYNTHETIC SURVEY DATA    ###########
+
+"""
+The repository ships a single 17-day cruise (174 watches, 470 sightings), which says little about how the scripts
+behave on the 10^5 - 10^7 sightings of a full ECSAS extract.
+
+Here I generate survey tables of any size with the same schema as the exported Access tables (see
+`ECSAS_tables/FileS1_all-tables.txt`), using the real tables as the template:
+
+- Cruises get a start date between 2000 and 2024, a company, platform, observer and ports drawn from the lkp tables.
+- Watches follow a ship track for each cruise: a random walk from a start point on the Atlantic Canadian shelf, where the
+  ship keeps roughly its heading between watches and stays put during stationary (PlatformClass 2) watches. Watches are
+  spaced through each cruise like in the real data, and the ship moves during moving (PlatformClass 3) watches.
+- Sightings are spread unevenly over the watches (many watches see nothing, a few see a lot). Species are drawn from the
+  species seen in the real cruise by how often they were seen, plus a tail of the other seabirds in tblSpeciesInfo, and
+  counts are resampled from the real counts.
+- Every other column (weather, sea state, distance codes, plumage, ...) is resampled from the real column, so the codes,
+  their frequencies and the share of missing values match the export.
+- Watch and sighting notes are resampled from the real notes for about the same share of watches and sightings.
+
+IDs are unique random-looking int32 values like Access random autonumbers. The lkp tables and tblSpeciesInfo are copied
+as they are. The fact tables are written as Parquet, which store.py reads in place of the Excel export.
+
+    python synthetic_data.py 1000000 synthetic/ECSAS_tables
+"""
+
+# load the required modules
+import argparse
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+
+from store import TABLES_DIR
+
+
+# Tables copied unchanged from the real export
+COPIED_PREFIXES = ('lkp',)
+COPIED_TABLES = ('tblSpeciesInfo',)
+
+# Area the cruise tracks start in (min lat, min lon, max lat, max lon), roughly the Atlantic Canadian shelf
+START_BOX = (42.0, -66.0, 58.0, -45.0)
+
+# Ship speed while moving, in degrees of latitude per hour (about 10 knots)
+SPEED_DEG_PER_HOUR = 0.17
+
+# Years the synthetic cruises start in
+YEARS = (2000, 2024)
+
+# Share of sightings drawn from the long tail of tblSpeciesInfo seabirds instead of the species in the real cruise
+RARE_SPECIES_SHARE = 0.05
+
+
+###########################
+# Helpers
+
+def _read(tables_dir, name):
+    return pd.read_excel(os.path.join(tables_dir, f'{name}.xlsx'))
+
+
+def _unique_ids(n, rng):
+    """n distinct int32 IDs in random order, spread over the whole int32 range like Access random autonumbers."""
+    stride = max(1, (2 ** 32 - 1) // max(n, 1))
+    return (np.int64(-2 ** 31) + rng.permutation(n).astype(np.int64) * stride
+            + rng.integers(0, stride, n)).astype(np.int64)
+
+
+def _resample(column, n, rng):
+    """Draw n values from a real column, keeping its code frequencies and share of missing values."""
+    values = column.to_numpy()
+    if len(values) == 0:
+        return np.full(n, np.nan)
+    return values[rng.integers(0, len(values), n)]
+
+
+def _fill_columns(template, generated, n, rng):
+    """Build a table with the template's columns, using the generated columns and resampling every other one."""
+    columns = {}
+    for name in template.columns:
+        columns[name] = generated[name] if name in generated else _resample(template[name], n, rng)
+    frame = pd.DataFrame(columns)
+    # resampled integer columns keep their dtype, generated ones may need it restored
+    for name in template.columns:
+        if name not in generated and template[name].dtype.kind in 'iub':
+            frame[name] = frame[name].astype(template[name].dtype)
+    return frame
+
+
+def _within_group_cumsum(values, group_starts):
+    """Cumulative sum of `values` restarting at every index in `group_starts` (the groups are contiguous)."""
+    totals = np.cumsum(values)
+    before = np.concatenate([[0.0], totals[group_starts[1:] - 1]])
+    group_of_row = np.searchsorted(group_starts, np.arange(len(values)), side='right') - 1
+    return totals - before[group_of_row]
+
+
+###########################
+# Generating the tables
+
+def generate_tables(n_sightings, seed=0, tables_dir=TABLES_DIR):
+    """
+    Generate tblCruise, tblWatch, tblSighting and the notes tables with about `n_sightings` sightings.
+
+    Returns a dict of DataFrames; the sizes of the real cruise (watches per cruise, sightings per watch) are kept.
+    """
+    rng = np.random.default_rng(seed)
+    real = {name: _read(tables_dir, name) for name in
+            ['tblCruise', 'tblWatch', 'tblSighting', 'tblSpeciesInfo', 'tblWatchNotes', 'tblSightingNotes',
+             'tblCruiseNotes', 'lkpCompany', 'lkpPlatform', 'lkpPlatformType', 'lkpObserver', 'lkpPorts', 'lkpProgram']}
+
+    sightings_per_watch = len(real['tblSighting']) / len(real['tblWatch'])
+    watches_per_cruise = len(real['tblWatch']) / len(real['tblCruise'])
+    n_watches = max(1, int(round(n_sightings / sightings_per_watch)))
+    n_cruises = max(1, int(round(n_watches / watches_per_cruise)))
+
+    cruises = _generate_cruises(real, n_cruises, rng)
+    watches = _generate_watches(real, cruises, n_watches, rng)
+    sightings = _generate_sightings(real, watches, n_sightings, rng)
+
+    return {
+        'tblCruise': cruises,
+        'tblWatch': watches,
+        'tblSighting': sightings,
+        'tblWatchNotes': _generate_notes(real['tblWatchNotes'], 'WatchID', watches['WatchID'],
+                                         len(real['tblWatch']), rng),
+        'tblSightingNotes': _generate_notes(real['tblSightingNotes'], 'SightingID', sightings['FlockID'],
+                                            len(real['tblSighting']), rng),
+        'tblCruiseNotes': real['tblCruiseNotes'].iloc[:0],
+    }
+
+
+def _generate_cruises(real, n_cruises, rng):
+    template = real['tblCruise']
+    days = (pd.Timestamp(f'{YEARS[1]}-12-31') - pd.Timestamp(f'{YEARS[0]}-01-01')).days
+    start = pd.Timestamp(f'{YEARS[0]}-01-01') + pd.to_timedelta(rng.integers(0, days, n_cruises), unit='D')
+    # cruise lengths resampled around the real one (17 days)
+    real_length = (template['End Date'] - template['Start Date']).dt.days.to_numpy()
+    length = np.maximum(1, rng.poisson(real_length.mean(), n_cruises))
+
+    def lookup(table, column, n):
+        return real[table][column].to_numpy()[rng.integers(0, len(real[table]), n)]
+
+    # the first cruise keeps the real CruiseID, since basic-metrics.py reports on that cruise
+    cruise_ids = _unique_ids(n_cruises, rng)
+    real_id = template['CruiseID'].iloc[0]
+    if real_id not in cruise_ids:
+        cruise_ids[0] = real_id
+
+    ports = lookup('lkpPorts', 'PortID', n_cruises)
+    generated = {
+        'CruiseID': cruise_ids,
+        'Company': lookup('lkpCompany', 'CompanyID', n_cruises),
+        'PlatformName': lookup('lkpPlatform', 'PlatformID', n_cruises),
+        'PlatformType': lookup('lkpPlatformType', 'PlatformTypeID', n_cruises),
+        'Observer': lookup('lkpObserver', 'ObserverID', n_cruises),
+        'Start Date': start,
+        'End Date': start + pd.to_timedelta(length, unit='D'),
+        # most cruises come back to the port they left from
+        'Start Port': ports,
+        'End Port': np.where(rng.random(n_cruises) < 0.8, ports, lookup('lkpPorts', 'PortID', n_cruises)),
+        'Program': lookup('lkpProgram', 'ProgramID', n_cruises),
+    }
+    return _fill_columns(template, generated, n_cruises, rng)
+
+
+def _generate_watches(real, cruises, n_watches, rng):
+    template = real['tblWatch']
+    n_cruises = len(cruises)
+
+    # spread the watches over the cruises (every cruise gets at least one) and keep them grouped by cruise
+    per_cruise = 1 + rng.multinomial(n_watches - n_cruises, np.full(n_cruises, 1 / n_cruises)) \
+        if n_watches > n_cruises else np.ones(n_cruises, dtype=np.int64)
+    n_watches = int(per_cruise.sum())
+    cruise_rows = np.repeat(np.arange(n_cruises), per_cruise)
+    group_starts = np.concatenate([[0], np.cumsum(per_cruise)[:-1]])
+
+    # watch times: evenly spread over each cruise with some jitter, in order
+    cruise_start = cruises['Start Date'].to_numpy()[cruise_rows]
+    cruise_hours = ((cruises['End Date'] - cruises['Start Date']).dt.total_seconds().to_numpy() / 3600)[cruise_rows]
+    position = np.arange(n_watches) - group_starts[cruise_rows]
+    fraction = np.clip((position + rng.random(n_watches)) / per_cruise[cruise_rows], 0, 1)
+    start_time = cruise_start + pd.to_timedelta(fraction * cruise_hours, unit='h').to_numpy()
+
+    platform_class = _resample(template['PlatformClass'], n_watches, rng)
+    moving = platform_class == 3
+    obs_len = np.where(moving, rng.choice([5.0, 10.0, 15.0], n_watches), rng.choice([0.0, 1.0], n_watches))
+
+    # ship track: the heading drifts a little between watches, and the ship covers the time since the last watch
+    heading = (rng.uniform(0, 2 * np.pi, n_cruises)[cruise_rows]
+               + _within_group_cumsum(rng.normal(0, 0.3, n_watches), group_starts))
+    gap_hours = np.diff(fraction * cruise_hours, prepend=0.0)
+    gap_hours[group_starts] = 0.0
+    # the ship only steams for part of the time between watches
+    step = SPEED_DEG_PER_HOUR * gap_hours * rng.uniform(0.05, 0.3, n_watches)
+    start_lat = rng.uniform(START_BOX[0], START_BOX[2], n_cruises)[cruise_rows]
+    start_lon = rng.uniform(START_BOX[1], START_BOX[3], n_cruises)[cruise_rows]
+    lat = np.clip(start_lat + _within_group_cumsum(step * np.cos(heading), group_starts), 38.0, 75.0)
+    lon_scale = np.cos(np.radians(lat))
+    lon = np.clip(start_lon + _within_group_cumsum(step * np.sin(heading), group_starts) / lon_scale, -80.0, -5.0)
+
+    # moving watches end further along the track, stationary ones where they started
+    moved = SPEED_DEG_PER_HOUR * obs_len / 60 * moving
+    lat_end = np.where(rng.random(n_watches) < 0.2, np.nan, lat + moved * np.cos(heading))
+    lon_end = np.where(np.isnan(lat_end), np.nan, lon + moved * np.sin(heading) / lon_scale)
+
+    start_time = pd.to_datetime(start_time).floor('s')
+    generated = {
+        'WatchID': _unique_ids(n_watches, rng),
+        'CruiseID': cruises['CruiseID'].to_numpy()[cruise_rows],
+        'Observer': cruises['Observer'].to_numpy()[cruise_rows],
+        'Date': start_time.normalize(),
+        'StartTime': start_time,
+        'EndTime': start_time + pd.to_timedelta(obs_len, unit='m'),
+        'ObsLen': obs_len,
+        'LatStart': lat,
+        'LongStart': lon,
+        'LatEnd': lat_end,
+        'LongEnd': lon_end,
+        'PlatformClass': platform_class,
+    }
+    # Access exports keep the watches in no particular order
+    return _fill_columns(template, generated, n_watches, rng).sample(frac=1, random_state=rng.integers(2 ** 31),
+                                                                       ignore_index=True)
+
+
+def _generate_sightings(real, watches, n_sightings, rng):
+    template = real['tblSighting']
+    n_watches = len(watches)
+
+    # overdispersed activity per watch, so many watches see nothing and a few see a lot
+    activity = rng.gamma(0.4, 1.0, n_watches)
+    watch_rows = np.sort(rng.choice(n_watches, n_sightings, p=activity / activity.sum()))
+
+    # species: mostly the ones in the real cruise by how often they were seen, plus a tail of other seabirds
+    seen = template['SpecInfoID'].value_counts()
+    species = real['tblSpeciesInfo']
+    seabirds = species.loc[species['Seabird'].fillna(0) != 0, 'SpecInfoID'].to_numpy()
+    if len(seabirds) == 0:
+        seabirds = species['SpecInfoID'].to_numpy()
+    spec_info = rng.choice(seen.index.to_numpy(), n_sightings, p=(seen / seen.sum()).to_numpy())
+    rare = rng.random(n_sightings) < RARE_SPECIES_SHARE
+    # tail species get Zipf-like weights so a few of them are common and most are rare
+    tail_weights = 1.0 / np.arange(1, len(seabirds) + 1)
+    spec_info[rare] = rng.choice(rng.permutation(seabirds), rare.sum(), p=tail_weights / tail_weights.sum())
+
+    # sightings are positioned near their watch and timed during it
+    lat = watches['LatStart'].to_numpy()[watch_rows]
+    lon = watches['LongStart'].to_numpy()[watch_rows]
+    obs_minutes = watches['ObsLen'].fillna(0).to_numpy()[watch_rows] * rng.random(n_sightings)
+    generated = {
+        'FlockID': _unique_ids(n_sightings, rng),
+        'WatchID': watches['WatchID'].to_numpy()[watch_rows],
+        'ObsLat': lat + rng.normal(0, 0.002, n_sightings),
+        'ObsLong': lon + rng.normal(0, 0.003, n_sightings),
+        'ObsTime': (watches['StartTime'].to_numpy()[watch_rows]
+                    + pd.to_timedelta(obs_minutes, unit='m').to_numpy()).astype('datetime64[s]'),
+        'SpecInfoID': spec_info,
+        'Count': _resample(template['Count'], n_sightings, rng),
+    }
+    return _fill_columns(template, generated, n_sightings, rng).sample(frac=1, random_state=rng.integers(2 ** 31),
+                                                                         ignore_index=True)
+
+
+def _generate_notes(template, key, ids, n_real_parents, rng):
+    """Attach resampled notes to about the same share of rows as in the real tables."""
+    if template.empty:
+        return template.iloc[:0]
+    share = min(1.0, len(template) / max(n_real_parents, 1))
+    noted = ids.to_numpy()[rng.random(len(ids)) < share]
+    return pd.DataFrame({
+        'NoteID': _unique_ids(len(noted), rng),
+        key: noted,
+        'Note': _resample(template['Note'], len(noted), rng),
+    })
+
+
+###########################
+# Writing the tables
+
+def write_tables(tables, out_dir, tables_dir=TABLES_DIR):
+    """Write the generated tables as Parquet and copy the lkp tables and tblSpeciesInfo from the real export."""
+    os.makedirs(out_dir, exist_ok=True)
+    for name in os.listdir(tables_dir):
+        stem, extension = os.path.splitext(name)
+        if extension == '.xlsx' and (stem.startswith(COPIED_PREFIXES) or stem in COPIED_TABLES):
+            shutil.copy2(os.path.join(tables_dir, name), os.path.join(out_dir, name))
+    for name, frame in tables.items():
+        frame.to_parquet(os.path.join(out_dir, f'{name}.parquet'), index=False)
+    return out_dir
+
+
+def generate(n_sightings, out_dir, seed=0, tables_dir=TABLES_DIR):
+    """Generate and write a synthetic export with about `n_sightings` sightings to `out_dir`."""
+    return write_tables(generate_tables(n_sightings, seed, tables_dir), out_dir, tables_dir)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Generate synthetic ECSAS survey tables.')
+    parser.add_argument('sightings', type=float, help='number of sightings (e.g. 1e6)')
+    parser.add_argument('out_dir', help='folder to write the tables to')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    tables = generate_tables(int(args.sightings), args.seed)
+    write_tables(tables, args.out_dir)
+    print(', '.join(f'{name}: {len(frame)} rows' for name, frame in tables.items()))
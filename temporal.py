@@ -0,0 +1,407 @@
+#####################################################
+###############   TEMPORAL BINNING    ###############
+
+"""
+The scripts handle time one row at a time. `GAM_scatter.py` numbers the survey days through a Python dict of dates,
+and `interactive_map.py` turns StartTime into `datetime.time` objects and Date into text before doing anything else
+with them, so no datetime operation can be used on them afterwards.
+
+The store already combines Date with StartTime/EndTime once (see `combine_watch_times` in store.py), and the survey
+arrays keep the results as int64 nanoseconds since 1970 (`start_ns`, `end_ns`, with NAT for missing times). Here I bin
+those integers directly, with whole-array integer arithmetic:
+
+- time of day: bins of `minutes` minutes since midnight (hours by default)
+- day of cruise: days since the first watch day of each cruise, starting at Day 1
+- calendar periods: day, week (starting on Monday), month, season and year, as period numbers since 1970
+- season: meteorological seasons of the northern hemisphere (Dec-Feb winter, Mar-May spring, Jun-Aug summer, Sep-Nov
+  autumn). December counts toward the winter of the following year
+
+`binned_totals` sums the counts per species and the effort (watches and minutes) for any mix of these bins and the
+cruise, and `resample` gives a gap-free time series per period (optionally per cruise) that `rolling` smooths into
+birds per watch over a moving window. Every aggregate is one `np.bincount` over the sightings, so decades of watches
+are summarized without a Python loop over watches or dates.
+
+    python temporal.py Season                 # birds per watch by season and species
+    python temporal.py resample --freq W      # weekly counts
+"""
+
+# load the required modules
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from survey_arrays import NAT, open_arrays
+
+
+# Lengths of time in nanoseconds
+NS_PER_MINUTE = 60 * 10 ** 9
+NS_PER_HOUR = 60 * NS_PER_MINUTE
+NS_PER_DAY = 24 * NS_PER_HOUR
+
+# 1970-01-01 was a Thursday, so weeks counted from day -3 (Monday 1969-12-29) start on Mondays
+WEEK_SHIFT_DAYS = 3
+
+# Season names in the order of their numbers
+SEASONS = ['Winter', 'Spring', 'Summer', 'Autumn']
+
+# Width of the time-of-day bins (minutes)
+TIME_OF_DAY_MINUTES = 60
+
+# Marks a bin that couldn't be calculated (missing time) in the bins that are never negative
+MISSING = -1
+
+
+###########################
+# Timestamps
+
+def to_ns(values):
+    """Convert datetime-like values (a column, array or list) to int64 nanoseconds since 1970, NAT where missing."""
+    times = pd.to_datetime(pd.Series(np.asarray(values)), errors='coerce').astype('datetime64[ns]')
+    return times.to_numpy().view(np.int64)
+
+
+def _timed(ns):
+    ns = np.asarray(ns, dtype=np.int64)
+    return ns, ns != NAT
+
+
+def date_text(ns):
+    """YYYY-MM-DD of each timestamp, '' where missing."""
+    ns, timed = _timed(ns)
+    return np.where(timed, np.datetime_as_string(ns.view('datetime64[ns]'), unit='D'), '')
+
+
+def clock_text(ns):
+    """HH:MM:SS of each timestamp, '' where missing."""
+    ns, timed = _timed(ns)
+    # the time is the part after the 'T' of YYYY-MM-DDTHH:MM:SS
+    text = pd.Series(np.datetime_as_string(ns.view('datetime64[ns]'), unit='s')).str[11:].to_numpy(dtype=str)
+    return np.where(timed, text, '')
+
+
+###########################
+# Bins
+
+def time_of_day(ns, minutes=TIME_OF_DAY_MINUTES):
+    """Number of the `minutes` wide bin since midnight of each timestamp (0 starts at midnight), MISSING if missing."""
+    ns, timed = _timed(ns)
+    # numpy's % is a floor modulo, so times before 1970 still give the time since their own midnight
+    return np.where(timed, (ns % NS_PER_DAY) // (minutes * NS_PER_MINUTE), MISSING)
+
+
+def day(ns):
+    """Days since 1970-01-01, NAT where missing."""
+    ns, timed = _timed(ns)
+    return np.where(timed, ns // NS_PER_DAY, NAT)
+
+
+def week(ns):
+    """Weeks (starting on Mondays) since the week of 1970-01-01, NAT where missing."""
+    days, timed = _timed(day(ns))
+    return np.where(timed, (days + WEEK_SHIFT_DAYS) // 7, NAT)
+
+
+def month(ns):
+    """Months since January 1970, NAT where missing."""
+    # numpy turns NaT into NaT at every unit, and NaT is the same integer as NAT
+    return np.asarray(ns, dtype=np.int64).view('datetime64[ns]').astype('datetime64[M]').view(np.int64)
+
+
+def year(ns):
+    """Calendar year of each timestamp, MISSING where missing."""
+    years, timed = _timed(np.asarray(ns, dtype=np.int64).view('datetime64[ns]').astype('datetime64[Y]').view(np.int64))
+    return np.where(timed, years + 1970, MISSING)
+
+
+def month_of_year(ns):
+    """Month of each timestamp from 1 (January) to 12, MISSING where missing."""
+    months, timed = _timed(month(ns))
+    return np.where(timed, months % 12 + 1, MISSING)
+
+
+def _year_period(ns):
+    """Years since 1970, NAT where missing."""
+    years, timed = _timed(year(ns))
+    return np.where(timed, years - 1970, NAT)
+
+
+def season_period(ns):
+    """Seasons since the winter of 1970 (December 1969 to February 1970), NAT where missing."""
+    months, timed = _timed(month(ns))
+    # moving every month one forward puts December in the same group of three as the January after it
+    return np.where(timed, (months + 1) // 3, NAT)
+
+
+def season(ns):
+    """Season number of each timestamp (an index into SEASONS), MISSING where missing."""
+    periods, timed = _timed(season_period(ns))
+    return np.where(timed, periods % 4, MISSING)
+
+
+def season_year(ns):
+    """Year each timestamp's season belongs to (December goes with the next year's winter), MISSING where missing."""
+    periods, timed = _timed(season_period(ns))
+    return np.where(timed, periods // 4 + 1970, MISSING)
+
+
+def day_of_cruise(ns, cruise_id):
+    """Day of each watch within its cruise, from Day 1 for the cruise's first watch day; MISSING where missing."""
+    days, timed = _timed(day(ns))
+    cruises, inverse = np.unique(np.asarray(cruise_id), return_inverse=True)
+    first = np.full(len(cruises), np.iinfo(np.int64).max)
+    np.minimum.at(first, inverse[timed], days[timed])
+    return np.where(timed, days - first[inverse] + 1, MISSING)
+
+
+def survey_day(ns):
+    """Number of each timestamp's day among the days that have any timestamp, from 1; MISSING where missing."""
+    days, timed = _timed(day(ns))
+    numbers = np.full(len(days), MISSING, dtype=np.int64)
+    numbers[timed] = np.unique(days[timed], return_inverse=True)[1].ravel() + 1
+    return numbers
+
+
+# Calendar periods: frequency -> (period number of a timestamp, start of a period number as datetime64)
+FREQUENCIES = {
+    'D': (day, lambda periods: periods.astype('datetime64[D]')),
+    'W': (week, lambda periods: (periods * 7 - WEEK_SHIFT_DAYS).astype('datetime64[D]')),
+    'M': (month, lambda periods: periods.astype('datetime64[M]')),
+    'S': (season_period, lambda periods: (periods * 3 - 1).astype('datetime64[M]')),
+    'Y': (_year_period, lambda periods: periods.astype('datetime64[Y]')),
+}
+
+
+def period(ns, freq):
+    """Period number of each timestamp for a frequency in FREQUENCIES ('D', 'W', 'M', 'S' or 'Y'), NAT where missing."""
+    if freq not in FREQUENCIES:
+        raise ValueError(f"Unknown frequency {freq!r}, choose from {', '.join(FREQUENCIES)}")
+    return FREQUENCIES[freq][0](ns)
+
+
+def period_start(periods, freq):
+    """First day of each period number, as datetime64 (NaT where the period is NAT)."""
+    periods, timed = _timed(periods)
+    start = FREQUENCIES[freq][1](np.where(timed, periods, 0)).astype('datetime64[ns]')
+    return np.where(timed, start, np.datetime64('NaT'))
+
+
+###########################
+# Bins of every watch
+
+# Watch bins that can be grouped by: name -> function of (arrays, start_ns)
+BINS = {
+    'CruiseID': lambda arrays, ns: np.asarray(arrays.cruise_id),
+    'TimeOfDay': lambda arrays, ns: time_of_day(ns),
+    'DayOfCruise': lambda arrays, ns: day_of_cruise(ns, arrays.cruise_id),
+    'Week': lambda arrays, ns: week(ns),
+    'Month': lambda arrays, ns: month_of_year(ns),
+    'Season': lambda arrays, ns: season(ns),
+    'SeasonYear': lambda arrays, ns: season_year(ns),
+    'Year': lambda arrays, ns: year(ns),
+}
+
+
+def watch_bins(arrays, bins=None):
+    """One row per watch (in store order) with its WatchID, StartTime and the bins in BINS (or `bins`)."""
+    ns = np.asarray(arrays.start_ns)
+    frame = pd.DataFrame({'WatchID': np.asarray(arrays.watch_id), 'StartTime': ns.view('datetime64[ns]')})
+    for name in bins or BINS:
+        frame[name] = BINS[name](arrays, ns)
+    if 'Week' in frame:
+        frame['Week'] = period_start(frame['Week'].to_numpy(), 'W')
+    if 'Season' in frame:
+        frame['Season'] = pd.Categorical.from_codes(frame['Season'], categories=SEASONS)
+    return frame
+
+
+###########################
+# Aggregates
+
+def _species_names(arrays):
+    """Alpha code of every species code, with 'UNKNOWN' for species without one and one extra slot for code -1."""
+    names = np.append(np.asarray(arrays.species, dtype=object), 'UNKNOWN')
+    names[names == ''] = 'UNKNOWN'
+    return names
+
+
+def _kept_watches(arrays, watch_mask):
+    """The watches in `watch_mask` (every watch if None) that have a StartTime, since every time bin needs one."""
+    keep = np.asarray(arrays.start_ns) != NAT
+    return keep if watch_mask is None else keep & np.asarray(watch_mask, dtype=bool)
+
+
+def _group_totals(arrays, keys, keep, species):
+    """
+    Sum the counts per (group, species) and the watches and effort per group, where a watch's group is given by the
+    integer `keys` (one array per level, one value per watch). Only the watches in `keep` are counted.
+
+    The species are the columns, by Alpha code: every species seen, or the Alpha codes in `species`. Returns the
+    distinct key combinations (one array per level), the counts (groups x species), watches and minutes per group,
+    and the Alpha codes of the columns.
+    """
+    # every combination of keys becomes one group number
+    levels, inverses = [], []
+    for values in keys:
+        distinct, inverse = np.unique(values[keep], return_inverse=True)
+        levels.append(distinct)
+        inverses.append(inverse.ravel())
+    shape = tuple(len(distinct) for distinct in levels)
+    if 0 in shape:
+        flat = np.zeros(0, dtype=np.int64)
+    else:
+        flat = np.ravel_multi_index(inverses, shape)
+    groups, group_of_kept = np.unique(flat, return_inverse=True)
+    watch_group = np.full(arrays.n_watches, -1, dtype=np.int64)
+    watch_group[keep] = group_of_kept.ravel()
+
+    watches = np.bincount(group_of_kept.ravel(), minlength=len(groups))
+    effort = np.nan_to_num(np.asarray(arrays.effort_min, dtype=np.float64)[keep])
+    minutes = np.bincount(group_of_kept.ravel(), weights=effort, minlength=len(groups))
+
+    # the sightings take the group of their watch, and the column of their species' Alpha code (code -1 indexes the
+    # extra 'UNKNOWN' slot at the end of the names)
+    rows = np.asarray(arrays.watch_row)
+    sighting_group = np.where(rows >= 0, watch_group[rows.clip(0)], -1)
+    seen = sighting_group >= 0
+    names = _species_names(arrays)
+    if species is None:
+        columns = np.unique(names[np.unique(np.asarray(arrays.species_code)[seen])].astype(str))
+    else:
+        columns = np.asarray([species] if isinstance(species, str) else list(species), dtype=str)
+        unknown = np.setdiff1d(columns, names.astype(str))
+        if len(unknown):
+            raise ValueError(f"Unknown species {', '.join(unknown)}")
+    column_of_name = dict(zip(columns, range(len(columns))))
+    column_of_code = np.array([column_of_name.get(name, -1) for name in names], dtype=np.int64)
+    code_column = column_of_code[np.asarray(arrays.species_code)]
+    seen &= code_column >= 0
+    cells = sighting_group[seen] * len(columns) + code_column[seen]
+    counts = np.bincount(cells, weights=np.asarray(arrays.count, dtype=np.float64)[seen],
+                         minlength=len(groups) * len(columns)).reshape(len(groups), len(columns))
+
+    group_keys = np.unravel_index(groups, shape) if len(groups) else [np.zeros(0, dtype=np.int64)] * len(keys)
+    return [distinct[index] for distinct, index in zip(levels, group_keys)], counts, watches, minutes, columns
+
+
+def binned_totals(arrays, by=('Season',), species=None, watch_mask=None):
+    """
+    Counts per species and effort for every combination of the bins in `by` (names in BINS, e.g.
+    ['CruiseID', 'DayOfCruise'] or ['SeasonYear', 'Season']). Returns one row per bin and species, with the total
+    Count, the Watches and EffortMinutes of the bin and the birds per watch. Species that weren't seen in a bin are
+    only listed (with a Count of 0) when they're asked for in `species`.
+    """
+    unknown = [name for name in by if name not in BINS]
+    if unknown:
+        raise ValueError(f"Unknown bins {', '.join(unknown)}, choose from {', '.join(BINS)}")
+    ns = np.asarray(arrays.start_ns)
+    keys = [BINS[name](arrays, ns) for name in by]
+    values, counts, watches, minutes, columns = _group_totals(arrays, keys, _kept_watches(arrays, watch_mask), species)
+
+    # without a species list, a bin only gets rows for the species seen in it
+    group, column = np.nonzero(counts) if species is None else np.indices(counts.shape).reshape(2, -1)
+    frame = pd.DataFrame({name: level[group] for name, level in zip(by, values)})
+    frame['Alpha'] = columns[column]
+    frame['Count'] = counts[group, column]
+    frame['Watches'] = watches[group]
+    frame['EffortMinutes'] = minutes[group]
+    frame['BirdsPerWatch'] = frame['Count'] / frame['Watches']
+    # bins are labelled like in `watch_bins`: weeks by their first day, seasons by name
+    if 'Week' in frame:
+        frame['Week'] = period_start(frame['Week'].to_numpy(), 'W')
+    if 'Season' in frame:
+        frame['Season'] = pd.Categorical.from_codes(frame['Season'], categories=SEASONS)
+    return frame
+
+
+def resample(arrays, freq='W', species=None, watch_mask=None, by_cruise=False):
+    """
+    Counts per species per period, with every period from the first to the last one (periods without watches are
+    0), indexed by the period's first day. The `Watches` and `EffortMinutes` columns come before the species columns.
+    With `by_cruise` the index is (CruiseID, period) and every cruise covers only its own periods.
+    """
+    ns = np.asarray(arrays.start_ns)
+    periods = period(ns, freq)
+    keys = ([np.asarray(arrays.cruise_id)] if by_cruise else []) + [periods]
+    values, counts, watches, minutes, columns = _group_totals(arrays, keys, _kept_watches(arrays, watch_mask), species)
+
+    # fill the gaps: each cruise (or the whole survey) gets every period between its first and last one. The groups
+    # come out sorted by (cruise, period), so each cruise's first and last period are at the ends of its run of groups
+    group_period = values[-1]
+    group_cruise = values[0] if by_cruise else np.zeros(len(group_period), dtype=np.int64)
+    cruises, first_row, per_cruise = np.unique(group_cruise, return_index=True, return_counts=True)
+    first_period = group_period[first_row]
+    lengths = group_period[first_row + per_cruise - 1] - first_period + 1
+    offsets = np.cumsum(lengths) - lengths
+    full_cruise = np.repeat(cruises, lengths)
+    full_period = np.arange(lengths.sum()) - np.repeat(offsets, lengths) + np.repeat(first_period, lengths)
+    cruise_number = np.repeat(np.arange(len(cruises)), per_cruise)
+    place = offsets[cruise_number] + group_period - first_period[cruise_number]
+
+    table = np.zeros((len(full_period), 2 + len(columns)))
+    table[place, 0] = watches
+    table[place, 1] = minutes
+    table[place, 2:] = counts
+
+    start = pd.DatetimeIndex(period_start(full_period, freq), name='Period')
+    index = pd.MultiIndex.from_arrays([full_cruise, start], names=['CruiseID', 'Period']) if by_cruise else start
+    frame = pd.DataFrame(table, index=index, columns=['Watches', 'EffortMinutes'] + list(columns))
+    frame['Watches'] = frame['Watches'].astype(np.int64)
+    return frame
+
+
+def rolling(series, window, min_periods=1):
+    """
+    Birds per watch of each species over a moving window of `window` periods of a `resample` result (per cruise if it
+    was resampled by cruise). Periods whose window has no watches are NaN.
+    """
+    # each window's sum is the difference of two cumulative sums, and a window can't reach back past the first
+    # period of its cruise (every cruise is one run of rows)
+    values = series.to_numpy(dtype=np.float64)
+    cumulative = np.vstack([np.zeros((1, values.shape[1])), np.cumsum(values, axis=0)])
+    rows = np.arange(len(series))
+    if isinstance(series.index, pd.MultiIndex):
+        cruises = series.index.get_level_values('CruiseID').to_numpy()
+        starts = np.flatnonzero(np.append(True, cruises[1:] != cruises[:-1]))
+        first = starts[np.searchsorted(starts, rows, side='right') - 1]
+    else:
+        first = np.zeros(len(series), dtype=np.int64)
+    window_start = np.maximum(rows + 1 - window, first)
+    sums = cumulative[rows + 1] - cumulative[window_start]
+    sums[rows + 1 - window_start < min_periods] = np.nan
+
+    sums = pd.DataFrame(sums, index=series.index, columns=series.columns)
+    watches = sums.pop('Watches')
+    sums.pop('EffortMinutes')
+    return sums.div(watches.where(watches > 0), axis=0)
+
+
+def _bin_names(text):
+    """Parse the bins argument of the command line: 'resample', or comma separated names from BINS."""
+    if text == 'resample':
+        return text
+    names = text.split(',')
+    unknown = [name for name in names if name not in BINS]
+    if unknown:
+        raise argparse.ArgumentTypeError(f"unknown bins {', '.join(unknown)}, choose from {', '.join(BINS)}")
+    return names
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Summarize the survey counts by time bins.')
+    parser.add_argument('by', nargs='?', default=['Season'], type=_bin_names,
+                        help=f"comma separated bins from {', '.join(BINS)}, or 'resample'")
+    parser.add_argument('--freq', default='W', choices=list(FREQUENCIES), help='period for resample')
+    parser.add_argument('--window', type=int, default=0, help='with resample: birds per watch over this many periods')
+    parser.add_argument('--species', default=None, help='comma separated Alpha codes')
+    parser.add_argument('--by-cruise', action='store_true', help='with resample: one series per cruise')
+    args = parser.parse_args()
+
+    arrays = open_arrays()
+    species = args.species.split(',') if args.species else None
+    with pd.option_context('display.width', 200, 'display.max_rows', 200):
+        if args.by == 'resample':
+            series = resample(arrays, args.freq, species, by_cruise=args.by_cruise)
+            print(rolling(series, args.window) if args.window else series)
+        else:
+            print(binned_totals(arrays, args.by, species).to_string(index=False))
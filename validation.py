@@ -0,0 +1,333 @@
+#####################################################
+###############   INGEST VALIDATION    ##############
+
+"""
+Nothing checked the exported tables before they were used. A sighting with a SpecInfoID that isn't in tblSpeciesInfo,
+a watch at latitude 470 or a code that isn't in its `lkp*` table only showed up later as an odd figure, and the merge in
+`preprocessing.py` turns a missing Count into 0 along with the watches that really had no sightings.
+
+Here I check the fact tables against a set of rules while the store is built (see `build_store` in store.py), on the
+tables already loaded for the store, so the exports aren't read a second time. Every rule is one vectorized check of
+one column:
+
+- `key`: the value must be a key of the parent table (tblWatch.CruiseID, tblSighting.WatchID, tblSighting.SpecInfoID)
+- `unique`: the table's own key appears only once (later copies are the violations)
+- `domain`: the code must be in its `lkp*` table (Weather, SeaState, Glare, PlatformClass, the sighting codes...)
+- `range`: the value must be a number within limits (latitudes, longitudes, Count >= 0)
+- `required`: the value can't be missing (Count)
+- `order`: EndTime can't be before StartTime (watches that crossed midnight are sorted out when the times are read)
+
+Each rule either quarantines the rows that break it, or only flags them (they stay in the store). Quarantined rows are
+taken out before the tables are sorted, together with the watches of a quarantined cruise and the sightings of a
+quarantined watch, and saved with the rules they broke to `cache/store/quarantine/`. Every violation, flagged or
+quarantined, is one row of `cache/store/violations.parquet`: the table, rule, row in the export, key, column and value.
+
+    python validation.py            # violations per rule, and a few examples of each
+"""
+
+# load the required modules
+import argparse
+import glob
+import hashlib
+import os
+
+import numpy as np
+import pandas as pd
+
+from lookups import load_lookups
+
+
+# Define the folder of the store (the violations and quarantined rows are saved next to the tables)
+STORE_DIR = os.path.join('cache', 'store')
+
+# What happens to rows that break a rule
+QUARANTINE = 'quarantine'
+FLAG = 'flag'
+
+# The key of each fact table, recorded with every violation
+PRIMARY_KEYS = {
+    'tblCruise': 'CruiseID',
+    'tblWatch': 'WatchID',
+    'tblSighting': 'FlockID',
+}
+
+# Rules checked on every ingest: name -> (table, check, arguments, action)
+RULES = {
+    # keys and relationships
+    'duplicate_cruise': ('tblCruise', 'unique', ('CruiseID',), QUARANTINE),
+    'duplicate_watch': ('tblWatch', 'unique', ('WatchID',), QUARANTINE),
+    'duplicate_sighting': ('tblSighting', 'unique', ('FlockID',), QUARANTINE),
+    'unknown_cruise': ('tblWatch', 'key', ('CruiseID', 'tblCruise', 'CruiseID'), QUARANTINE),
+    'unknown_watch': ('tblSighting', 'key', ('WatchID', 'tblWatch', 'WatchID'), QUARANTINE),
+    'unknown_species': ('tblSighting', 'key', ('SpecInfoID', 'tblSpeciesInfo', 'SpecInfoID'), QUARANTINE),
+
+    # positions, times and counts
+    'lat_start_range': ('tblWatch', 'range', ('LatStart', -90, 90), QUARANTINE),
+    'long_start_range': ('tblWatch', 'range', ('LongStart', -180, 180), QUARANTINE),
+    'lat_end_range': ('tblWatch', 'range', ('LatEnd', -90, 90), QUARANTINE),
+    'long_end_range': ('tblWatch', 'range', ('LongEnd', -180, 180), QUARANTINE),
+    'end_before_start': ('tblWatch', 'order', ('StartTime', 'EndTime'), QUARANTINE),
+    'missing_position': ('tblWatch', 'required', ('LatStart',), FLAG),
+    'missing_count': ('tblSighting', 'required', ('Count',), QUARANTINE),
+    'negative_count': ('tblSighting', 'range', ('Count', 0, None), QUARANTINE),
+    'obs_lat_range': ('tblSighting', 'range', ('ObsLat', -90, 90), FLAG),
+    'obs_long_range': ('tblSighting', 'range', ('ObsLong', -180, 180), FLAG),
+
+    # codes the analyses group by are quarantined, the rest are only flagged
+    'unknown_platform_class': ('tblWatch', 'domain', ('PlatformClass', 'lkpPlatformClass'), QUARANTINE),
+    'unknown_weather': ('tblWatch', 'domain', ('Weather', 'lkpWeather'), QUARANTINE),
+    'unknown_sea_state': ('tblWatch', 'domain', ('SeaState', 'lkpSeaState'), QUARANTINE),
+    'unknown_glare': ('tblWatch', 'domain', ('Glare', 'lkpGlare'), QUARANTINE),
+    'unknown_wind_force': ('tblWatch', 'domain', ('WindForce', 'lkpWindForce'), FLAG),
+    'unknown_platform_activity': ('tblWatch', 'domain', ('PlatformActivity', 'lkpPlatformActivity'), FLAG),
+    'unknown_observer': ('tblWatch', 'domain', ('Observer', 'lkpObserver'), FLAG),
+    'unknown_scan_type': ('tblWatch', 'domain', ('ScanType', 'lkpScanType'), FLAG),
+    'unknown_dist_meth': ('tblWatch', 'domain', ('DistMeth', 'lkpDistMeth'), FLAG),
+    'unknown_what_count': ('tblWatch', 'domain', ('WhatCount', 'lkpWhatCount'), FLAG),
+    'unknown_distance': ('tblSighting', 'domain', ('Distance', 'lkpDistCode'), FLAG),
+    'unknown_fly_swim': ('tblSighting', 'domain', ('FlySwim', 'lkpFlySwim'), FLAG),
+    'unknown_association': ('tblSighting', 'domain', ('Association', 'lkpAssociation'), FLAG),
+    'unknown_behaviour': ('tblSighting', 'domain', ('Behaviour', 'lkpBehaviour'), FLAG),
+    'unknown_age': ('tblSighting', 'domain', ('Age', 'lkpAge'), FLAG),
+    'unknown_plumage': ('tblSighting', 'domain', ('Plumage', 'lkpPlumage'), FLAG),
+    'unknown_sex': ('tblSighting', 'domain', ('Sex', 'lkpSex'), FLAG),
+}
+
+# Children of a quarantined row are quarantined with it: child table -> (parent table, key column, rule name)
+CASCADES = [
+    ('tblWatch', 'tblCruise', 'CruiseID', 'cruise_quarantined'),
+    ('tblSighting', 'tblWatch', 'WatchID', 'watch_quarantined'),
+]
+
+# Columns of the violations table
+VIOLATION_COLUMNS = ['Table', 'Rule', 'Action', 'Row', 'Key', 'Column', 'Value']
+
+
+###########################
+# Checks
+
+def _numbers(values):
+    return pd.to_numeric(values, errors='coerce').to_numpy(dtype=np.float64, na_value=np.nan)
+
+
+def _check_unique(tables, table, column):
+    return tables[table][column].duplicated(keep='first').to_numpy()
+
+
+def _isin(values, keys):
+    """Whether each value is one of `keys`, by binary search in the sorted keys."""
+    keys = np.sort(keys)
+    if len(keys) == 0:
+        return np.zeros(len(values), dtype=bool)
+    position = np.searchsorted(keys, values).clip(0, len(keys) - 1)
+    return keys[position] == values
+
+
+def _check_key(tables, table, column, parent, parent_column):
+    values = tables[table][column]
+    keys = tables[parent][parent_column].dropna().to_numpy()
+    return ~_isin(values.to_numpy(), keys) & values.notna().to_numpy()
+
+
+def _check_range(tables, table, column, low, high):
+    values = tables[table][column]
+    numbers = _numbers(values)
+    # values that aren't numbers at all break the rule too, missing values are left to the `required` rules
+    bad = np.isnan(numbers) & values.notna().to_numpy()
+    if low is not None:
+        bad |= numbers < low
+    if high is not None:
+        bad |= numbers > high
+    return bad
+
+
+def _check_required(tables, table, column):
+    return tables[table][column].isna().to_numpy()
+
+
+def _check_order(tables, table, start, end):
+    starts = pd.to_datetime(tables[table][start], errors='coerce')
+    ends = pd.to_datetime(tables[table][end], errors='coerce')
+    return (ends < starts).to_numpy()
+
+
+def _check_domain(tables, table, column, lookup, lookups):
+    # a column holds only a few distinct codes, so only those are looked up (missing values factorize to -1)
+    codes, distinct = pd.factorize(tables[table][column])
+    unknown = np.append(lookups[lookup].index(distinct) < 0, False)
+    return unknown[codes]
+
+
+CHECKS = {
+    'unique': _check_unique,
+    'key': _check_key,
+    'range': _check_range,
+    'required': _check_required,
+    'order': _check_order,
+    'domain': _check_domain,
+}
+
+
+###########################
+# Running the rules
+
+def _violations(tables, table, rule, action, rows, column):
+    """The violations table rows for the `rows` of `table` that broke `rule`."""
+    frame = tables[table]
+    key = PRIMARY_KEYS[table]
+    return pd.DataFrame({
+        'Table': table,
+        'Rule': rule,
+        'Action': action,
+        'Row': rows.astype(np.int64),
+        'Key': pd.to_numeric(frame[key].to_numpy()[rows], errors='coerce'),
+        'Column': column,
+        'Value': frame[column].to_numpy()[rows].astype(str),
+    }, columns=VIOLATION_COLUMNS)
+
+
+def _available(tables, table, check, arguments, lookups):
+    """Whether the tables (and lookup table) a rule needs were exported, so it can run."""
+    if table not in tables or arguments[0] not in tables[table]:
+        return False
+    if check == 'key':
+        return arguments[1] in tables and arguments[2] in tables[arguments[1]]
+    if check == 'order':
+        return arguments[1] in tables[table]
+    if check == 'domain':
+        try:
+            lookups[arguments[1]]
+        except FileNotFoundError:
+            return False
+    return True
+
+
+def validate(tables, tables_dir=None, rules=None):
+    """
+    Check the fact tables against RULES (or `rules`) and take out the quarantined rows.
+
+    `tables` maps table names to the loaded DataFrames. Returns the tables without the quarantined rows (same dict
+    layout, original row order), the violations table and the quarantined rows of each table, with a `Rules` column
+    naming the rules each one broke.
+    """
+    rules = RULES if rules is None else rules
+    lookups = load_lookups() if tables_dir is None else load_lookups(tables_dir)
+
+    found = []
+    quarantined = {table: np.zeros(len(tables[table]), dtype=bool) for table in PRIMARY_KEYS if table in tables}
+    for rule, (table, check, arguments, action) in rules.items():
+        if not _available(tables, table, check, arguments, lookups):
+            continue
+        extra = (lookups,) if check == 'domain' else ()
+        bad = CHECKS[check](tables, table, *arguments, *extra)
+        if bad.any():
+            rows = np.flatnonzero(bad)
+            found.append(_violations(tables, table, rule, action, rows, arguments[0]))
+            if action == QUARANTINE:
+                quarantined[table][rows] = True
+
+    # rows whose parent was quarantined go with it (cruise -> watches -> sightings)
+    for table, parent, column, rule in CASCADES:
+        if table in quarantined and parent in quarantined and quarantined[parent].any():
+            # a key only counts as quarantined if no copy of it was kept (e.g. a duplicated CruiseID)
+            parent_keys = tables[parent][column].to_numpy()
+            parent_keys = np.setdiff1d(parent_keys[quarantined[parent]], parent_keys[~quarantined[parent]])
+            bad = _isin(tables[table][column].to_numpy(), parent_keys) & ~quarantined[table]
+            if bad.any():
+                rows = np.flatnonzero(bad)
+                found.append(_violations(tables, table, rule, QUARANTINE, rows, column))
+                quarantined[table][rows] = True
+
+    violations = pd.concat(found, ignore_index=True) if found else pd.DataFrame(
+        {column: pd.Series(dtype=dtype) for column, dtype in zip(
+            VIOLATION_COLUMNS, [str, str, str, np.int64, np.float64, str, str])})
+    for column in ['Table', 'Rule', 'Action', 'Column']:
+        violations[column] = violations[column].astype('category')
+
+    clean, removed = dict(tables), {}
+    for table, mask in quarantined.items():
+        if mask.any():
+            broken = violations[(violations['Table'] == table) & (violations['Action'] == QUARANTINE)]
+            reasons = broken.groupby('Row', observed=True)['Rule'].agg(lambda names: ','.join(map(str, names)))
+            removed[table] = tables[table][mask].assign(Rules=reasons.reindex(np.flatnonzero(mask)).to_numpy())
+            clean[table] = tables[table][~mask].reset_index(drop=True)
+    return clean, violations, removed
+
+
+###########################
+# Keeping the store current
+
+def rules_version(rules=None):
+    """Hash of the rules and cascades, recorded by the store so that changing a rule rebuilds it."""
+    rules = RULES if rules is None else rules
+    return hashlib.sha256(repr((sorted(rules.items()), CASCADES)).encode()).hexdigest()[:16]
+
+
+def lookup_sources(tables_dir, rules=None):
+    """The `lkp*` files the domain rules check against, with their modification times (None if not exported)."""
+    rules = RULES if rules is None else rules
+    names = sorted({arguments[1] for _, check, arguments, _ in rules.values() if check == 'domain'})
+    sources = {}
+    for name in names:
+        path = os.path.join(tables_dir, f'{name}.xlsx')
+        sources[name] = os.path.getmtime(path) if os.path.exists(path) else None
+    return sources
+
+
+###########################
+# Saving and reading the results
+
+def write_violations(violations, quarantined, store_dir=STORE_DIR):
+    """Save the violations table and the quarantined rows next to the store's tables."""
+    quarantine_dir = os.path.join(store_dir, 'quarantine')
+    os.makedirs(quarantine_dir, exist_ok=True)
+    # rows quarantined by an earlier build that are fine now mustn't linger
+    for path in glob.glob(os.path.join(quarantine_dir, '*.parquet')):
+        os.remove(path)
+    violations.to_parquet(os.path.join(store_dir, 'violations.parquet'), index=False)
+    for table, frame in quarantined.items():
+        frame.reset_index(drop=True).to_parquet(os.path.join(quarantine_dir, f'{table}.parquet'), index=False)
+
+
+def summarize(violations):
+    """Number of violations of each rule, most frequent first."""
+    if len(violations) == 0:
+        return pd.DataFrame(columns=['Table', 'Rule', 'Action', 'Rows'])
+    counts = violations.groupby(['Table', 'Rule', 'Action'], observed=True).size().rename('Rows').reset_index()
+    return counts.sort_values('Rows', ascending=False, kind='stable').reset_index(drop=True)
+
+
+def describe(violations, quarantined):
+    """One line about the outcome of the validation, for the ingest output."""
+    if len(violations) == 0:
+        return 'Validation: no violations'
+    removed = ', '.join(f'{len(frame)} {table}' for table, frame in quarantined.items()) or 'nothing'
+    return (f"Validation: {len(violations)} violations of {violations['Rule'].nunique()} rules, "
+            f"quarantined {removed}")
+
+
+def load_violations(store_dir=STORE_DIR):
+    """Read the violations table of the last build."""
+    return pd.read_parquet(os.path.join(store_dir, 'violations.parquet'))
+
+
+def load_quarantine(table, store_dir=STORE_DIR):
+    """Read the rows of `table` quarantined by the last build (empty if there weren't any)."""
+    path = os.path.join(store_dir, 'quarantine', f'{table}.parquet')
+    return pd.read_parquet(path) if os.path.exists(path) else pd.DataFrame()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the rule violations found when the store was last built.')
+    parser.add_argument('--examples', type=int, default=3, help='example rows to show for each rule')
+    args = parser.parse_args()
+
+    violations = load_violations()
+    summary = summarize(violations)
+    if len(summary) == 0:
+        print('No violations')
+    else:
+        print(summary.to_string(index=False))
+        for rule, group in violations.groupby('Rule', observed=True):
+            print(f"\n{rule}:")
+            print(group.head(args.examples)[['Row', 'Key', 'Column', 'Value']].to_string(index=False))
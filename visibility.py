@@ -12,12 +12,16 @@ import matplotlib.pyplot as plt
 import seaborn as sns
 from sklearn.linear_model import LinearRegression
 import numpy as np
+from pipeline import load_input
+from artifact_cache import ArtifactCache, code_version, package_version
+from instrumentation import stage
+from render import show
 
 # Define file paths
 stationary_survey_path = r'data\stationary_platform_data.xlsx'
 
 # Load the stationary survey data
-stationary_survey = pd.read_excel(stationary_survey_path)
+stationary_survey = load_input('stationary_survey', stationary_survey_path)
 
 # Aggregate the total count of birds for each WatchID
 total_count_per_watch = stationary_survey.groupby('WatchID')['Count'].sum().reset_index()
@@ -30,31 +34,43 @@ visibility_data = pd.merge(stationary_survey[['WatchID', 'Visibility']], total_c
 X = visibility_data[['Visibility']].values
 y = visibility_data['TotalCount'].values
 
+# The fit and the figure are cached by a hash of the data and this script (and the fit by the scikit-learn version,
+# see artifact_cache.py), so they are only redone when one of those changes
+cache = ArtifactCache()
+model_key = cache.key(X, y, 'LinearRegression', code_version(__file__), package_version('scikit-learn'))
+figure_key = cache.key(model_key, visibility_data, code_version(__file__))
+
 # Fit linear regression model
-model = LinearRegression().fit(X, y)
+with stage('fit', rows_in=len(X)):
+    model = cache.memoize(model_key, lambda: LinearRegression().fit(X, y))
 slope = model.coef_[0]
 intercept = model.intercept_
 r_squared = model.score(X, y)
 
-# Plot sizing
-plt.figure(figsize=(10, 6))
+def render_figure(path):
+    # Plot sizing
+    plt.figure(figsize=(10, 6))
+
+    # Plot the scatter plot with line of best fit
+    sns.regplot(x='Visibility', y='TotalCount', data=visibility_data, scatter_kws={'s':50}, line_kws={'color':'red'})
 
-# Plot the scatter plot with line of best fit
-sns.regplot(x='Visibility', y='TotalCount', data=visibility_data, scatter_kws={'s':50}, line_kws={'color':'red'})
+    # Display the trend metrics on the plot
+    plt.text(
+        0.05, 0.95, f'Linear Trend:\nSlope: {slope:.2f}\nIntercept: {intercept:.2f}\nR²: {r_squared:.2f}',
+        ha='left', va='top', fontsize=12, bbox=dict(facecolor='white', alpha=0.7, edgecolor='black'),
+        transform=plt.gca().transAxes
+    )
 
-# Display the trend metrics on the plot
-plt.text(
-    0.05, 0.95, f'Linear Trend:\nSlope: {slope:.2f}\nIntercept: {intercept:.2f}\nR²: {r_squared:.2f}',
-    ha='left', va='top', fontsize=12, bbox=dict(facecolor='white', alpha=0.7, edgecolor='black'),
-    transform=plt.gca().transAxes
-)
+    plt.xlabel('Visibility (km)')
+    plt.ylabel('Count per watch')
+    plt.grid(True)
 
-plt.xlabel('Visibility (km)')
-plt.ylabel('Count per watch')
-plt.grid(True)
+    # Save the plot as a PNG file
+    plt.savefig(path)
 
-# Save the plot as a PNG file
-plt.savefig('figures/visibility_vs_total_counts.png')
+# Render the plot only if it isn't cached already
+with stage('render', rows_in=len(visibility_data)):
+    cache.output(figure_key, 'figures/visibility_vs_total_counts.png', render_figure)
 
-# Show the plot (optional)
-plt.show()
\ No newline at end of file
+# Show the plot (optional), only when there's a screen to show it on so headless cluster jobs don't wait on it
+show()
\ No newline at end of file